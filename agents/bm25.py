@@ -0,0 +1,118 @@
+from collections import Counter
+from typing import List, Dict, Optional, Tuple
+from agents.keywords import TOKEN_PATTERN, STOPWORDS
+import numpy as np
+import json
+import os
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def analyze(text: str) -> List[str]:
+    """Lowercase terms of a text without the stopwords."""
+    return [term for term in TOKEN_PATTERN.findall(text.casefold()) if term not in STOPWORDS]
+
+
+class BM25Index:
+    """Okapi BM25 over the chunk contents of a collection.
+
+    Posting lists are stored CSR style: the postings of the term at row `r` are
+    `doc_ids[offsets[r]:offsets[r + 1]]` with their frequencies in `term_freqs`, as flat uint32 and
+    uint16 arrays, so the whole index is a handful of contiguous buffers instead of Python objects.
+    """
+
+    def __init__(self, vocabulary: Dict[str, int], offsets: np.ndarray, doc_ids: np.ndarray, term_freqs: np.ndarray, doc_lengths: np.ndarray, k1: float = BM25_K1, b: float = BM25_B):
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+
+        documents = len(doc_lengths)
+        document_frequency = np.diff(offsets).astype(np.float32)
+        self.idf = np.log1p((documents - document_frequency + 0.5) / (document_frequency + 0.5)).astype(np.float32)
+        average_length = float(doc_lengths.mean()) if documents else 0.0
+        # the length normalization of every document, computed once
+        self.norms = (k1 * (1 - b + b * doc_lengths / (average_length or 1.0))).astype(np.float32)
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    @classmethod
+    def build(cls, contents: List[str], k1: float = BM25_K1, b: float = BM25_B) -> "BM25Index":
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+        doc_lengths = np.zeros(len(contents), dtype=np.uint32)
+        for doc_id, content in enumerate(contents):
+            terms = analyze(content or "")
+            doc_lengths[doc_id] = len(terms)
+            for term, count in Counter(terms).items():
+                postings.setdefault(term, []).append((doc_id, count))
+
+        vocabulary = {term: row for row, term in enumerate(sorted(postings))}
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        doc_ids, term_freqs = [], []
+        for term, row in vocabulary.items():
+            for doc_id, count in postings[term]:
+                doc_ids.append(doc_id)
+                term_freqs.append(min(count, np.iinfo(np.uint16).max))
+            offsets[row + 1] = len(doc_ids)
+        return cls(vocabulary, offsets, np.asarray(doc_ids, dtype=np.uint32), np.asarray(term_freqs, dtype=np.uint16), doc_lengths, k1, b)
+
+    def save(self, directory: str):
+        np.savez(os.path.join(directory, "bm25.npz"), offsets=self.offsets, doc_ids=self.doc_ids, term_freqs=self.term_freqs, doc_lengths=self.doc_lengths)
+        with open(os.path.join(directory, "bm25.json"), "w", encoding="utf-8") as f:
+            json.dump({"k1": self.k1, "b": self.b, "vocabulary": self.vocabulary}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, directory: str) -> "BM25Index":
+        with open(os.path.join(directory, "bm25.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        with np.load(os.path.join(directory, "bm25.npz")) as arrays:
+            return cls(meta["vocabulary"], arrays["offsets"], arrays["doc_ids"], arrays["term_freqs"], arrays["doc_lengths"], meta["k1"], meta["b"])
+
+    def scores(self, query: str) -> np.ndarray:
+        """BM25 score of every document for the query."""
+        scores = np.zeros(len(self), dtype=np.float32)
+        for term, count in Counter(analyze(query)).items():
+            row = self.vocabulary.get(term)
+            if row is None:
+                continue
+            start, end = self.offsets[row], self.offsets[row + 1]
+            doc_ids = self.doc_ids[start:end]
+            term_freqs = self.term_freqs[start:end].astype(np.float32)
+            # doc ids are unique within a posting list, so a plain fancy-index add is safe
+            scores[doc_ids] += count * self.idf[row] * term_freqs * (self.k1 + 1) / (term_freqs + self.norms[doc_ids])
+        return scores
+
+    def search(self, query: str, limit: int = 5, mask: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """Get the top `limit` (document position, score) pairs, documents without a query term are skipped."""
+        scores = self.scores(query)
+        if mask is not None:
+            scores[~mask] = 0.0
+        matched = np.flatnonzero(scores > 0)
+        if len(matched) > limit:
+            matched = matched[np.argpartition(-scores[matched], limit - 1)[:limit]]
+        matched = matched[np.argsort(-scores[matched], kind="stable")]
+        return [(int(i), float(scores[i])) for i in matched]
+
+
+def reciprocal_rank_fusion(rankings: List[List], weights: Optional[List[float]] = None, k: int = 60) -> Dict:
+    """Fuse ranked lists of ids, an id scores sum(weight / (k + rank)) over the lists it appears in.
+
+    Args:
+        rankings: The ranked lists of ids, best first.
+        weights: The weight of every list, 1 by default.
+        k: Dampens the advantage of the top ranks.
+
+    Returns:
+        The fused score of every id.
+    """
+    weights = weights or [1.0] * len(rankings)
+    fused: Dict = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, item in enumerate(ranking, start=1):
+            fused[item] = fused.get(item, 0.0) + weight / (k + rank)
+    return fused
@@ -1,14 +1,225 @@
-import groq 
+import groq
 import cohere
+import openai
+import asyncio
+import weakref
+import threading
+import importlib.util
+import logging
+import httpx
+import time
+import ell
 import os
+from concurrent.futures import Future
+from typing import Callable, Dict, Iterable, Optional, TypeVar
 from dotenv import load_dotenv
+from agents.tracing import UsageRecordingStore, count_request, async_count_request
+from agents.ell_store import BackgroundStore
 
 load_dotenv()
 
 os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
 
-groq_client = groq.Groq(
-    api_key=os.getenv('GROQ_API_KEY'),
+logger = logging.getLogger(__name__)
+
+ELL_STORE = "./logdir"
+
+# keep-alive pool shared by the provider clients, every host gets its own connections
+POOL_MAX_CONNECTIONS = int(os.getenv("POOL_MAX_CONNECTIONS", "64"))
+POOL_MAX_KEEPALIVE = int(os.getenv("POOL_MAX_KEEPALIVE", "32"))
+POOL_KEEPALIVE_EXPIRY = float(os.getenv("POOL_KEEPALIVE_EXPIRY", "120"))
+# HTTP/2 multiplexes the concurrent requests to a host over one connection, it needs the h2 package
+HTTP2 = os.getenv("HTTP2", "true").lower() == "true" and importlib.util.find_spec("h2") is not None
+
+COHERE_URL = "https://api.cohere.com"
+ZEP_URL = "https://api.getzep.com"
+
+T = TypeVar("T")
+
+_factories: Dict[str, Callable[[], object]] = {}
+_warmups: Dict[str, Callable[[object], object]] = {}
+_clients: Dict[str, object] = {}
+_clients_lock = threading.RLock()
+
+_timings: Dict[str, float] = {}
+_timings_lock = threading.Lock()
+
+
+def record_timing(name: str, seconds: float):
+    """Record a startup step, only its first occurrence is kept."""
+    with _timings_lock:
+        _timings.setdefault(name, seconds)
+
+
+def startup_report() -> Dict[str, float]:
+    """Seconds spent importing the app, creating every client and warming it up, by step."""
+    with _timings_lock:
+        return dict(_timings)
+
+
+def pool_limits() -> httpx.Limits:
+    return httpx.Limits(max_connections=POOL_MAX_CONNECTIONS, max_keepalive_connections=POOL_MAX_KEEPALIVE, keepalive_expiry=POOL_KEEPALIVE_EXPIRY)
+
+
+def register_client(name: str, factory: Callable[[], object], warmup: Optional[Callable[[object], object]] = None):
+    """Declare a client created by `factory` on first use.
+
+    Args:
+        name: The name of the client.
+        factory: Creates the client.
+        warmup: Opens the connections of the client, called by `warmup`.
+    """
+    with _clients_lock:
+        _factories[name] = factory
+        if warmup is not None:
+            _warmups[name] = warmup
+
+
+def set_client(name: str, client: object):
+    """Use the given client instead of creating one, e.g. an in-memory Qdrant."""
+    with _clients_lock:
+        _clients[name] = client
+
+
+def get_client(name: str):
+    """Get the shared client `name`, created on first use."""
+    client = _clients.get(name)
+    if client is not None:
+        return client
+    with _clients_lock:
+        if name not in _clients:
+            if name not in _factories:
+                raise ValueError(f"Unknown client: {name}")
+            started = time.perf_counter()
+            _clients[name] = _factories[name]()
+            record_timing(f"client.{name}", time.perf_counter() - started)
+        return _clients[name]
+
+
+def lazy_client(name: str, client_type: type):
+    """A `client_type` standing for the shared client `name`, which is created on first use.
+
+    The ell decorators take the client of an LMP when the module is imported and pick the provider
+    from its type, the proxy has the type without creating the client and its connection pool.
+    """
+    class LazyClient(client_type):
+        def __init__(self):
+            pass
+
+        def __getattr__(self, attribute: str):
+            return getattr(get_client(name), attribute)
+
+    return LazyClient()
+
+
+def warmup(names: Optional[Iterable[str]] = None, background: bool = True) -> Optional[Future]:
+    """Create the clients and open their connections before the first request.
+
+    Args:
+        names: The clients to warm up, every client with a warmup by default.
+        background: Whether to return right away and warm up in a thread.
+
+    Returns:
+        A future done once the clients are warm when in the background.
+    """
+    names = list(_warmups if names is None else names)
+
+    def run():
+        for name in names:
+            started = time.perf_counter()
+            try:
+                client = get_client(name)
+                if name in _warmups:
+                    _warmups[name](client)
+            except Exception as e:
+                # a provider that cannot be reached now is connected to on first use instead
+                logger.warning("could not warm up the %s client: %s", name, e)
+            record_timing(f"warmup.{name}", time.perf_counter() - started)
+
+    if not background:
+        run()
+        return None
+    future: Future = Future()
+
+    def target():
+        run()
+        future.set_result(startup_report())
+
+    threading.Thread(target=target, name="client-warmup", daemon=True).start()
+    return future
+
+
+def open_connection(url: str):
+    """Open a connection to a host in the shared pool, any response will do."""
+    get_client("http").head(url)
+
+
+# the request hook counts the requests of every traced call, the retries of the SDKs included
+register_client("http", lambda: httpx.Client(http2=HTTP2, limits=pool_limits(), event_hooks={"request": [count_request]}))
+register_client(
+    "openai",
+    lambda: openai.Client(http_client=get_client("http")),
+    lambda client: open_connection(str(client.base_url)),
 )
+register_client(
+    "groq",
+    lambda: groq.Groq(api_key=os.getenv('GROQ_API_KEY'), http_client=get_client("http")),
+    lambda client: open_connection(str(client.base_url)),
+)
+register_client(
+    "cohere",
+    lambda: cohere.ClientV2(os.getenv("COHERE_API_KEY"), httpx_client=get_client("http")),
+    lambda client: open_connection(COHERE_URL),
+)
+
+
+_ell_initialized = False
+
+
+def init_ell(store: str = ELL_STORE):
+    """Initialize ell once per process, its OpenAI models use the shared OpenAI client."""
+    global _ell_initialized
+    with _clients_lock:
+        if _ell_initialized:
+            return
+        started = time.perf_counter()
+        ell.init(store=store)
+        # invocations are sampled and written off the request path, see ELL_LOGGING
+        ell.config.store = BackgroundStore(ell.config.store)
+        # ell parses the token usage of every LMP call, the traces take it from the store
+        ell.config.store = UsageRecordingStore(ell.config.store)
+        # ell creates its own OpenAI client at import, with a pool of its own
+        ell.models.openai.register(get_client("openai"))
+        ell.config.default_client = get_client("openai")
+        _ell_initialized = True
+        record_timing("ell.init", time.perf_counter() - started)
+
+
+# async clients of every running event loop
+_loop_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, object]]" = weakref.WeakKeyDictionary()
+
+
+def loop_client(name: str, factory: Callable[[], T]) -> T:
+    """Get the async client `name` of the running event loop, created by `factory` on first use.
+
+    The connection pool of an async client is bound to the event loop it was first used in, so every
+    loop, e.g. every `asyncio.run`, gets its own clients and reuses them for all its requests.
+    """
+    loop = asyncio.get_running_loop()
+    clients = _loop_clients.setdefault(loop, {})
+    if name not in clients:
+        clients[name] = factory()
+    return clients[name]
+
+
+def async_http_client() -> httpx.AsyncClient:
+    """The keep-alive pool shared by the async clients of the running event loop."""
+    return loop_client("http", lambda: httpx.AsyncClient(http2=HTTP2, limits=pool_limits(), event_hooks={"request": [async_count_request]}))
+
+
+def async_groq_client() -> groq.AsyncGroq:
+    return loop_client("groq", lambda: groq.AsyncGroq(api_key=os.getenv('GROQ_API_KEY'), http_client=async_http_client()))
+
 
-cohere_client = cohere.ClientV2(os.getenv("COHERE_API_KEY"))
\ No newline at end of file
+def async_openai_client() -> openai.AsyncClient:
+    return loop_client("openai", lambda: openai.AsyncClient(http_client=async_http_client()))
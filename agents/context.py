@@ -0,0 +1,174 @@
+from collections import OrderedDict
+from typing import List, Dict, Optional
+from agents.bm25 import analyze
+from ell import Message
+import threading
+import tiktoken
+import hashlib
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# encoding of the token counts stored in the chunk payloads at ingest, the one of the answer model
+TOKEN_COUNT_ENCODING = "o200k_base"
+# fallback for the models tiktoken does not know, e.g. the llama models served by Groq
+DEFAULT_ENCODING = "cl100k_base"
+
+# prompt token budgets per model, documents are the retrieved chunks and history the conversation
+CONTEXT_BUDGETS = {
+    "gpt-4o-2024-08-06": {"documents": 3000, "history": 1500},
+    "gpt-4o-mini": {"documents": 3000, "history": 1500},
+    "llama3-70b-8192": {"documents": 2500, "history": 1000},
+    "llama-3.1-8b-instant": {"documents": 1500, "history": 800},
+}
+DEFAULT_BUDGET = {"documents": 2000, "history": 1000}
+DOCUMENT_TOKEN_BUDGET = os.getenv("DOCUMENT_TOKEN_BUDGET")
+HISTORY_TOKEN_BUDGET = os.getenv("HISTORY_TOKEN_BUDGET")
+
+# tokens added by the chat format around every message
+MESSAGE_TOKENS = 4
+TOKEN_CACHE_SIZE = 16384
+
+# a chunk sharing this share of its word shingles with a chunk ranked above it is dropped
+DUPLICATE_OVERLAP = 0.8
+SHINGLE_SIZE = 5
+
+_encodings: Dict[str, tiktoken.Encoding] = {}
+_token_counts: "OrderedDict[str, int]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def encoding(model: Optional[str] = None) -> tiktoken.Encoding:
+    """Get the tiktoken encoding of a model, the encoding of the stored token counts by default."""
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding(TOKEN_COUNT_ENCODING)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding(DEFAULT_ENCODING)
+    return _encodings[model]
+
+
+def budget(model: str, part: str) -> int:
+    """Get the token budget of the documents or the history of a prompt to the model."""
+    override = {"documents": DOCUMENT_TOKEN_BUDGET, "history": HISTORY_TOKEN_BUDGET}[part]
+    if override is not None:
+        return int(override)
+    return CONTEXT_BUDGETS.get(model, DEFAULT_BUDGET)[part]
+
+
+def _key(name: str, text: str) -> str:
+    return name + ":" + hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def seed_token_count(text: str, count: int, encoding_name: str = TOKEN_COUNT_ENCODING):
+    """Cache a token count known beforehand, e.g. the one stored with a chunk at ingest."""
+    with _lock:
+        _token_counts[_key(encoding_name, text)] = count
+        while len(_token_counts) > TOKEN_CACHE_SIZE:
+            _token_counts.popitem(last=False)
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """Count the tokens of a text for a model, counts are cached per text."""
+    if not text:
+        return 0
+    enc = encoding(model)
+    key = _key(enc.name, text)
+    with _lock:
+        count = _token_counts.get(key)
+        if count is not None:
+            _token_counts.move_to_end(key)
+            return count
+    count = len(enc.encode(text, disallowed_special=()))
+    seed_token_count(text, count, enc.name)
+    return count
+
+
+def truncate_tokens(text: str, limit: int, model: Optional[str] = None) -> str:
+    """Cut a text to its first `limit` tokens."""
+    if not text or count_tokens(text, model) <= limit:
+        return text
+    enc = encoding(model)
+    return enc.decode(enc.encode(text, disallowed_special=())[:limit])
+
+
+def _shingles(text: str) -> set:
+    terms = analyze(text or "")
+    if len(terms) <= SHINGLE_SIZE:
+        return {tuple(terms)} if terms else set()
+    return {tuple(terms[i:i + SHINGLE_SIZE]) for i in range(len(terms) - SHINGLE_SIZE + 1)}
+
+
+def dedupe_chunks(results: List[Dict], overlap: float = DUPLICATE_OVERLAP) -> List[Dict]:
+    """Drop the search results whose content mostly repeats a result ranked above them.
+
+    Args:
+        results: The search results, best first, with their "content".
+        overlap: The share of the word shingles of a content already seen above which it is dropped.
+
+    Returns:
+        The results without the duplicates, in the same order.
+    """
+    seen = set()
+    unique = []
+    for result in results:
+        shingles = _shingles(result.get("content"))
+        if shingles and len(shingles & seen) >= overlap * len(shingles):
+            continue
+        seen |= shingles
+        unique.append(result)
+    return unique
+
+
+def pack_documents(documents: List[str], model: str, limit: Optional[int] = None) -> List[str]:
+    """Keep the documents fitting in the token budget of the model, most relevant first.
+
+    Documents are taken in order, the ones not fitting in what is left of the budget are skipped so a
+    shorter one ranked lower can still fit. The first document is truncated when it alone exceeds
+    the budget, so there is always some context.
+
+    Args:
+        documents: The documents, most relevant first.
+        model: The model the prompt is sent to.
+        limit: The token budget, the one of the model by default.
+
+    Returns:
+        The packed documents, in the same order.
+    """
+    limit = budget(model, "documents") if limit is None else limit
+    packed = []
+    used = 0
+    for document in documents:
+        tokens = count_tokens(document, model)
+        if used + tokens <= limit:
+            packed.append(document)
+            used += tokens
+    if documents and not packed:
+        packed = [truncate_tokens(documents[0], limit, model)]
+    if len(packed) < len(documents):
+        logger.debug("packed %d of %d documents in %d tokens", len(packed), len(documents), limit)
+    return packed
+
+
+def pack_history(messages: List[Message], model: str, limit: Optional[int] = None) -> List[Message]:
+    """Keep the most recent messages fitting in the token budget of the model.
+
+    Args:
+        messages: The conversation, oldest first.
+        model: The model the prompt is sent to.
+        limit: The token budget, the one of the model by default.
+
+    Returns:
+        The most recent messages, oldest first. The last message is always kept.
+    """
+    limit = budget(model, "history") if limit is None else limit
+    packed = []
+    used = 0
+    for message in reversed(messages):
+        tokens = count_tokens(message.text, model) + MESSAGE_TOKENS
+        if packed and used + tokens > limit:
+            break
+        packed.append(message)
+        used += tokens
+    return packed[::-1]
@@ -0,0 +1,183 @@
+from collections import Counter
+from typing import List, Optional, Set, Tuple
+from ell.store import Store
+from ell.stores.sql import SQLStore
+from ell.types import Invocation, InvocationContents, InvocationTrace, SerializedLMP
+from sqlmodel import Session, select
+from agents.tracing import current_span, span
+import threading
+import logging
+import atexit
+import queue
+import json
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+# "async" writes the invocations from a background thread, "sync" on the request path like ell does,
+# "off" drops them, the prompt versions are written in every mode
+ELL_LOGGING = os.getenv("ELL_LOGGING", "async").lower()
+# share of the traces whose invocations are kept, all the LMP calls of a sampled trace are kept
+ELL_SAMPLE_RATE = float(os.getenv("ELL_SAMPLE_RATE", "1.0"))
+# invocations waiting to be written, once full new ones are dropped instead of blocking the request
+ELL_QUEUE_SIZE = int(os.getenv("ELL_QUEUE_SIZE", "1024"))
+# invocations written in a single transaction
+ELL_BATCH_SIZE = int(os.getenv("ELL_BATCH_SIZE", "64"))
+# seconds the writer waits for more invocations before writing a batch
+ELL_FLUSH_INTERVAL = float(os.getenv("ELL_FLUSH_INTERVAL", "1.0"))
+
+LOGGING_MODES = ("async", "sync", "off")
+
+
+def sampled(key: str, rate: float) -> bool:
+    """Whether the trace or invocation `key` is sampled, the same key always gets the same answer."""
+    if rate >= 1.0:
+        return True
+    if rate <= 0.0:
+        return False
+    digits = "".join(c for c in key if c in "0123456789abcdef")[-8:]
+    return int(digits or "0", 16) / 0x100000000 < rate
+
+
+class BackgroundStore(Store):
+    """ell store writing the invocations of the sampled traces from a background thread.
+
+    The prompt versions (`write_lmp`) and every read go to `store` right away, so the versioning
+    metadata is always complete. Invocations are queued and written in batches by a single writer
+    thread, a full queue drops them rather than slowing down the request.
+    """
+
+    def __init__(
+        self,
+        store: Store,
+        mode: str = ELL_LOGGING,
+        sample_rate: float = ELL_SAMPLE_RATE,
+        queue_size: int = ELL_QUEUE_SIZE,
+        batch_size: int = ELL_BATCH_SIZE,
+        flush_interval: float = ELL_FLUSH_INTERVAL,
+    ):
+        if mode not in LOGGING_MODES:
+            raise ValueError(f"Unknown ell logging mode: {mode}")
+        # the blobs of large invocations are written by the writer too, ell must not write them inline
+        super().__init__(None)
+        self.store = store
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats = {"invocations": 0, "sampled_out": 0, "dropped": 0, "written": 0, "batches": 0, "failures": 0}
+
+        self._queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self._closed = False
+        self._writer = None
+        if mode == "async":
+            self._writer = threading.Thread(target=self._write_loop, name="ell-writer", daemon=True)
+            self._writer.start()
+            atexit.register(self.close)
+
+    # prompt versions and reads, never sampled
+
+    def write_lmp(self, serialized_lmp: SerializedLMP, uses):
+        return self.store.write_lmp(serialized_lmp, uses)
+
+    def get_cached_invocations(self, lmp_id: str, state_cache_key: str) -> List[Invocation]:
+        return self.store.get_cached_invocations(lmp_id, state_cache_key)
+
+    def get_versions_by_fqn(self, fqn: str) -> List[SerializedLMP]:
+        return self.store.get_versions_by_fqn(fqn)
+
+    def __getattr__(self, name: str):
+        return getattr(self.store, name)
+
+    # invocations
+
+    def write_invocation(self, invocation: Invocation, consumes: Set[str]):
+        self.stats["invocations"] += 1
+        current = current_span()
+        if self.mode == "off" or not sampled(current.trace_id if current is not None else invocation.id, self.sample_rate):
+            self.stats["sampled_out"] += 1
+            return None
+        if self.mode == "sync":
+            self._write([(invocation, consumes)])
+            return None
+        try:
+            self._queue.put_nowait((invocation, consumes))
+        except queue.Full:
+            self.stats["dropped"] += 1
+        return None
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            # collect the invocations arriving meanwhile, a flush marker ends the batch early
+            while len(batch) < self.batch_size and isinstance(batch[-1], tuple):
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            invocations = [item for item in batch if isinstance(item, tuple)]
+            if invocations:
+                self._write(invocations)
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+            if batch[-1] is None:
+                return
+
+    def _externalize(self, invocation: Invocation):
+        # what ell does on the request path when the store has a blob store
+        contents = invocation.contents
+        if self.store.has_blob_storage and contents.should_externalize:
+            self.store.blob_store.store_blob(json.dumps(contents.model_dump(), default=str).encode("utf-8"), invocation.id)
+            invocation.contents = InvocationContents(invocation_id=invocation.id, is_external=True)
+
+    def _write(self, invocations: List[Tuple[Invocation, Set[str]]]):
+        with span("ell_store.write", invocations=len(invocations)):
+            try:
+                for invocation, _ in invocations:
+                    self._externalize(invocation)
+                if isinstance(self.store, SQLStore):
+                    self._write_sql(invocations)
+                else:
+                    for invocation, consumes in invocations:
+                        self.store.write_invocation(invocation, consumes)
+                self.stats["written"] += len(invocations)
+                self.stats["batches"] += 1
+            except Exception:
+                self.stats["failures"] += len(invocations)
+                logger.exception("could not write %d ell invocations", len(invocations))
+
+    def _write_sql(self, invocations: List[Tuple[Invocation, Set[str]]]):
+        # `SQLStore.write_invocation` for a whole batch, in one transaction
+        counts = Counter(invocation.lmp_id for invocation, _ in invocations)
+        with Session(self.store.engine) as session:
+            for lmp in session.exec(select(SerializedLMP).where(SerializedLMP.lmp_id.in_(list(counts)))):
+                lmp.num_invocations = (lmp.num_invocations or 0) + counts[lmp.lmp_id]
+            for invocation, consumes in invocations:
+                session.add(invocation.contents)
+                session.add(invocation)
+                for consumed_id in consumes:
+                    session.add(InvocationTrace(invocation_consumer_id=invocation.id, invocation_consuming_id=consumed_id))
+            session.commit()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every invocation queued so far is written, False on timeout."""
+        if self._writer is None or self._closed:
+            return True
+        done = threading.Event()
+        # the marker waits for room in the queue, unlike the invocations
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout: Optional[float] = 10.0):
+        """Write the queued invocations and stop the writer."""
+        if self._writer is None or self._closed:
+            return
+        self.flush(timeout)
+        self._closed = True
+        self._queue.put(None)
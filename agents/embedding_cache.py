@@ -0,0 +1,174 @@
+from array import array
+from collections import OrderedDict
+from typing import List, Optional, Dict
+from dotenv import load_dotenv
+import hashlib
+import sqlite3
+import threading
+import time
+import os
+
+load_dotenv()
+
+# resolved against the project root so the app and the notebooks share one store
+CACHE_DIR = os.getenv("CACHE_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache"))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", os.path.join(CACHE_DIR, "embeddings.sqlite3"))
+EMBEDDING_CACHE_MEMORY_ITEMS = 4096
+EMBEDDING_CACHE_DISK_BYTES = 256 * 1024 * 1024
+
+
+def normalize_text(text: str) -> str:
+    """Normalize text so that near-identical inputs share a cache entry."""
+    return " ".join(text.split()).casefold()
+
+
+def cache_key(model: str, text: str) -> str:
+    """Content address of an embedding, the hash of the model and the normalized text."""
+    return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Two tier embedding cache, an in-process LRU backed by a SQLite store on disk.
+
+    Vectors are stored as float32 blobs. The disk store is evicted least recently used first
+    once it grows past `max_disk_bytes`.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = EMBEDDING_CACHE_PATH,
+        max_memory_items: int = EMBEDDING_CACHE_MEMORY_ITEMS,
+        max_disk_bytes: int = EMBEDDING_CACHE_DISK_BYTES,
+    ):
+        self.path = path
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+        self._memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._disk_bytes = 0
+
+    def _connection(self) -> Optional[sqlite3.Connection]:
+        if self.path is None:
+            return None
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                """CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    accessed REAL NOT NULL
+                )"""
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS embeddings_accessed ON embeddings (accessed)")
+            self._disk_bytes = db.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+            self._db = db
+        return self._db
+
+    def _remember(self, key: str, embedding: List[float]):
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        """Get the cached embedding of the text, None on a miss."""
+        return self.get_many(model, [text])[0]
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """Get the cached embeddings of the texts, None for every miss."""
+        keys = [cache_key(model, text) for text in texts]
+        results: List[Optional[List[float]]] = [None] * len(keys)
+
+        with self._lock:
+            missing: Dict[str, List[int]] = {}
+            for position, key in enumerate(keys):
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    results[position] = self._memory[key]
+                    self.stats["memory_hits"] += 1
+                else:
+                    missing.setdefault(key, []).append(position)
+
+            db = self._connection()
+            if missing and db is not None:
+                placeholders = ",".join("?" * len(missing))
+                rows = db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", list(missing)
+                ).fetchall()
+                if rows:
+                    db.execute(
+                        f"UPDATE embeddings SET accessed = ? WHERE key IN ({','.join('?' * len(rows))})",
+                        [time.time()] + [key for key, _ in rows],
+                    )
+                for key, blob in rows:
+                    embedding = array("f", blob).tolist()
+                    self._remember(key, embedding)
+                    for position in missing.pop(key):
+                        results[position] = embedding
+                        self.stats["disk_hits"] += 1
+
+            self.stats["misses"] += sum(len(positions) for positions in missing.values())
+
+        return results
+
+    def put(self, model: str, text: str, embedding: List[float]):
+        """Store the embedding of the text."""
+        self.put_many(model, [text], [embedding])
+
+    def put_many(self, model: str, texts: List[str], embeddings: List[List[float]]):
+        """Store the embeddings of the texts."""
+        now = time.time()
+        rows = []
+        with self._lock:
+            for text, embedding in zip(texts, embeddings):
+                key = cache_key(model, text)
+                self._remember(key, list(embedding))
+                blob = array("f", embedding).tobytes()
+                rows.append((key, model, blob, len(blob), now))
+
+            db = self._connection()
+            if db is None or not rows:
+                return
+            db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, vector, size, accessed) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._disk_bytes += sum(row[3] for row in rows)
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict(db)
+
+    def _evict(self, db: sqlite3.Connection):
+        # drop the least recently used entries until the store is back under 90% of its budget
+        self._disk_bytes = db.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+        target = int(self.max_disk_bytes * 0.9)
+        for key, size in db.execute("SELECT key, size FROM embeddings ORDER BY accessed").fetchall():
+            if self._disk_bytes <= target:
+                break
+            db.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+            self._disk_bytes -= size
+            self.stats["evictions"] += 1
+
+    def clear(self):
+        """Remove every cached embedding."""
+        with self._lock:
+            self._memory.clear()
+            db = self._connection()
+            if db is not None:
+                db.execute("DELETE FROM embeddings")
+            self._disk_bytes = 0
+
+    def hit_rate(self) -> float:
+        """Fraction of lookups served from either tier."""
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
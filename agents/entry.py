@@ -2,7 +2,9 @@ import os
 import ell 
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
-from agents.memory_db import zep_client, SESSION_ID
+from agents.memory_db import SESSION_ID
+from agents.clients import init_ell, async_openai_client
+from agents.tracing import traced, record_usage
 from typing import List
 from ell import Message
 
@@ -10,7 +12,7 @@ load_dotenv()
 
 os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
 
-ell.init(store="./logdir")
+init_ell()
 
 
 class ChatbotEntry(BaseModel):
@@ -45,11 +47,9 @@ class ChatbotEntry(BaseModel):
     
 #     return history 
 
-@ell.complex(model="gpt-4o-2024-08-06", response_format=ChatbotEntry)
-def chatbot_entry(query: str, history: List[Message], facts: str) -> ChatbotEntry:
-    "Entry point to the chatbot agent"
-    return [
-        ell.system("""
+CHATBOT_ENTRY_MODEL = "gpt-4o-2024-08-06"
+
+CHATBOT_ENTRY_PROMPT = """
         You are a helpful assistant who is a professional podcast host. 
         Your task is to provide a conversational, engaging, and context-aware answer to the query provided, while reflecting the tone and sentiment of the user’s input.\n
         Additionally, you will integrate disfluencies, informal language, and overlapping speech from the conversation when necessary, to maintain a natural and coherent podcast-style flow.
@@ -81,5 +81,31 @@ def chatbot_entry(query: str, history: List[Message], facts: str) -> ChatbotEntr
         - The user intent (e.g., Information Request, Toxic),  
         - The output emotion (e.g., Empathy, Neutral, None).  
         </INS>
-        """)
-    ] + history + [ell.user(f"Output answer should contain, the answer to user query, any URL links, timestamps and the speaker name.\n\nQuery: {query} \n\n Summarised History: \n {facts}\n")]
+        """
+
+
+def chatbot_entry_message(query: str, facts: str) -> str:
+    return f"Output answer should contain, the answer to user query, any URL links, timestamps and the speaker name.\n\nQuery: {query} \n\n Summarised History: \n {facts}\n"
+
+
+@traced("chatbot_entry")
+@ell.complex(model=CHATBOT_ENTRY_MODEL, response_format=ChatbotEntry)
+def chatbot_entry(query: str, history: List[Message], facts: str) -> ChatbotEntry:
+    "Entry point to the chatbot agent"
+    return [
+        ell.system(CHATBOT_ENTRY_PROMPT)
+    ] + history + [ell.user(chatbot_entry_message(query=query, facts=facts))]
+
+
+@traced("chatbot_entry")
+async def async_chatbot_entry(query: str, history: List[Message], facts: str) -> ChatbotEntry:
+    "Entry point to the chatbot agent, without blocking the event loop"
+    response = await async_openai_client().beta.chat.completions.parse(
+        model=CHATBOT_ENTRY_MODEL,
+        messages=[{"role": "system", "content": CHATBOT_ENTRY_PROMPT}]
+        + [{"role": message.role, "content": message.text} for message in history]
+        + [{"role": "user", "content": chatbot_entry_message(query=query, facts=facts)}],
+        response_format=ChatbotEntry,
+    )
+    record_usage(response)
+    return response.choices[0].message.parsed
@@ -0,0 +1,295 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional
+from qdrant_client.http import models
+from agents.embedding_cache import CACHE_DIR
+from agents.keywords import build_keyword_index, DATA_DIR
+from agents.rag_db import get_embeddings, VECTOR_SIZE
+from agents.clients import get_client
+from agents.response_cache import bump_collection_generation
+from agents.vector_index import export_collection, index_path, open_index, QUANTIZATION
+from agents.transcripts import Chunk, CHUNKER_VERSION, iter_chunks, batched
+import argparse
+import hashlib
+import logging
+import uuid
+import json
+import glob
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+COLLECTION_NAME = "podcasts"
+EMBED_BATCH_SIZE = 128
+UPSERT_BATCH_SIZE = 256
+UPSERT_WORKERS = 4
+
+# namespace of the chunk ids, an id is derived from the chunk content so re-ingesting is idempotent
+CHUNK_NAMESPACE = uuid.UUID("6f1c2a52-9d1e-4f4e-8a53-3c1f0c4b7e21")
+
+def transcript_paths(data_dir: str) -> List[str]:
+    return sorted(glob.glob(os.path.join(data_dir, "*.txt")))
+
+
+def transcript_digest(path: str) -> str:
+    """Hash of a transcript and of the chunker version, read in blocks."""
+    digest = hashlib.sha256(CHUNKER_VERSION.encode("utf-8"))
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_id(chunk: Chunk) -> str:
+    """Deterministic point id of a chunk, derived from its title, subtopic and content."""
+    digest = hashlib.sha256("\0".join([chunk.title or "", chunk.subtopic, chunk.content]).encode("utf-8")).hexdigest()
+    return str(uuid.uuid5(CHUNK_NAMESPACE, digest))
+
+
+def chunk_payload(chunk: Chunk) -> Dict:
+    return {
+        "subtopic": chunk.subtopic,
+        "speakers": chunk.speakers,
+        "content": chunk.content,
+        "title": chunk.title,
+        "url": chunk.url,
+        "timestamp": chunk.timestamp,
+        "start": chunk.start,
+        "end": chunk.end,
+        # counted by the chunker so the context packer does not tokenize the retrieved chunks again
+        "token_count": chunk.token_count
+    }
+
+
+def quantization_config(quantization: str = QUANTIZATION):
+    if quantization == "int8":
+        return models.ScalarQuantization(scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, always_ram=True))
+    if quantization == "binary":
+        return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=True))
+    return None
+
+
+def create_collections(collection_name: str, vector_size: int = VECTOR_SIZE):
+    "Create new collection in qdrant cloud"
+    get_client("qdrant").create_collection(
+        collection_name=collection_name,
+        vectors_config=models.VectorParams(
+            size=vector_size,
+            distance=models.Distance.COSINE,
+            hnsw_config=models.HnswConfigDiff(
+                m=16,
+                ef_construct=100,
+                full_scan_threshold=10000,
+                max_indexing_threads=0
+            )
+        ),
+        quantization_config=quantization_config()
+    )
+
+    # Create indexes on metadata fields and full text
+    for field_name, field_schema in [
+        ("subtopic", models.PayloadSchemaType.KEYWORD),
+        ("speakers", models.PayloadSchemaType.KEYWORD),
+        ("title", models.PayloadSchemaType.KEYWORD),
+        ("content", models.PayloadSchemaType.TEXT),
+    ]:
+        get_client("qdrant").create_payload_index(collection_name=collection_name, field_name=field_name, field_schema=field_schema)
+
+
+def progress_path(collection_name: str) -> str:
+    return os.path.join(CACHE_DIR, f"ingest_{collection_name}.json")
+
+
+def load_progress(collection_name: str) -> Dict:
+    """Get the progress of the previous runs.
+
+    Returns:
+        The "transcripts" already ingested, file name -> content hash, and "pending_rebuild", whether
+        the collection changed since the response cache was invalidated and the local index built.
+    """
+    try:
+        with open(progress_path(collection_name), "r", encoding="utf-8") as f:
+            progress = json.load(f)
+    except FileNotFoundError:
+        progress = {}
+    if "transcripts" not in progress:
+        # the progress of older runs only lists the transcripts
+        progress = {"transcripts": progress, "pending_rebuild": False}
+    return progress
+
+
+def save_progress(collection_name: str, progress: Dict):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = progress_path(collection_name)
+    # write then rename so an interrupted run never leaves a truncated file
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(progress, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def existing_ids(collection_name: str, ids: List[str]) -> set:
+    found = set()
+    for start in range(0, len(ids), UPSERT_BATCH_SIZE):
+        points = get_client("qdrant").retrieve(collection_name=collection_name, ids=ids[start:start + UPSERT_BATCH_SIZE], with_payload=False, with_vectors=False)
+        found.update(str(point.id) for point in points)
+    return found
+
+
+def ingest_transcript(
+    path: str,
+    collection_name: str = COLLECTION_NAME,
+    embed_batch_size: int = EMBED_BATCH_SIZE,
+    upsert_batch_size: int = UPSERT_BATCH_SIZE,
+    executor: Optional[ThreadPoolExecutor] = None,
+) -> Dict[str, int]:
+    """Embed and upsert the chunks of a transcript that are not in the collection yet.
+
+    The transcript is read and chunked as it is embedded, one batch of chunks at a time. Chunks of a
+    previous version of the transcript that are gone are deleted.
+
+    Returns:
+        Counts of the chunks, the new ones and the deleted ones.
+    """
+    def upsert(points):
+        get_client("qdrant").upsert(collection_name=collection_name, points=points, wait=True)
+
+    ids = []
+    title = None
+    new = 0
+    futures = []
+    for batch in batched(iter_chunks(path), embed_batch_size):
+        batch_ids = [chunk_id(chunk) for chunk in batch]
+        ids.extend(batch_ids)
+        title = title or batch[0].title
+
+        present = existing_ids(collection_name, batch_ids)
+        batch = [(point_id, chunk) for point_id, chunk in zip(batch_ids, batch) if point_id not in present]
+        if not batch:
+            continue
+        new += len(batch)
+        vectors = get_embeddings([chunk.content for _, chunk in batch])
+        points = [
+            models.PointStruct(id=point_id, vector=vector, payload=chunk_payload(chunk))
+            for (point_id, chunk), vector in zip(batch, vectors)
+        ]
+        # upserts run in the background while the next batch is embedded
+        for offset in range(0, len(points), upsert_batch_size):
+            if executor is None:
+                upsert(points[offset:offset + upsert_batch_size])
+            else:
+                futures.append(executor.submit(upsert, points[offset:offset + upsert_batch_size]))
+    for future in futures:
+        future.result()
+
+    # drop the chunks of an older version of this transcript
+    deleted = 0
+    if title:
+        stale = models.Filter(
+            must=[models.FieldCondition(key="title", match=models.MatchValue(value=title))],
+            must_not=[models.HasIdCondition(has_id=ids)],
+        )
+        deleted = get_client("qdrant").count(collection_name=collection_name, count_filter=stale, exact=True).count
+        if deleted:
+            get_client("qdrant").delete(collection_name=collection_name, points_selector=models.FilterSelector(filter=stale), wait=True)
+
+    return {"chunks": len(ids), "new": new, "deleted": deleted}
+
+
+def ingest(
+    data_dir: str = DATA_DIR,
+    collection_name: str = COLLECTION_NAME,
+    embed_batch_size: int = EMBED_BATCH_SIZE,
+    upsert_batch_size: int = UPSERT_BATCH_SIZE,
+    workers: int = UPSERT_WORKERS,
+    restart: bool = False,
+    local_index: bool = True,
+) -> Dict[str, Dict[str, int]]:
+    """Ingest every transcript of the data directory.
+
+    Transcripts are skipped when they were already ingested unchanged, so an interrupted run resumes
+    where it stopped and re-running only loads new or modified transcripts.
+
+    Args:
+        data_dir: The directory containing the transcripts.
+        collection_name: The collection to load the chunks into, created if missing.
+        embed_batch_size: The number of chunks embedded per request.
+        upsert_batch_size: The number of points upserted per request.
+        workers: The number of parallel upsert requests.
+        restart: Whether to ignore the recorded progress.
+        local_index: Whether to rebuild the local vector index of the collection when it changed.
+
+    Returns:
+        The counts of every ingested transcript.
+    """
+    if not get_client("qdrant").collection_exists(collection_name):
+        create_collections(collection_name, VECTOR_SIZE)
+
+    progress = load_progress(collection_name)
+    if restart:
+        # a rebuild still pending from an interrupted run is kept
+        progress["transcripts"] = {}
+    transcripts = progress["transcripts"]
+    report = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for path in transcript_paths(data_dir):
+            name = os.path.basename(path)
+            digest = transcript_digest(path)
+            if transcripts.get(name) == digest:
+                logger.info("%s: already ingested", name)
+                continue
+
+            started = time.perf_counter()
+            counts = ingest_transcript(path, collection_name, embed_batch_size, upsert_batch_size, executor)
+            logger.info("%s: %s in %.1fs", name, counts, time.perf_counter() - started)
+
+            report[name] = counts
+            # recorded with the transcript, a run dying before the rebuild leaves it for the next run
+            if counts["new"] > 0 or counts["deleted"] > 0:
+                progress["pending_rebuild"] = True
+            transcripts[name] = digest
+            save_progress(collection_name, progress)
+
+    build_keyword_index(data_dir)
+    changed = progress["pending_rebuild"]
+    if changed:
+        bump_collection_generation(collection_name)
+    if local_index and (changed or not os.path.exists(index_path(collection_name))):
+        started = time.perf_counter()
+        path = export_collection(get_client("qdrant"), collection_name)
+        logger.info("local index %s built in %.1fs", path, time.perf_counter() - started)
+        if QUANTIZATION != "none":
+            logger.info("local index quantization: %s", open_index(collection_name).quantization_report())
+    # without the local index the rebuild stays pending until a run builds it
+    if changed and local_index:
+        progress["pending_rebuild"] = False
+        save_progress(collection_name, progress)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load the podcast transcripts into the vector database.")
+    parser.add_argument("--data-dir", default=DATA_DIR, help="directory containing the transcripts")
+    parser.add_argument("--collection", default=COLLECTION_NAME, help="name of the collection")
+    parser.add_argument("--embed-batch-size", type=int, default=EMBED_BATCH_SIZE, help="chunks embedded per request")
+    parser.add_argument("--upsert-batch-size", type=int, default=UPSERT_BATCH_SIZE, help="points upserted per request")
+    parser.add_argument("--workers", type=int, default=UPSERT_WORKERS, help="parallel upsert requests")
+    parser.add_argument("--restart", action="store_true", help="ignore the progress of previous runs")
+    parser.add_argument("--no-local-index", action="store_true", help="do not build the local vector index")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    report = ingest(
+        data_dir=args.data_dir,
+        collection_name=args.collection,
+        embed_batch_size=args.embed_batch_size,
+        upsert_batch_size=args.upsert_batch_size,
+        workers=args.workers,
+        restart=args.restart,
+        local_index=not args.no_local_index,
+    )
+    logger.info("ingested %d transcripts", len(report))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+from collections import Counter, deque
+from typing import List, Dict, Iterable, Optional, Tuple
+from agents.embedding_cache import CACHE_DIR
+import threading
+import json
+import math
+import glob
+import re
+import os
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+KEYWORD_INDEX_PATH = os.getenv("KEYWORD_INDEX_PATH", os.path.join(CACHE_DIR, "keywords.json"))
+
+# a term is "high-IDF" when it shows up in at most this fraction of the transcript sections
+MAX_DOCUMENT_FREQUENCY = 0.05
+MIN_TERM_COUNT = 2
+MIN_TERM_LENGTH = 4
+
+TITLE_PATTERN = re.compile(r"^Title: (.+)$", re.MULTILINE)
+SUBTOPIC_PATTERN = re.compile(r"^(.*)\n-+\n", re.MULTILINE)
+SPEAKER_PATTERN = re.compile(r"^(?P<speaker>[^\[\n]+?) \[\(\d{2}:\d{2}:\d{2}\)\]", re.MULTILINE)
+TOKEN_PATTERN = re.compile(r"[a-z][a-z0-9]*(?:['’-][a-z0-9]+)*")
+
+STOPWORDS = frozenset("""
+a about above after again against all also am an and any are aren't as at be because been before being below
+between both but by can can't cannot could couldn't did didn't do does doesn't doing don't down during each
+even ever every few for from further get gets getting go going gonna got had hadn't has hasn't have haven't
+having he he'd he'll he's her here here's hers herself him himself his how how's i i'd i'll i'm i've if in
+into is isn't it it's its itself just kind know let's like lot make many maybe me more most much must mustn't
+my myself need never no nor not now of off okay on once one only or other ought our ours ourselves out over
+own really right said same say says see shan't she she'd she'll she's should shouldn't so some something such
+sure than that that's the their theirs them themselves then there there's these they they'd they'll they're
+they've thing things think this those through to too under until up us very want was wasn't way we we'd
+we'll we're we've well were weren't what what's when when's where where's which while who who's whom why
+why's will with won't would wouldn't yeah yes you you'd you'll you're you've your yours yourself yourselves
+""".split())
+
+
+class AhoCorasick:
+    """Multi-pattern matcher over lowercase text, matches are reported on word boundaries only."""
+
+    def __init__(self, patterns: Iterable[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[List[int]] = [[]]
+        self.patterns: List[str] = []
+
+        for pattern in patterns:
+            self._add(pattern)
+        self._link()
+
+    def _add(self, pattern: str):
+        state = 0
+        for char in pattern:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        self.output[state].append(len(self.patterns))
+        self.patterns.append(pattern)
+
+    def _link(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def find(self, text: str) -> List[Tuple[int, int, str]]:
+        """Find every (start, end, pattern) occurrence in the text."""
+        matches = []
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for index in self.output[state]:
+                pattern = self.patterns[index]
+                start = position - len(pattern) + 1
+                end = position + 1
+                if (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum()):
+                    matches.append((start, end, pattern))
+        return matches
+
+
+class KeywordExtractor:
+    """Deterministic in-process replacement for the LLM entity extraction.
+
+    Matches the query against the speaker names, subtopic headings, titles and high-IDF terms of the corpus
+    and returns the leftmost-longest, non-overlapping matches in their canonical spelling.
+    """
+
+    def __init__(self, terms: Dict[str, str]):
+        # lowercase pattern -> canonical spelling
+        self.terms = terms
+        self.matcher = AhoCorasick(sorted(terms))
+
+    def extract(self, text: str) -> List[str]:
+        """Get the keywords found in the given text."""
+        matches = sorted(self.matcher.find(text.casefold()), key=lambda match: (match[0], -match[1]))
+
+        entities = []
+        covered = 0
+        for start, end, pattern in matches:
+            if start < covered:
+                continue
+            covered = end
+            entity = self.terms[pattern]
+            if entity not in entities:
+                entities.append(entity)
+        return entities
+
+    @classmethod
+    def load(cls, path: str = KEYWORD_INDEX_PATH) -> "KeywordExtractor":
+        with open(path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+        return cls(terms_from_index(index))
+
+
+def _title_terms(title: str) -> List[str]:
+    # "Transcript for Elon Musk: War, AI, Aliens | Lex Fridman Podcast #400 - Lex Fridman"
+    title = title.split("|")[0].removeprefix("Transcript for").strip()
+    parts = re.split(r"[:,&]| vs | and ", title)
+    return [part.strip() for part in parts if part.strip()]
+
+
+def build_keyword_index(data_dir: str = DATA_DIR, path: Optional[str] = KEYWORD_INDEX_PATH) -> Dict[str, List[str]]:
+    """Build the keyword index from the transcripts and store it at `path`.
+
+    Args:
+        data_dir: The directory containing the transcripts.
+        path: Where to store the index, None to skip storing it.
+
+    Returns:
+        The index, lists of speakers, subtopics, titles and high-IDF terms.
+    """
+    speakers, subtopics, titles = set(), set(), set()
+    document_frequency, term_count = Counter(), Counter()
+    sections = 0
+
+    for file_name in sorted(glob.glob(os.path.join(data_dir, "*.txt"))):
+        with open(file_name, "r", encoding="utf-8") as f:
+            transcript = f.read()
+
+        title = TITLE_PATTERN.search(transcript)
+        if title:
+            titles.update(_title_terms(title.group(1)))
+
+        speakers.update(speaker.strip() for speaker in SPEAKER_PATTERN.findall(transcript))
+
+        blocks = SUBTOPIC_PATTERN.split(transcript.split("Markdown Content:", 1)[-1])
+        for i in range(1, len(blocks), 2):
+            subtopics.add(blocks[i].strip())
+            tokens = TOKEN_PATTERN.findall(blocks[i + 1].casefold() if i + 1 < len(blocks) else "")
+            term_count.update(tokens)
+            document_frequency.update(set(tokens))
+            sections += 1
+
+    max_df = max(1, int(sections * MAX_DOCUMENT_FREQUENCY))
+    terms = sorted(
+        (
+            term for term, df in document_frequency.items()
+            if df <= max_df and term_count[term] >= MIN_TERM_COUNT and len(term) >= MIN_TERM_LENGTH and term not in STOPWORDS
+        ),
+        key=lambda term: (-math.log(sections / document_frequency[term]), term),
+    )
+
+    index = {
+        "speakers": sorted(speakers),
+        "subtopics": sorted(subtopic for subtopic in subtopics if subtopic),
+        "titles": sorted(titles),
+        "terms": terms,
+    }
+
+    if path is not None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False, indent=1)
+    return index
+
+
+def terms_from_index(index: Dict[str, List[str]]) -> Dict[str, str]:
+    """Flatten a keyword index into lowercase pattern -> canonical spelling."""
+    terms = {}
+    # earlier kinds win when the same pattern appears twice
+    for kind in ("speakers", "titles", "subtopics", "terms"):
+        for term in index.get(kind, []):
+            terms.setdefault(term.casefold(), term)
+            # speakers are also matched by their individual names, e.g. "Musk"
+            if kind == "speakers":
+                for name in term.split():
+                    if len(name) >= 3 and name.casefold() not in STOPWORDS:
+                        terms.setdefault(name.casefold(), name)
+    return terms
+
+
+_extractor: Optional[KeywordExtractor] = None
+_extractor_lock = threading.Lock()
+
+
+def keyword_extractor() -> KeywordExtractor:
+    """Get the shared extractor, the index is built from the transcripts if it was not built at ingest time."""
+    global _extractor
+    if _extractor is None:
+        with _extractor_lock:
+            if _extractor is None:
+                if os.path.exists(KEYWORD_INDEX_PATH):
+                    _extractor = KeywordExtractor.load(KEYWORD_INDEX_PATH)
+                else:
+                    _extractor = KeywordExtractor(terms_from_index(build_keyword_index()))
+    return _extractor
+
+
+def extract_keywords(text: str) -> List[str]:
+    """Get the keywords of the given text with the shared extractor."""
+    return keyword_extractor().extract(text)
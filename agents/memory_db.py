@@ -1,8 +1,11 @@
-from zep_cloud.client import Zep
+from zep_cloud.client import Zep, AsyncZep
 from zep_cloud import Message
 from dotenv import load_dotenv
-from agents.clients import groq_client
+from agents.clients import get_client, lazy_client, register_client, async_groq_client, async_http_client, loop_client, ZEP_URL, open_connection
+from agents.tracing import traced, record_usage
+from typing import List, Tuple
 import ell
+import groq
 import uuid
 import os
 
@@ -10,13 +13,25 @@ load_dotenv()
 
 SESSION_ID = uuid.uuid4().hex
 
-zep_client = Zep(
-    api_key=os.environ.get('ZEP_API_KEY'),
+register_client(
+    "zep",
+    lambda: Zep(api_key=os.environ.get('ZEP_API_KEY'), httpx_client=get_client("http")),
+    lambda client: open_connection(ZEP_URL),
 )
 
+SUMMARIZE_PROMPT = """
+        You are an expert transcriber. you will summarise a text containing a reply from a podcast host. Your summary must contain  what was spoken, who spoke about it and the timestamp and url in the format [timestamp](url).\n
+        provide only the summary and nothing else.
+        """
+
+
+def async_zep_client() -> AsyncZep:
+    return loop_client("zep", lambda: AsyncZep(api_key=os.environ.get('ZEP_API_KEY'), httpx_client=async_http_client()))
+
 
+@traced("zep.create_user")
 def create_user(user_id: str, email: str, firstname: str, lastname: str):
-    new_user = zep_client.user.add(
+    new_user = get_client("zep").user.add(
         user_id=user_id,
         email=email,
         first_name=firstname,
@@ -25,50 +40,90 @@ def create_user(user_id: str, email: str, firstname: str, lastname: str):
     )
     return new_user
 
+@traced("zep.create_session")
 def create_session(user_id: str, session_id: str):
-    new_session =  zep_client.memory.add_session(
+    new_session =  get_client("zep").memory.add_session(
         user_id=user_id,
         session_id=session_id,
         metadata={},
     )
     return new_session
 
+@traced("zep.delete_session")
 def delete_session(session_id: str):
-    zep_client.memory.delete(session_id)   
+    get_client("zep").memory.delete(session_id)   
 
+@traced("zep.delete_user")
 def delete_user(user_id: str):
-    zep_client.user.delete(user_id)
+    get_client("zep").user.delete(user_id)
 
+def memory_messages(user_content: str, assistent_content: str):
+    return [
+        Message(
+            content=user_content,
+            role="user",
+            role_type="user",
+        ),
+        Message(
+            content=assistent_content,
+            role="assistant",
+            role_type="assistant",
+        )
+    ]
+
+@traced("zep.add_memory")
 def add_memory(session_id, user_content: str, assistent_content: str):
-    memory = zep_client.memory.add(
+    memory = get_client("zep").memory.add(
         session_id=session_id,
-        messages=[
-            Message(
-                content=user_content,
-                role="user",
-                role_type="user",
-            ),
-            Message(
-                content=assistent_content,
-                role="assistant",
-                role_type="assistant",
-            )
-        ],
+        messages=memory_messages(user_content, assistent_content),
         #summary_instruction="Summarize the conversation highlighting the key points and the query discussed provide URLS, timestamps and youtube urls",
     )
     return memory
 
+@traced("zep.add_memory")
+def add_turns(session_id, turns: List[Tuple[str, str]]):
+    """Add several (user, assistant) turns to the memory of a session in a single request."""
+    messages = [message for user_content, assistent_content in turns for message in memory_messages(user_content, assistent_content)]
+    return get_client("zep").memory.add(session_id=session_id, messages=messages)
+
+@traced("zep.get_memory")
 def get_memory(session_id):
-    memory = zep_client.memory.get(session_id)
+    memory = get_client("zep").memory.get(session_id)
     return memory
 
 
-@ell.simple(model="llama-3.1-8b-instant", client=groq_client)
+@traced("summarize_conversation")
+@ell.simple(model="llama-3.1-8b-instant", client=lazy_client("groq", groq.Groq))
 def summarize_conversation(conversation: str) -> str:
     return [
-        ell.system("""
-        You are an expert transcriber. you will summarise a text containing a reply from a podcast host. Your summary must contain  what was spoken, who spoke about it and the timestamp and url in the format [timestamp](url).\n
-        provide only the summary and nothing else.
-        """),
+        ell.system(SUMMARIZE_PROMPT),
         ell.user(conversation)
-    ]
\ No newline at end of file
+    ]
+
+
+# Async variants, for callers running in an event loop.
+
+@traced("zep.create_session")
+async def async_create_session(user_id: str, session_id: str):
+    return await async_zep_client().memory.add_session(user_id=user_id, session_id=session_id, metadata={})
+
+@traced("zep.delete_session")
+async def async_delete_session(session_id: str):
+    await async_zep_client().memory.delete(session_id)
+
+@traced("zep.add_memory")
+async def async_add_memory(session_id, user_content: str, assistent_content: str):
+    return await async_zep_client().memory.add(session_id=session_id, messages=memory_messages(user_content, assistent_content))
+
+@traced("zep.get_memory")
+async def async_get_memory(session_id):
+    return await async_zep_client().memory.get(session_id)
+
+@traced("summarize_conversation")
+async def async_summarize_conversation(conversation: str) -> str:
+    response = await async_groq_client().chat.completions.create(
+        model="llama-3.1-8b-instant",
+        messages=[{"role": "system", "content": SUMMARIZE_PROMPT}, {"role": "user", "content": conversation}],
+    )
+    record_usage(response)
+    return response.choices[0].message.content
@@ -0,0 +1,212 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from typing import List, Dict, Optional, Tuple
+from agents.memory_db import add_turns, get_memory, delete_session, summarize_conversation
+from agents.tracing import attempt
+from ell import Message
+import threading
+import hashlib
+import logging
+import atexit
+import queue
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+# turns of a session written to Zep in a single request
+MEMORY_BATCH_SIZE = int(os.getenv("MEMORY_BATCH_SIZE", "8"))
+# seconds the writer waits for more turns before writing a batch
+MEMORY_FLUSH_INTERVAL = float(os.getenv("MEMORY_FLUSH_INTERVAL", "0.5"))
+MEMORY_RETRIES = 3
+MEMORY_RETRY_BACKOFF = 0.5
+# seconds before the facts of a session are refreshed in the background
+FACTS_TTL = float(os.getenv("FACTS_TTL", "60"))
+SUMMARY_CACHE_SIZE = 4096
+
+NO_FACTS = "No facts available"
+
+
+def _retry(func, *args, retries: int = MEMORY_RETRIES, backoff: float = MEMORY_RETRY_BACKOFF):
+    for number in range(retries):
+        try:
+            # the spans of the call record which attempt they are
+            with attempt(number + 1):
+                return func(*args)
+        except Exception:
+            if number == retries - 1:
+                raise
+            time.sleep(backoff * 2 ** number)
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class MemoryManager:
+    """Write-behind conversation memory.
+
+    Turns are queued and written to Zep by a background thread, batched per session and retried.
+    Answers are summarized in the background, `summarized` swaps a history message for its summary
+    once it is ready. The facts of a session are cached and refreshed in the background when stale,
+    so reading them never waits on Zep except on the first read of a session.
+    """
+
+    def __init__(self, batch_size: int = MEMORY_BATCH_SIZE, flush_interval: float = MEMORY_FLUSH_INTERVAL, facts_ttl: float = FACTS_TTL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.facts_ttl = facts_ttl
+        self.stats = {"turns": 0, "writes": 0, "write_failures": 0, "summaries": 0, "summary_failures": 0, "fact_refreshes": 0}
+
+        self._queue: "queue.Queue" = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="memory")
+        self._lock = threading.Lock()
+        # session id -> (facts, fetched at, stale)
+        self._facts: Dict[str, Tuple[str, float, bool]] = {}
+        self._refreshing = set()
+        self._summaries: "OrderedDict[str, str]" = OrderedDict()
+        self._closed = False
+
+        self._writer = threading.Thread(target=self._write_loop, name="memory-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    # writes
+
+    def record_turn(self, session_id: str, user_content: str, assistent_content: str, summarize: bool = True):
+        """Queue a turn for the memory of the session and summarize the answer, returns immediately."""
+        self.stats["turns"] += 1
+        self._queue.put((session_id, str(user_content), str(assistent_content)))
+        if summarize:
+            self._executor.submit(self._summarize, str(assistent_content))
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            # collect the turns arriving meanwhile, a flush marker ends the batch early
+            while len(batch) < self.batch_size and isinstance(batch[-1], tuple):
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            self._write(batch)
+            if batch[-1] is None:
+                return
+
+    def _write(self, batch: List):
+        turns: Dict[str, List[Tuple[str, str]]] = {}
+        for item in batch:
+            if isinstance(item, tuple):
+                session_id, user_content, assistent_content = item
+                turns.setdefault(session_id, []).append((user_content, assistent_content))
+
+        for session_id, session_turns in turns.items():
+            for start in range(0, len(session_turns), self.batch_size):
+                try:
+                    _retry(add_turns, session_id, session_turns[start:start + self.batch_size])
+                    self.stats["writes"] += 1
+                except Exception:
+                    self.stats["write_failures"] += 1
+                    logger.exception("could not write %d turns to the memory of session %s", len(session_turns[start:start + self.batch_size]), session_id)
+            # the facts extracted by Zep change with the new turns
+            with self._lock:
+                if session_id in self._facts:
+                    facts, fetched, _ = self._facts[session_id]
+                    self._facts[session_id] = (facts, fetched, True)
+
+        for item in batch:
+            if isinstance(item, threading.Event):
+                item.set()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every turn queued so far is written, False on timeout."""
+        if self._closed:
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout: Optional[float] = 10.0):
+        """Write the queued turns and stop the writer."""
+        if self._closed:
+            return
+        self.flush(timeout)
+        self._closed = True
+        self._queue.put(None)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    # summaries
+
+    def _summarize(self, text: str):
+        try:
+            summary = _retry(summarize_conversation, text)
+        except Exception:
+            self.stats["summary_failures"] += 1
+            logger.exception("could not summarize an answer")
+            return
+        self.stats["summaries"] += 1
+        with self._lock:
+            self._summaries[_digest(text)] = summary
+            while len(self._summaries) > SUMMARY_CACHE_SIZE:
+                self._summaries.popitem(last=False)
+
+    def summary(self, text: str) -> Optional[str]:
+        """Get the summary of an answer, None while it is not ready."""
+        with self._lock:
+            return self._summaries.get(_digest(text))
+
+    def summarized(self, message: Message) -> Message:
+        """Get the message with its summary as content if it is an answer that was summarized."""
+        if message.role != "assistant":
+            return message
+        summary = self.summary(message.text)
+        return message if summary is None else Message(role="assistant", content=summary)
+
+    # facts
+
+    def _refresh_facts(self, session_id: str) -> str:
+        try:
+            memory = _retry(get_memory, session_id)
+            facts = ("\n ").join([fact for fact in memory.facts]) if memory.facts else NO_FACTS
+            self.stats["fact_refreshes"] += 1
+        except Exception:
+            facts = None
+        with self._lock:
+            self._refreshing.discard(session_id)
+            if facts is None:
+                # keep serving the previous facts until the next refresh
+                previous = self._facts.get(session_id)
+                facts = previous[0] if previous else NO_FACTS
+            self._facts[session_id] = (facts, time.monotonic(), False)
+        return facts
+
+    def facts(self, session_id: str) -> str:
+        """Get the facts of a session.
+
+        The cached facts are returned right away and refreshed in the background when stale, the first
+        read of a session waits for them.
+        """
+        with self._lock:
+            cached = self._facts.get(session_id)
+            stale = cached is None or cached[2] or time.monotonic() - cached[1] > self.facts_ttl
+            refresh = stale and session_id not in self._refreshing
+            if refresh:
+                self._refreshing.add(session_id)
+        if cached is None:
+            return self._refresh_facts(session_id) if refresh else NO_FACTS
+        if refresh:
+            self._executor.submit(self._refresh_facts, session_id)
+        return cached[0]
+
+    # sessions
+
+    def delete_session(self, session_id: str, timeout: Optional[float] = 10.0):
+        """Write the queued turns, then delete the session and forget its facts."""
+        self.flush(timeout)
+        delete_session(session_id)
+        with self._lock:
+            self._facts.pop(session_id, None)
@@ -1,83 +1,376 @@
-from agents.rag_functions import get_documents, graded_documents, llm_generation, halucinations_score, answer_grade, requery
-from typing import List
+from agents.rag_functions import get_documents, graded_documents, llm_generation, llm_generation_stream, halucinations_score, answer_grade, requery, GRADING_TIMEOUT, RETRIEVAL_LIMIT
+from agents.rag_pipeline import PipelineState, Stage, RAG_DEADLINE
+from agents.rag_functions import async_get_documents, async_graded_documents, async_llm_generation, async_llm_generation_stream, async_halucinations_score, async_answer_grade, async_requery
+from agents.response_cache import lookup_response, store_response, async_lookup_response, async_store_response
+from agents.tracing import span, attempt, propagate
+from agents.single_flight import coalesced
+from agents.embedding_cache import normalize_text
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Iterator, AsyncIterator, Optional
+import asyncio
+import logging
 
-RETRIEVAL_RETRIES = ANSWER_RETRIES = HALLUCINATION_RETRIES = 3
+logger = logging.getLogger(__name__)
 
 
-def rag_response(query: str, intent: str, output_sentiment: str, documents: List[str], history: str = None):
-    """Generate an answer using the llm model.
+def retrieve_stage(state: PipelineState) -> Stage:
+    documents = state.prefetched.pop(state.query, None)
+    if documents is None:
+        documents = get_documents(query=state.query, limit=RETRIEVAL_LIMIT)
+    return state.after_retrieval(documents)
+
+
+def grade_stage(state: PipelineState) -> Stage:
+    remaining = state.remaining()
+    timeout = GRADING_TIMEOUT if remaining is None else min(GRADING_TIMEOUT, remaining)
+    graded_documents_list = graded_documents(query=state.query, documents=state.documents, timeout=timeout)
+    return state.after_grading(graded_documents_list)
+
+
+def generate_stage(state: PipelineState) -> Stage:
+    # the hallucination check grades against the documents that fit in the prompt
+    response, state.graded_documents = llm_generation(query=state.query, intent=state.user_intent, output_sentiment=state.output_emotion, documents=state.graded_documents, history=state.history)
+    return state.after_generation(response)
+
+
+def hallucination_stage(state: PipelineState) -> Stage:
+    score = halucinations_score(documents=state.graded_documents, answer=state.answer)
+    return state.after_hallucination_check(score)
+
+
+def answer_grade_stage(state: PipelineState) -> Stage:
+    grade = answer_grade(answer=state.answer, question=state.original_query)
+    return state.after_answer_grade(grade)
+
+
+def requery_stage(state: PipelineState) -> Stage:
+    new_query = requery(query=state.query)
+    return state.after_requery(new_query)
+
+
+STAGES = {
+    Stage.RETRIEVE: retrieve_stage,
+    Stage.GRADE: grade_stage,
+    Stage.GENERATE: generate_stage,
+    Stage.CHECK_HALLUCINATION: hallucination_stage,
+    Stage.GRADE_ANSWER: answer_grade_stage,
+    Stage.REQUERY: requery_stage,
+}
+
+
+def run_pipeline(state: PipelineState) -> PipelineState:
+    """Run the RAG pipeline until it is done or out of time.
 
     Args:
-        query: The query text.
-        intent: The user intent.
-        output_sentiment: The output sentiment.
-        documents: The list of documents.
+        state: The state of the request.
 
     Returns:
-        The generated answer from llm.
+        The final state, its `result()` is the best answer found.
     """
-    response, document = llm_generation(query=query, intent=intent, output_sentiment=output_sentiment, documents=documents, history=history)
+    while state.stage != Stage.DONE:
+        if state.expired() and not state.degraded:
+            state.stage = state.on_deadline()
+            continue
 
-    score = halucinations_score(documents=document, answer=response)
+        state.trace.append(state.stage.value)
+        try:
+            # the stage and the calls it makes are traced with the requery attempt they belong to
+            with attempt(state.attempt()), span(f"pipeline.{state.stage.value}", query=state.query):
+                next_stage = STAGES[state.stage](state)
+        except Exception:
+            # a failing stage costs the request only if no answer was produced yet
+            if state.best_answer is None:
+                raise
+            next_stage = Stage.DONE
 
-    if str(score).lower() == "no" and HALLUCINATION_RETRIES > 0:
-        new_query = requery(query=query)
-        return rag_response(query=new_query, intent=intent, output_sentiment=output_sentiment, documents=documents, history=history)
-    return response
+        # once degraded, the answer is returned without grading
+        state.stage = Stage.DONE if state.degraded else next_stage
+    return state
+
+
+def prefetched_documents(query: str, documents: Optional[List[str]]) -> dict:
+    return {} if documents is None else {query: documents}
 
 
-def rag_agent(query: str, user_intent: str, output_emotion: str, history: str = None):
+def rag_agent(query: str, user_intent: str, output_emotion: str, history: str = None, timeout: Optional[float] = RAG_DEADLINE, documents: Optional[List[str]] = None):
     """RAG model for response generation.
 
     Args:
         query: The query text.
         user_intent: The user intent.
         output_emotion: The output sentiment.
+        timeout: Seconds before the best answer so far is returned, None to wait for all retries.
+        documents: Documents already retrieved for the query, used instead of the first retrieval.
 
     Returns:
         The generated response from the RAG model.
     """
-    documents = get_documents(query=query, limit=10)
+    state = PipelineState.start(query=query, user_intent=user_intent, output_emotion=output_emotion, history=history, timeout=timeout, prefetched=prefetched_documents(query, documents))
+    return run_pipeline(state).result()
 
-    graded_documents_list = graded_documents(query=query, documents=documents)
 
-    # check if the documents are not relevant AND the retries are not exhausted
-    if len(graded_documents_list) == 0 and RETRIEVAL_RETRIES > 0:
-        requery = requery(query=query)
-        return rag_agent(query=requery, user_intent=user_intent, output_emotion=output_emotion, history=history)
+def rag_response_key(query: str, user_intent: str, output_emotion: str, history: str = None, use_cache: bool = True, timeout: Optional[float] = RAG_DEADLINE, documents: Optional[List[str]] = None):
+    return normalize_text(query), user_intent, output_emotion, history, use_cache, timeout, None if documents is None else tuple(documents)
 
-    response = rag_response(query=query, intent=user_intent, output_sentiment=output_emotion, documents=graded_documents_list, history=history)
-    grade = answer_grade(answer=response, question=query)
-    
-    # check if the answer is not relevant AND the retries are not exhausted
-    if str(grade).lower() == "no" and ANSWER_RETRIES > 0:
-        new_query = requery(query=query)
-        return rag_agent(query=new_query, user_intent=user_intent, output_emotion=output_emotion, history=history)
 
-    return response
-
-def execute_rag_response(query: str, user_intent: str, output_emotion: str, history: str = None):
+@coalesced("execute_rag_response", rag_response_key)
+def execute_rag_response(query: str, user_intent: str, output_emotion: str, history: str = None, use_cache: bool = True, timeout: Optional[float] = RAG_DEADLINE, documents: Optional[List[str]] = None):
     """Execute the RAG response.
 
     Args:
         query: The query text.
         user_intent: The user intent.
         output_emotion: The output sentiment.
+        use_cache: Whether to reuse the response of a previously answered similar query.
+        timeout: Seconds before the best answer so far is returned, None to wait for all retries.
+        documents: Documents already retrieved for the query, used instead of the first retrieval.
     
     Returns:
         The response from the RAG model.
     """
-    global RETRIEVAL_RETRIES, ANSWER_RETRIES, HALLUCINATION_RETRIES
+    with span("rag_response", query=query) as current:
+        if use_cache:
+            cached = lookup_response(query)
+            if cached is not None:
+                current.set(cached=True)
+                return cached["response"]
+
+        try:
+            state = run_pipeline(PipelineState.start(query=query, user_intent=user_intent, output_emotion=output_emotion, history=history, timeout=timeout, prefetched=prefetched_documents(query, documents)))
+            response = state.result()
+            # the deadline fallback and ungraded answers are not served to other queries
+            if use_cache and state.accepted():
+                store_response(query, response, history=history)
+        except Exception as e:
+            # the user only sees the message, the traceback and the failed span are kept
+            current.fail(e)
+            logger.exception("RAG response failed for query %r", query)
+            response = f"An error occurred: {e}"
+
+    return response
+
+
+class StreamedAnswer:
+    """Tokens of a RAG answer, streamed before the answer is graded.
+
+    Iterate over it to receive the tokens, then call `is_valid` to run the graders on the full answer.
+    `graded` tells whether the graders actually ran, an answer kept because they were unavailable is
+    shown but must not be cached.
+    """
+
+    def __init__(self, query: str, documents: List[str], tokens: Iterator[str]):
+        self.query = query
+        self.documents = documents
+        self._tokens = tokens
+        self._parts = []
+        self.failed = False
+        self.graded = False
+
+    def __iter__(self) -> Iterator[str]:
+        try:
+            for token in self._tokens:
+                self._parts.append(token)
+                yield token
+        except Exception:
+            # an interrupted stream is rejected by `is_valid`
+            self.failed = True
 
-    # init retries
-    RETRIEVAL_RETRIES = ANSWER_RETRIES = HALLUCINATION_RETRIES = 3
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
 
+    def is_valid(self) -> bool:
+        """Check the streamed answer for hallucinations and relevance, both graders run concurrently."""
+        if self.failed or not self.text:
+            return False
+        try:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                grounded = executor.submit(propagate(halucinations_score), documents=self.documents, answer=self.text)
+                relevant = executor.submit(propagate(answer_grade), answer=self.text, question=self.query)
+                grounded, relevant = grounded.result(), relevant.result()
+        except Exception:
+            # keep the streamed answer when the graders are unavailable, it stays ungraded
+            return True
+        self.graded = True
+        return str(grounded).lower() != "no" and str(relevant).lower() != "no"
+
+
+def stream_rag_response(query: str, user_intent: str, output_emotion: str, history: str = None, documents: Optional[List[str]] = None) -> Optional[StreamedAnswer]:
+    """Stream the RAG response, the graders run once the stream is consumed.
+
+    Args:
+        query: The query text.
+        user_intent: The user intent.
+        output_emotion: The output sentiment.
+        documents: Documents already retrieved for the query, used instead of retrieving them.
+
+    Returns:
+        The streamed answer, None when no relevant document was retrieved and `execute_rag_response`
+        should be used instead to requery.
+    """
     try:
-        response = rag_agent(query=query, user_intent=user_intent, output_emotion=output_emotion, history=history)
-    except Exception as e:
-        response = f"An error occurred: {e}"
-    finally:
-        # reset retries
-        RETRIEVAL_RETRIES = ANSWER_RETRIES = HALLUCINATION_RETRIES = 3
-    
+        if documents is None:
+            documents = get_documents(query=query, limit=RETRIEVAL_LIMIT)
+        graded_documents_list = graded_documents(query=query, documents=documents)
+    except Exception:
+        return None
+    if len(graded_documents_list) == 0:
+        return None
+
+    # the hallucination check grades against the documents that fit in the prompt
+    tokens, graded_documents_list = llm_generation_stream(query=query, intent=user_intent, output_sentiment=output_emotion, documents=graded_documents_list, history=history)
+    return StreamedAnswer(query=query, documents=graded_documents_list, tokens=tokens)
+
+
+# Async pipeline, the same stages and state transitions awaiting the async provider clients.
+
+async def async_retrieve_stage(state: PipelineState) -> Stage:
+    documents = state.prefetched.pop(state.query, None)
+    if documents is None:
+        documents = await async_get_documents(query=state.query, limit=RETRIEVAL_LIMIT)
+    return state.after_retrieval(documents)
+
+
+async def async_grade_stage(state: PipelineState) -> Stage:
+    remaining = state.remaining()
+    timeout = GRADING_TIMEOUT if remaining is None else min(GRADING_TIMEOUT, remaining)
+    graded_documents_list = await async_graded_documents(query=state.query, documents=state.documents, timeout=timeout)
+    return state.after_grading(graded_documents_list)
+
+
+async def async_generate_stage(state: PipelineState) -> Stage:
+    # the hallucination check grades against the documents that fit in the prompt
+    response, state.graded_documents = await async_llm_generation(query=state.query, intent=state.user_intent, output_sentiment=state.output_emotion, documents=state.graded_documents, history=state.history)
+    return state.after_generation(response)
+
+
+async def async_hallucination_stage(state: PipelineState) -> Stage:
+    score = await async_halucinations_score(documents=state.graded_documents, answer=state.answer)
+    return state.after_hallucination_check(score)
+
+
+async def async_answer_grade_stage(state: PipelineState) -> Stage:
+    grade = await async_answer_grade(answer=state.answer, question=state.original_query)
+    return state.after_answer_grade(grade)
+
+
+async def async_requery_stage(state: PipelineState) -> Stage:
+    new_query = await async_requery(query=state.query)
+    return state.after_requery(new_query)
+
+
+ASYNC_STAGES = {
+    Stage.RETRIEVE: async_retrieve_stage,
+    Stage.GRADE: async_grade_stage,
+    Stage.GENERATE: async_generate_stage,
+    Stage.CHECK_HALLUCINATION: async_hallucination_stage,
+    Stage.GRADE_ANSWER: async_answer_grade_stage,
+    Stage.REQUERY: async_requery_stage,
+}
+
+
+async def async_run_pipeline(state: PipelineState) -> PipelineState:
+    """Async `run_pipeline`, a stage still running at the deadline is cancelled instead of awaited."""
+    while state.stage != Stage.DONE:
+        if state.expired() and not state.degraded:
+            state.stage = state.on_deadline()
+            continue
+
+        state.trace.append(state.stage.value)
+        try:
+            # the answer generated once degraded is awaited without a time limit, like in `run_pipeline`
+            with attempt(state.attempt()), span(f"pipeline.{state.stage.value}", query=state.query):
+                next_stage = await asyncio.wait_for(ASYNC_STAGES[state.stage](state), None if state.degraded else state.remaining())
+        except asyncio.TimeoutError:
+            state.stage = state.on_deadline()
+            continue
+        except Exception:
+            if state.best_answer is None:
+                raise
+            next_stage = Stage.DONE
+
+        state.stage = Stage.DONE if state.degraded else next_stage
+    return state
+
+
+async def async_rag_agent(query: str, user_intent: str, output_emotion: str, history: str = None, timeout: Optional[float] = RAG_DEADLINE, documents: Optional[List[str]] = None):
+    """Async `rag_agent`."""
+    state = PipelineState.start(query=query, user_intent=user_intent, output_emotion=output_emotion, history=history, timeout=timeout, prefetched=prefetched_documents(query, documents))
+    return (await async_run_pipeline(state)).result()
+
+
+@coalesced("execute_rag_response", rag_response_key)
+async def async_execute_rag_response(query: str, user_intent: str, output_emotion: str, history: str = None, use_cache: bool = True, timeout: Optional[float] = RAG_DEADLINE, documents: Optional[List[str]] = None):
+    """Async `execute_rag_response`."""
+    with span("rag_response", query=query) as current:
+        if use_cache:
+            cached = await async_lookup_response(query)
+            if cached is not None:
+                current.set(cached=True)
+                return cached["response"]
+
+        try:
+            state = await async_run_pipeline(PipelineState.start(query=query, user_intent=user_intent, output_emotion=output_emotion, history=history, timeout=timeout, prefetched=prefetched_documents(query, documents)))
+            response = state.result()
+            if use_cache and state.accepted():
+                await async_store_response(query, response, history=history)
+        except Exception as e:
+            current.fail(e)
+            logger.exception("RAG response failed for query %r", query)
+            response = f"An error occurred: {e}"
+
     return response
+
+
+class AsyncStreamedAnswer:
+    """Async `StreamedAnswer`, iterate over it with `async for` then await `is_valid`."""
+
+    def __init__(self, query: str, documents: List[str], tokens: AsyncIterator[str]):
+        self.query = query
+        self.documents = documents
+        self._tokens = tokens
+        self._parts = []
+        self.failed = False
+        self.graded = False
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        try:
+            async for token in self._tokens:
+                self._parts.append(token)
+                yield token
+        except Exception:
+            self.failed = True
+
+    async def is_valid(self) -> bool:
+        """Check the streamed answer for hallucinations and relevance, both graders run concurrently."""
+        if self.failed or not self.text:
+            return False
+        try:
+            grounded, relevant = await asyncio.gather(
+                async_halucinations_score(documents=self.documents, answer=self.text),
+                async_answer_grade(answer=self.text, question=self.query),
+            )
+        except Exception:
+            return True
+        self.graded = True
+        return str(grounded).lower() != "no" and str(relevant).lower() != "no"
+
+
+async def async_stream_rag_response(query: str, user_intent: str, output_emotion: str, history: str = None, documents: Optional[List[str]] = None) -> Optional[AsyncStreamedAnswer]:
+    """Async `stream_rag_response`."""
+    try:
+        if documents is None:
+            documents = await async_get_documents(query=query, limit=RETRIEVAL_LIMIT)
+        graded_documents_list = await async_graded_documents(query=query, documents=documents)
+    except Exception:
+        return None
+    if len(graded_documents_list) == 0:
+        return None
+
+    # the hallucination check grades against the documents that fit in the prompt
+    tokens, graded_documents_list = async_llm_generation_stream(query=query, intent=user_intent, output_sentiment=output_emotion, documents=graded_documents_list, history=history)
+    return AsyncStreamedAnswer(query=query, documents=graded_documents_list, tokens=tokens)
@@ -1,13 +1,15 @@
 import os
 import ell 
+import groq
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
-from agents.clients import groq_client
-from typing import List
+from agents.clients import get_client, lazy_client, init_ell, async_groq_client, async_openai_client
+from agents.tracing import traced, record_usage
+from typing import List, Iterator, AsyncIterator
 
 load_dotenv()
 
-ell.init(store="./logdir")
+init_ell()
 
 os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
 
@@ -22,6 +24,23 @@ class GradeDocuments(BaseModel):
         description="Documents are relevant to the question, 'yes' or 'no'"
     )
 
+class DocumentGrade(BaseModel):
+    """Binary score for relevance check on a single document of a batch."""
+
+    index: int = Field(
+        description="Index of the document in the provided list of documents"
+    )
+    binary_score: str = Field(
+        description="Document is relevant to the question, 'yes' or 'no'"
+    )
+
+class GradeDocumentsBatch(BaseModel):
+    """Binary scores for relevance check on a batch of retrieved documents."""
+
+    grades: List[DocumentGrade] = Field(
+        description="One grade for every document in the provided list"
+    )
+
 class GradeHallucinations(BaseModel):
     """Binary score for hallucination present in generation answer."""
 
@@ -38,65 +57,109 @@ class GradeAnswer(BaseModel):
     
 
 
+# This module contains the prompts of the agents, shared by the sync and async agents.
+
+GRADE_DOCUMENT_PROMPT = """You are a grader assessing relevance of a retrieved document to a user question. \n 
+                It does not need to be a stringent test. The goal is to filter out erroneous retrievals. \n
+                If the document contains keyword(s) or semantic meaning related to the user question, grade it as relevant. \n
+                Give a binary score 'yes' or 'no' score to indicate whether the document is relevant to the question.
+                """
+
+GRADE_DOCUMENTS_BATCH_PROMPT = """You are a grader assessing relevance of a list of retrieved documents to a user question. \n 
+                It does not need to be a stringent test. The goal is to filter out erroneous retrievals. \n
+                Each document is enclosed in <DOCUMENT> tags carrying its index. Grade every document independently. \n
+                If a document contains keyword(s) or semantic meaning related to the user question, grade it as relevant. \n
+                Return exactly one grade per document with its index and a binary score 'yes' or 'no' to indicate whether the document is relevant to the question.
+                """
+
+CHECK_HALLUCINATIONS_PROMPT = """
+            You are a grader assessing whether an LLM generation is grounded in / supported by a set of retrieved facts. \n 
+            Give a binary score 'yes' or 'no'. 'yes' means that the answer is grounded in / supported by the set of facts else 'no'.
+            The response can be 'yes' or 'no' and nothing else.
+                """
+
+GRADE_ANSWER_PROMPT = """
+            You are a grader assessing whether an answer addresses / resolves a question \n 
+            You do not need to be overly strict. The goal is to filter out if irrelevant answers created. \n
+            as long as the answer is relevant to the question, grade it as relevant. \n
+            Give a binary score 'yes' or 'no'. 'yes' means that the answer resolves the question else 'no'.
+                """
+
+REQUERY_PROMPT = """
+        You are given a user query. You must requery it and provide with a new query so that relevant documents can be retrieved.
+        Your output should strictly contain only the new query.
+        """
+
+
+def grade_document_message(query: str, document: str) -> str:
+    return f"Query: {query} \n\n Document: {document}"
+
+
+def grade_documents_batch_message(query: str, documents: List[str]) -> str:
+    formatted_documents = "\n\n".join(
+        f"<DOCUMENT index={index}>\n{document}\n</DOCUMENT>" for index, document in enumerate(documents)
+    )
+    return f"Query: {query} \n\n Documents: \n\n {formatted_documents}"
+
+
+def check_halucinations_message(document: List[str], answer: str) -> str:
+    formatted_document = "\n".join(document)
+    return f"Set of facts: \n\n {formatted_document} \n\n LLM generation: {answer}"
+
+
+def grade_answer_message(answer: str, question: str) -> str:
+    return f"Question: {question} \n\n Answer: {answer}"
+
+
+def requery_message(query: str) -> str:
+    return f"previose query: {query}"
+
+
 # This module contains the agents for the RAG model.
 
+@traced("grade_document")
 @ell.complex(model="gpt-4o-mini", response_format=GradeDocuments)
 def grade_document(query: str, document: str) -> GradeDocuments:
     "Document grading agent, grades document as yes or no"
     return [
-        ell.system("""You are a grader assessing relevance of a retrieved document to a user question. \n 
-                It does not need to be a stringent test. The goal is to filter out erroneous retrievals. \n
-                If the document contains keyword(s) or semantic meaning related to the user question, grade it as relevant. \n
-                Give a binary score 'yes' or 'no' score to indicate whether the document is relevant to the question.
-                """),
-        ell.user(f"Query: {query} \n\n Document: {document}"),
+        ell.system(GRADE_DOCUMENT_PROMPT),
+        ell.user(grade_document_message(query=query, document=document)),
+    ]
+
+
+@traced("grade_documents_batch")
+@ell.complex(model="gpt-4o-mini", response_format=GradeDocumentsBatch)
+def grade_documents_batch(query: str, documents: List[str]) -> GradeDocumentsBatch:
+    "Batched document grading agent, grades every document as yes or no in a single call"
+    return [
+        ell.system(GRADE_DOCUMENTS_BATCH_PROMPT),
+        ell.user(grade_documents_batch_message(query=query, documents=documents)),
     ]
 
 
+@traced("check_halucinations")
 @ell.complex(model="gpt-4o-mini", response_format=GradeHallucinations)
 def check_halucinations(document: List[str], answer: str) -> GradeHallucinations:
     "hallucination grading agent, grades answer as yes or no"
-    formatted_document = "\n".join(document)
     return [
-        ell.system("""
-            You are a grader assessing whether an LLM generation is grounded in / supported by a set of retrieved facts. \n 
-            Give a binary score 'yes' or 'no'. 'yes' means that the answer is grounded in / supported by the set of facts else 'no'.
-            The response can be 'yes' or 'no' and nothing else.
-                """),
-        ell.user(f"Set of facts: \n\n {formatted_document} \n\n LLM generation: {answer}"),
+        ell.system(CHECK_HALLUCINATIONS_PROMPT),
+        ell.user(check_halucinations_message(document=document, answer=answer)),
     ]
 
 
+@traced("grade_answer")
 @ell.complex(model="gpt-4o-mini", response_format=GradeAnswer)
 def grade_answer(answer: str, question: str) -> GradeAnswer:
     "Answer grading agent, grades answer as yes or no"
     return [
-        ell.system("""
-            You are a grader assessing whether an answer addresses / resolves a question \n 
-            You do not need to be overly strict. The goal is to filter out if irrelevant answers created. \n
-            as long as the answer is relevant to the question, grade it as relevant. \n
-            Give a binary score 'yes' or 'no'. 'yes' means that the answer resolves the question else 'no'.
-                """),
-        ell.user(f"Question: {question} \n\n Answer: {answer}"),
+        ell.system(GRADE_ANSWER_PROMPT),
+        ell.user(grade_answer_message(answer=answer, question=question)),
     ]
 
 
-@ell.simple(model="gpt-4o-2024-08-06")
-def llm_answer(query: str, user_intent: str, output_emotion: str, documents: List[str], history: str) -> str:
-    """Generate an answer using the LLM model.
-
-    Args:
-        query: The query text.
-        user_intent: The user intent.
-        output_emotion: The output sentiment.
-        documents: The list of documents.
+LLM_ANSWER_MODEL = "gpt-4o-2024-08-06"
 
-    Returns:
-        The generated answer from llm.
-    """
-    formatted_documents = "\n".join(documents)
-    return [
-        ell.system("""
+LLM_ANSWER_PROMPT = """
         You are a state-of-the-art Q&A chatbot designed to respond in the persona of a podcast host. 
         Your task is to provide a conversational, engaging, and context-aware answer to the query provided, while reflecting the tone and sentiment of the user’s input.\n
         Additionally, you will integrate disfluencies, informal language, and overlapping speech from the conversation when necessary, to maintain a natural and coherent podcast-style flow.
@@ -126,12 +189,67 @@ def llm_answer(query: str, user_intent: str, output_emotion: str, documents: Lis
         - Handle conversational disfluencies and informal speech as part of your persona.
         - Always provide correct source attribution with YouTube links and timestamps.
         </INS>
-        """),
-        ell.user(f"Documents:\n {formatted_documents} \n\nConversation history: {history} \n\nQuery: {query} \n User Intent: {user_intent} \n answer with output emotion: {output_emotion}"),
+        """
+
+
+def llm_answer_message(query: str, user_intent: str, output_emotion: str, documents: List[str], history: str) -> str:
+    formatted_documents = "\n".join(documents)
+    return f"Documents:\n {formatted_documents} \n\nConversation history: {history} \n\nQuery: {query} \n User Intent: {user_intent} \n answer with output emotion: {output_emotion}"
+
+
+@traced("llm_answer")
+@ell.simple(model=LLM_ANSWER_MODEL)
+def llm_answer(query: str, user_intent: str, output_emotion: str, documents: List[str], history: str) -> str:
+    """Generate an answer using the LLM model.
+
+    Args:
+        query: The query text.
+        user_intent: The user intent.
+        output_emotion: The output sentiment.
+        documents: The list of documents.
+
+    Returns:
+        The generated answer from llm.
+    """
+    return [
+        ell.system(LLM_ANSWER_PROMPT),
+        ell.user(llm_answer_message(query=query, user_intent=user_intent, output_emotion=output_emotion, documents=documents, history=history)),
     ]
 
 
-@ell.simple(model="llama3-70b-8192", client=groq_client)
+@traced("llm_answer", stream=True)
+def stream_llm_answer(query: str, user_intent: str, output_emotion: str, documents: List[str], history: str) -> Iterator[str]:
+    """Generate an answer using the LLM model, yielding the tokens as they arrive.
+
+    Uses the same prompt as `llm_answer`.
+
+    Args:
+        query: The query text.
+        user_intent: The user intent.
+        output_emotion: The output sentiment.
+        documents: The list of documents.
+
+    Returns:
+        An iterator over the generated tokens.
+    """
+    stream = get_client("openai").chat.completions.create(
+        model=LLM_ANSWER_MODEL,
+        messages=[
+            {"role": "system", "content": LLM_ANSWER_PROMPT},
+            {"role": "user", "content": llm_answer_message(query=query, user_intent=user_intent, output_emotion=output_emotion, documents=documents, history=history)},
+        ],
+        stream=True,
+        # the last chunk then carries the token usage
+        stream_options={"include_usage": True},
+    )
+    for chunk in stream:
+        record_usage(chunk)
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+@traced("requery")
+@ell.simple(model="llama3-70b-8192", client=lazy_client("groq", groq.Groq))
 def requery(query: str) -> str:
     """Requery the chatbot with the new query.
 
@@ -143,9 +261,84 @@ def requery(query: str) -> str:
         The response from the chatbot.
     """
     return [
-        ell.system("""
-        You are given a user query. You must requery it and provide with a new query so that relevant documents can be retrieved.
-        Your output should strictly contain only the new query.
-        """),
-        ell.user(f"previose query: {query}"),
-    ]
\ No newline at end of file
+        ell.system(REQUERY_PROMPT),
+        ell.user(requery_message(query)),
+    ]
+
+# Async agents, the same prompts and output formats called through the async provider clients.
+
+async def async_parse(model: str, system: str, user: str, response_format):
+    response = await async_openai_client().beta.chat.completions.parse(
+        model=model,
+        messages=[{"role": "system", "content": system}, {"role": "user", "content": user}],
+        response_format=response_format,
+    )
+    record_usage(response)
+    return response.choices[0].message.parsed
+
+
+@traced("grade_document")
+async def async_grade_document(query: str, document: str) -> GradeDocuments:
+    "Document grading agent, grades document as yes or no"
+    return await async_parse("gpt-4o-mini", GRADE_DOCUMENT_PROMPT, grade_document_message(query=query, document=document), GradeDocuments)
+
+
+@traced("grade_documents_batch")
+async def async_grade_documents_batch(query: str, documents: List[str]) -> GradeDocumentsBatch:
+    "Batched document grading agent, grades every document as yes or no in a single call"
+    return await async_parse("gpt-4o-mini", GRADE_DOCUMENTS_BATCH_PROMPT, grade_documents_batch_message(query=query, documents=documents), GradeDocumentsBatch)
+
+
+@traced("check_halucinations")
+async def async_check_halucinations(document: List[str], answer: str) -> GradeHallucinations:
+    "hallucination grading agent, grades answer as yes or no"
+    return await async_parse("gpt-4o-mini", CHECK_HALLUCINATIONS_PROMPT, check_halucinations_message(document=document, answer=answer), GradeHallucinations)
+
+
+@traced("grade_answer")
+async def async_grade_answer(answer: str, question: str) -> GradeAnswer:
+    "Answer grading agent, grades answer as yes or no"
+    return await async_parse("gpt-4o-mini", GRADE_ANSWER_PROMPT, grade_answer_message(answer=answer, question=question), GradeAnswer)
+
+
+@traced("llm_answer")
+async def async_llm_answer(query: str, user_intent: str, output_emotion: str, documents: List[str], history: str) -> str:
+    """Generate an answer using the LLM model, like `llm_answer`."""
+    response = await async_openai_client().chat.completions.create(
+        model=LLM_ANSWER_MODEL,
+        messages=[
+            {"role": "system", "content": LLM_ANSWER_PROMPT},
+            {"role": "user", "content": llm_answer_message(query=query, user_intent=user_intent, output_emotion=output_emotion, documents=documents, history=history)},
+        ],
+    )
+    record_usage(response)
+    return response.choices[0].message.content
+
+
+@traced("llm_answer", stream=True)
+async def async_stream_llm_answer(query: str, user_intent: str, output_emotion: str, documents: List[str], history: str) -> AsyncIterator[str]:
+    """Generate an answer using the LLM model, yielding the tokens as they arrive, like `stream_llm_answer`."""
+    stream = await async_openai_client().chat.completions.create(
+        model=LLM_ANSWER_MODEL,
+        messages=[
+            {"role": "system", "content": LLM_ANSWER_PROMPT},
+            {"role": "user", "content": llm_answer_message(query=query, user_intent=user_intent, output_emotion=output_emotion, documents=documents, history=history)},
+        ],
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    async for chunk in stream:
+        record_usage(chunk)
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+@traced("requery")
+async def async_requery(query: str) -> str:
+    """Requery the chatbot with the new query, like `requery`."""
+    response = await async_groq_client().chat.completions.create(
+        model="llama3-70b-8192",
+        messages=[{"role": "system", "content": REQUERY_PROMPT}, {"role": "user", "content": requery_message(query)}],
+    )
+    record_usage(response)
+    return response.choices[0].message.content
@@ -1,16 +1,40 @@
-from qdrant_client import QdrantClient
+from qdrant_client import QdrantClient, AsyncQdrantClient
 from qdrant_client.http import models
-import openai
-import groq
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from agents.embedding_cache import EmbeddingCache
+from agents.clients import get_client, register_client, loop_client, async_openai_client, pool_limits, HTTP2
+from agents.keywords import extract_keywords
+from agents.vector_index import open_index, has_lexical_index, QUANTIZATION, RESCORE_OVERSAMPLING
+from agents.bm25 import reciprocal_rank_fusion
+from agents.context import dedupe_chunks, count_tokens, seed_token_count
+from agents.tracing import traced, record_usage, propagate
+import asyncio
+import logging
+import time
 import os
 
 load_dotenv()
 
-openai_client = openai.Client()
-openai.api_key = os.getenv("OPENAI_API_KEY")
+logger = logging.getLogger(__name__)
+
 VECTOR_SIZE = 1536
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_BATCH_SIZE = 256
+# "local" matches the query against the keyword index built from the corpus, "llm" asks GROQ
+ENTITY_EXTRACTOR = os.getenv("ENTITY_EXTRACTOR", "local")
+# ask GROQ when the local extractor finds no keyword
+ENTITY_LLM_FALLBACK = os.getenv("ENTITY_LLM_FALLBACK", "false").lower() == "true"
+# "qdrant" searches the Qdrant Cloud collection, "local" the memory-mapped index built at ingest time
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "qdrant")
+# "true" fuses the BM25 results of the local index, built at ingest time, into the vector ranking of
+# any backend, "local" only when searching the local backend, "false" keeps the entity filtered search
+LEXICAL_FUSION = os.getenv("LEXICAL_FUSION", "true").lower()
+# reciprocal rank fusion of the vector and BM25 rankings
+RRF_K = int(os.getenv("RRF_K", "60"))
+VECTOR_WEIGHT = float(os.getenv("VECTOR_WEIGHT", "1.0"))
+LEXICAL_WEIGHT = float(os.getenv("LEXICAL_WEIGHT", "1.0"))
 
 KEYWORD_PROMPT="""
 Your task is to analyse the query and identify the entities in the query.
@@ -21,31 +45,243 @@ only provide the keywords found and nothing else.
 """
 
 
-client = QdrantClient(
-    url="https://3973cdf9-4ba6-40b1-ae92-b2f952f82fb9.europe-west3-0.gcp.cloud.qdrant.io:6333", 
-    api_key=os.getenv("QDRANT_CLOUD_API_KEY"),
+QDRANT_URL = "https://3973cdf9-4ba6-40b1-ae92-b2f952f82fb9.europe-west3-0.gcp.cloud.qdrant.io:6333"
+
+# qdrant-client keeps its own connection pool, created with the shared pool settings
+register_client(
+    "qdrant",
+    lambda: QdrantClient(url=QDRANT_URL, api_key=os.getenv("QDRANT_CLOUD_API_KEY"), http2=HTTP2, limits=pool_limits()),
+    lambda client: client.get_collections(),
 )
 
- 
+def async_qdrant_client() -> AsyncQdrantClient:
+    return loop_client("qdrant", lambda: AsyncQdrantClient(url=QDRANT_URL, api_key=os.getenv("QDRANT_CLOUD_API_KEY"), http2=HTTP2, limits=pool_limits()))
+
+# runs the embedding and the entity extraction of a query side by side
+search_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="hybrid-search")
+
+# shared by the query path and the ingestion pipeline
+embedding_cache = EmbeddingCache()
 
+
+@traced("get_embedding")
 def get_embedding(text: str) -> List[float]:
     """Get OpenAI embedding for the given text."""
 
-    response = openai_client.embeddings.create(input=text, model="text-embedding-3-small")
-    return response.data[0].embedding
+    embedding = embedding_cache.get(EMBEDDING_MODEL, text)
+    if embedding is not None:
+        return embedding
 
-groq_client = groq.Groq(
-    api_key=os.getenv("GROQ_API_KEY"),
-)
+    response = get_client("openai").embeddings.create(input=text, model=EMBEDDING_MODEL)
+    record_usage(response)
+    embedding = response.data[0].embedding
+    embedding_cache.put(EMBEDDING_MODEL, text, embedding)
+    return embedding
+
+@traced("get_embedding")
+async def async_get_embedding(text: str) -> List[float]:
+    """Get OpenAI embedding for the given text without blocking the event loop."""
+
+    embedding = embedding_cache.get(EMBEDDING_MODEL, text)
+    if embedding is not None:
+        return embedding
+
+    response = await async_openai_client().embeddings.create(input=text, model=EMBEDDING_MODEL)
+    record_usage(response)
+    embedding = response.data[0].embedding
+    embedding_cache.put(EMBEDDING_MODEL, text, embedding)
+    return embedding
+
+@traced("get_embedding")
+def get_embeddings(texts: List[str], batch_size: int = EMBEDDING_BATCH_SIZE) -> List[List[float]]:
+    """Get OpenAI embeddings for the given texts, only the cache misses are sent in batched requests."""
+
+    embeddings = embedding_cache.get_many(EMBEDDING_MODEL, texts)
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        response = get_client("openai").embeddings.create(input=[texts[i] for i in batch], model=EMBEDDING_MODEL)
+        record_usage(response)
+        batch_embeddings = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        embedding_cache.put_many(EMBEDDING_MODEL, [texts[i] for i in batch], batch_embeddings)
+        for i, embedding in zip(batch, batch_embeddings):
+            embeddings[i] = embedding
+
+    return embeddings
 
-def get_entities(text: str) -> List[str]:
+@traced("get_llm_entities")
+def get_llm_entities(text: str) -> List[str]:
     """Get entities from the given text using GROQ."""
-    response = groq_client.chat.completions.create(
+    response = get_client("groq").chat.completions.create(
         messages=[{"role": "system", "content": KEYWORD_PROMPT}, {"role": "user", "content": text}],
         model="llama3-8b-8192",
     )
+    record_usage(response)
     return response.choices[0].message.content.split(", ")
 
+@traced("get_entities")
+def get_entities(text: str, extractor: str = ENTITY_EXTRACTOR, llm_fallback: bool = ENTITY_LLM_FALLBACK) -> List[str]:
+    """Get entities from the given text.
+
+    Args:
+        text: The query text.
+        extractor: "local" to use the keyword index of the corpus, "llm" to use GROQ.
+        llm_fallback: Whether to use GROQ when the local extractor finds nothing.
+
+    Returns:
+        The entities found in the text.
+    """
+    if extractor == "llm":
+        return get_llm_entities(text)
+
+    entities = extract_keywords(text)
+    if not entities and llm_fallback:
+        return get_llm_entities(text)
+    return entities
+
+# a search filter, payload field -> accepted values that must all match, and terms of which one must be in the content
+SearchFilter = Tuple[Dict[str, List[str]], List[str]]
+
+def qdrant_filter(must: Dict[str, List[str]], should: List[str]) -> models.Filter:
+    must_conditions = [models.FieldCondition(key=key, match=models.MatchAny(any=values)) for key, values in must.items()]
+    should_conditions = [models.FieldCondition(key="content", match=models.MatchText(text=word)) for word in should]
+    return models.Filter(must=must_conditions, should=should_conditions or None)
+
+@traced("qdrant_search")
+def qdrant_search(collection_name: str, query_embedding: List[float], filters: List[SearchFilter], limit: int) -> List[List]:
+    """Run every filtered search in a single batched request to Qdrant."""
+    # search the quantized vectors of the collection and rescore the best candidates with the original ones
+    params = None
+    if QUANTIZATION != "none":
+        params = models.SearchParams(quantization=models.QuantizationSearchParams(rescore=True, oversampling=float(RESCORE_OVERSAMPLING)))
+    requests = [
+        models.QueryRequest(
+            query=query_embedding,
+            filter=qdrant_filter(must, should),
+            params=params,
+            limit=limit,
+            with_payload=True,
+            score_threshold=0.0
+        )
+        for must, should in filters
+    ]
+    responses = get_client("qdrant").query_batch_points(collection_name=collection_name, requests=requests)
+    return [response.points for response in responses]
+
+@traced("qdrant_search")
+async def async_qdrant_search(collection_name: str, query_embedding: List[float], filters: List[SearchFilter], limit: int) -> List[List]:
+    """Async `qdrant_search`."""
+    params = None
+    if QUANTIZATION != "none":
+        params = models.SearchParams(quantization=models.QuantizationSearchParams(rescore=True, oversampling=float(RESCORE_OVERSAMPLING)))
+    requests = [
+        models.QueryRequest(query=query_embedding, filter=qdrant_filter(must, should), params=params, limit=limit, with_payload=True, score_threshold=0.0)
+        for must, should in filters
+    ]
+    responses = await async_qdrant_client().query_batch_points(collection_name=collection_name, requests=requests)
+    return [response.points for response in responses]
+
+@traced("local_search")
+def local_search(collection_name: str, query_embedding: List[float], filters: List[SearchFilter], limit: int) -> List[List]:
+    """Run every filtered search on the local index of the collection."""
+    index = open_index(collection_name)
+    return [index.search(query_embedding, limit=limit, must=must, should=should, score_threshold=0.0) for must, should in filters]
+
+SEARCH_BACKENDS = {
+    "qdrant": qdrant_search,
+    "local": local_search,
+}
+
+@traced("lexical_search")
+def lexical_search(collection_name: str, query: str, limit: int, must: Dict[str, List[str]]) -> List:
+    """Get the chunks of the collection with the best BM25 score for the query."""
+    return open_index(collection_name).lexical_search(query, limit=limit, must=must)
+
+def search_document(hit) -> Dict:
+    return {
+        "id": hit.id,
+        "subtopic": hit.payload.get("subtopic"),
+        "speakers": hit.payload.get("speakers"),
+        "content": hit.payload.get("content"),
+        "title": hit.payload.get("title"),
+        "url": hit.payload.get("url"),
+        "timestamp": hit.payload.get("timestamp"),
+        "token_count": hit.payload.get("token_count"),
+        "score": hit.score
+    }
+
+def fuse_results(vector_hits: List, lexical_hits: List, weights: Optional[List[float]] = None, k: int = RRF_K) -> List[Dict]:
+    """Merge the vector and BM25 results by reciprocal rank fusion.
+
+    Args:
+        vector_hits: The results of the vector search, best first.
+        lexical_hits: The results of the BM25 search, best first.
+        weights: The weights of the vector and BM25 rankings.
+        k: The rank constant of the fusion.
+
+    Returns:
+        The documents of both result lists, the "score" is the fused score, the "vector_score" and
+        "lexical_score" the scores of the legs that returned the document.
+    """
+    weights = weights or [VECTOR_WEIGHT, LEXICAL_WEIGHT]
+    documents = {}
+    for leg, hits in (("vector_score", vector_hits), ("lexical_score", lexical_hits)):
+        for hit in hits:
+            document = documents.setdefault(str(hit.id), dict(search_document(hit), vector_score=None, lexical_score=None))
+            document[leg] = hit.score
+
+    fused = reciprocal_rank_fusion([[str(hit.id) for hit in vector_hits], [str(hit.id) for hit in lexical_hits]], weights, k)
+    for key, score in fused.items():
+        documents[key]["score"] = score
+    return sorted(documents.values(), key=lambda x: x["score"], reverse=True)
+
+def lexical_fusion(collection_name: str, backend: str, full_text_search: bool = True) -> bool:
+    """Whether the full-text leg of a search is the BM25 lookup fused by rank, see `LEXICAL_FUSION`."""
+    if not full_text_search or LEXICAL_FUSION == "false":
+        return False
+    if LEXICAL_FUSION == "local" and backend != "local":
+        return False
+    return has_lexical_index(collection_name)
+
+def must_filters(subtopic: Optional[str] = None, speakers: Optional[List[str]] = None, title: Optional[str] = None) -> Dict[str, List[str]]:
+    """Metadata filtering, on the top-level fields of the payload written by the ingestion."""
+    must = {}
+    if subtopic:
+        must["subtopic"] = [subtopic]
+    if speakers:
+        must["speakers"] = list(speakers)
+    if title:
+        must["title"] = [title]
+    return must
+
+def search_filters(must: Dict[str, List[str]], entities: List[str]) -> List[SearchFilter]:
+    # search with and without full-text search in a single batch,
+    # without entities the full-text search would be a copy of the plain one
+    filters = []
+    if entities:
+        filters.append((must, entities))
+    filters.append((must, []))
+    return filters
+
+def merge_results(responses: List[List], lexical_hits: Optional[List] = None) -> List[Dict]:
+    """Merge the results of the searches, fused with the BM25 results when there are some."""
+    if lexical_hits is not None:
+        return fuse_results(responses[-1], lexical_hits)
+
+    final_result = [hit for points in responses for hit in points]
+    retrieved_docs = [search_document(hit) for hit in final_result]
+
+    # remove duplicates and sort by score
+    seen = set()
+    unique_docs = []
+    for doc in retrieved_docs:
+        if doc["id"] not in seen:
+            seen.add(doc["id"])
+            unique_docs.append(doc)
+    return sorted(unique_docs, key=lambda x: x["score"], reverse=True)
+
+@traced("hybrid_search")
 def hybrid_search(
     collection_name: str,
     query: str,
@@ -53,7 +289,9 @@ def hybrid_search(
     subtopic: Optional[str] = None,
     speakers: Optional[List[str]] = None,
     title: Optional[str] = None,
-    full_text_search: bool = True
+    full_text_search: bool = True,
+    timings: Optional[Dict[str, float]] = None,
+    backend: str = SEARCH_BACKEND
 ) -> List[Dict]: 
     """Search for similar documents in the collection using a hybrid search approach.
     
@@ -64,83 +302,109 @@ def hybrid_search(
         subtopic: The subtopic of the document.
         speakers: The speakers of the document.
         title: The title of the document.
+        full_text_search: Whether to also run a full-text search, BM25 fused with the vector results
+            when `lexical_fusion` allows it, else a vector search filtered on the entities of the query.
+        timings: Optional dictionary filled with the duration in seconds of every step.
+        backend: The search backend, "qdrant" or "local".
 
     Returns:
-        A list of dictionaries containing the search results.
+        A list of dictionaries containing the search results. Once fused the "score" is the reciprocal
+        rank fusion score, at most `(VECTOR_WEIGHT + LEXICAL_WEIGHT) / (RRF_K + 1)`, not a cosine
+        similarity, the similarity is kept in "vector_score".
     """
 
-    # Get the embeddings for the query text.
-    query_embedding = get_embedding(query)
+    if backend not in SEARCH_BACKENDS:
+        raise ValueError(f"Unknown search backend: {backend}")
 
-    must_conditions = []
-    should_conditions = []
+    timings = {} if timings is None else timings
+    started = time.perf_counter()
 
-    final_result = []
+    def timed(step, func, *args):
+        step_started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            timings[step] = time.perf_counter() - step_started
 
-    # Metadata filtering
-    if subtopic:
-        must_conditions.append(models.FieldCondition(key="subtopic", match=models.MatchValue(value=subtopic)))
-    if speakers:
-        must_conditions.append(models.FieldCondition(key="metadata.speakers", match=models.MatchAny(any=speakers)))
-    if title:
-        must_conditions.append(models.FieldCondition(key="metadata.title", match=models.MatchValue(value=title)))
+    must = must_filters(subtopic=subtopic, speakers=speakers, title=title)
+
+    # the full-text leg is a BM25 lookup fused by rank, else a vector search filtered on the entities
+    lexical = lexical_fusion(collection_name, backend, full_text_search)
+
+    # Get the embeddings and the entities or lexical results for the query text concurrently.
+    embedding_future = search_executor.submit(propagate(timed), "embedding", get_embedding, query)
+    entities_future = search_executor.submit(propagate(timed), "entities", get_entities, query) if full_text_search and not lexical else None
+    lexical_future = search_executor.submit(propagate(timed), "lexical", lexical_search, collection_name, query, limit, must) if lexical else None
+
+    query_embedding = embedding_future.result()
 
     # Full-text search condition
-    if full_text_search == True:
-        entities = get_entities(query)
-        for word in entities:
-            should_conditions.append(models.FieldCondition(key="content", match=models.MatchText(text=word)))
-
-    # search with and without full-text search
-
-    if full_text_search == True:
-        search_result = client.search(
-            collection_name=collection_name,
-            query_vector=query_embedding,
-            query_filter=models.Filter(
-                must=must_conditions,
-                should=should_conditions
-            ),
-            limit=limit,
-            with_payload=True,
-            score_threshold=0.0
-        )
-        final_result = search_result
-
-    search_result = client.search(
-        collection_name=collection_name,
-        query_vector=query_embedding,
-        query_filter=models.Filter(
-            must=must_conditions
-        ),
-        limit=limit,
-        with_payload=True,
-        score_threshold=0.0
+    entities = entities_future.result() if entities_future is not None else []
+
+    search_started = time.perf_counter()
+    responses = SEARCH_BACKENDS[backend](collection_name, query_embedding, search_filters(must, entities), limit)
+    timings["search"] = time.perf_counter() - search_started
+
+    unique_docs = merge_results(responses, lexical_future.result() if lexical_future is not None else None)
+
+    timings["total"] = time.perf_counter() - started
+    logger.debug("hybrid_search timings: %s", ", ".join(f"{step}={seconds * 1000:.1f}ms" for step, seconds in timings.items()))
+    return unique_docs
+
+@traced("hybrid_search")
+async def async_hybrid_search(
+    collection_name: str,
+    query: str,
+    limit: int = 5,
+    subtopic: Optional[str] = None,
+    speakers: Optional[List[str]] = None,
+    title: Optional[str] = None,
+    full_text_search: bool = True,
+    timings: Optional[Dict[str, float]] = None,
+    backend: str = SEARCH_BACKEND
+) -> List[Dict]:
+    """Async `hybrid_search`, the embedding and Qdrant requests do not block the event loop.
+
+    The entity extraction and the BM25 lookup run in worker threads next to the embedding request.
+    """
+
+    if backend not in SEARCH_BACKENDS:
+        raise ValueError(f"Unknown search backend: {backend}")
+
+    timings = {} if timings is None else timings
+    started = time.perf_counter()
+
+    async def timed(step, awaitable):
+        step_started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            timings[step] = time.perf_counter() - step_started
+
+    async def nothing():
+        return None
+
+    must = must_filters(subtopic=subtopic, speakers=speakers, title=title)
+    lexical = lexical_fusion(collection_name, backend, full_text_search)
+
+    query_embedding, entities, lexical_hits = await asyncio.gather(
+        timed("embedding", async_get_embedding(query)),
+        timed("entities", asyncio.to_thread(get_entities, query)) if full_text_search and not lexical else nothing(),
+        timed("lexical", asyncio.to_thread(lexical_search, collection_name, query, limit, must)) if lexical else nothing(),
     )
-    final_result += search_result
-    
-    retrieved_docs = [
-        {
-            "id": hit.id,
-            "subtopic": hit.payload.get("subtopic"),
-            "speakers": hit.payload.get("speakers"),
-            "content": hit.payload.get("content"),
-            "title": hit.payload.get("title"),
-            "url": hit.payload.get("url"),
-            "timestamp": hit.payload.get("timestamp"),
-            "score": hit.score
-        }
-        for hit in final_result
-    ]
 
-    # remove duplicates and sort by score
-    seen = set()
-    unique_docs = []
-    for doc in retrieved_docs:
-        if doc["id"] not in seen:
-            seen.add(doc["id"])
-            unique_docs.append(doc)
-    unique_docs = sorted(unique_docs, key=lambda x: x["score"], reverse=True)
+    search_started = time.perf_counter()
+    filters = search_filters(must, entities or [])
+    if backend == "qdrant":
+        responses = await async_qdrant_search(collection_name, query_embedding, filters, limit)
+    else:
+        responses = SEARCH_BACKENDS[backend](collection_name, query_embedding, filters, limit)
+    timings["search"] = time.perf_counter() - search_started
+
+    unique_docs = merge_results(responses, lexical_hits)
+
+    timings["total"] = time.perf_counter() - started
+    logger.debug("async_hybrid_search timings: %s", ", ".join(f"{step}={seconds * 1000:.1f}ms" for step, seconds in timings.items()))
     return unique_docs
 
 def markdown_template(data) -> str:
@@ -157,7 +421,23 @@ def markdown_template(data) -> str:
     """
     return RESULT_TEMPLATE
 
+def render_results(results: List[Dict]) -> List[str]:
+    """Render the search results without the overlapping chunks, caching their token counts."""
+    documents = []
+    for data in dedupe_chunks(results):
+        document = markdown_template(data)
+        if data.get("token_count") is not None:
+            # the count stored at ingest plus the count of the short header
+            seed_token_count(document, data["token_count"] + count_tokens(markdown_template(dict(data, content=""))))
+        documents.append(document)
+    return documents
+
 def get_results(query: str, collection_name: str, limit: int = 5) -> List[str]:
     """Get search results for the given query."""
     results = hybrid_search(collection_name=collection_name, query=query, limit=limit)
-    return [markdown_template(data) for data in results]
\ No newline at end of file
+    return render_results(results)
+
+async def async_get_results(query: str, collection_name: str, limit: int = 5) -> List[str]:
+    """Get search results for the given query without blocking the event loop."""
+    results = await async_hybrid_search(collection_name=collection_name, query=query, limit=limit)
+    return render_results(results)
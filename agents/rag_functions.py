@@ -1,45 +1,170 @@
-from agents.rag_db import get_results
+from agents.rag_db import get_results, async_get_results
 from typing import Optional, List
-from agents.clients import cohere_client
-from agents.rag_agents import grade_answer, grade_document, check_halucinations, llm_answer, requery
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import asyncio
+import logging
+from agents.tracing import traced, propagate
+from agents.single_flight import coalesced
+from agents.embedding_cache import normalize_text
+from agents.rerankers import get_reranker, RERANKER
+from agents.context import pack_documents, truncate_tokens, budget
+from agents.rag_agents import LLM_ANSWER_MODEL
+from agents.rag_agents import grade_answer, grade_document, grade_documents_batch, check_halucinations, llm_answer, stream_llm_answer, requery as llm_requery
+from agents.rag_agents import async_grade_answer, async_grade_document, async_grade_documents_batch, async_check_halucinations, async_llm_answer, async_stream_llm_answer, async_requery as async_llm_requery
 
 
-def get_documents(query: str, limit: Optional[int]):
+logger = logging.getLogger(__name__)
+
+# documents retrieved per query by the RAG pipeline
+RETRIEVAL_LIMIT = 10
+
+
+def documents_key(query: str, limit: Optional[int], reranker: str = RERANKER):
+    return normalize_text(query), limit, reranker
+
+
+@traced("retrieve")
+@coalesced("get_documents", documents_key)
+def get_documents(query: str, limit: Optional[int], reranker: str = RERANKER):
     """Get the response from the RAG model.
 
     Args:
         query: The query text.
         limit: The number of results to return.
+        reranker: The reranker ordering the results, "none", "lexical", "cross_encoder" or "cohere".
 
     Returns:
-        The documents retrieved from vector database.
+        The documents retrieved from vector database, most relevant first.
     """
     results = get_results(query, collection_name="podcasts", limit=limit)
-    # reranker
-    # reranker = cohere_client.rerank(model="rerank-english-v3.0", query=query, documents=results, return_documents=False, top_n=5)
-    # indices = [reranker[i].index for i in range(len(reranker))]
-    # documents = [results[i] for i in indices]
-    return results
+    model = get_reranker(reranker)
+    if model is None or not results:
+        return results
+    try:
+        ranking = model.rerank(query, results)
+    except Exception:
+        logger.warning("%s reranker failed, keeping the retrieval order", reranker, exc_info=True)
+        return results
+    return [results[index] for index, _ in ranking]
+
+
+GRADING_MAX_WORKERS = 5
+GRADING_TIMEOUT = 30.0
+# "per_document" grades every document with its own call, "batch" grades all documents in one call
+GRADING_MODE = "per_document"
+
+
+def _is_relevant(query: str, document: str) -> bool:
+    grade = grade_document(query=query, document=document)
+    return grade.content[-1].parsed.binary_score == "yes"
+
+
+def _batch_relevance(query: str, documents: List[str], keep_on_error: bool) -> List[bool]:
+    grade = grade_documents_batch(query=query, documents=documents)
+    verdicts = {item.index: item.binary_score == "yes" for item in grade.content[-1].parsed.grades}
+    # documents the grader skipped are treated like failed grades
+    return [verdicts.get(index, keep_on_error) for index in range(len(documents))]
+
+
+def _concurrent_relevance(query: str, documents: List[str], max_workers: int, timeout: Optional[float], keep_on_error: bool) -> List[bool]:
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(documents))))
+    try:
+        futures = [executor.submit(propagate(_is_relevant), query, document) for document in documents]
+
+        relevance = []
+        for future in futures:
+            try:
+                relevance.append(future.result(timeout=timeout))
+            except FutureTimeoutError:
+                future.cancel()
+                relevance.append(keep_on_error)
+            except Exception:
+                relevance.append(keep_on_error)
+    finally:
+        # do not block on grades that timed out
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return relevance
+
+
+def _reranker_verdicts(query: str, documents: List[str], reranker: str) -> List[Optional[bool]]:
+    model = get_reranker(reranker)
+    if model is None:
+        return [None] * len(documents)
+    try:
+        return [model.verdict(score) for score in model.score(query, documents)]
+    except Exception:
+        logger.warning("%s reranker failed, grading every document", reranker, exc_info=True)
+        return [None] * len(documents)
 
 
-def graded_documents(query: str, documents: List[str]):
+def graded_documents(
+    query: str,
+    documents: List[str],
+    max_workers: int = GRADING_MAX_WORKERS,
+    timeout: Optional[float] = GRADING_TIMEOUT,
+    keep_on_error: bool = True,
+    mode: str = GRADING_MODE,
+    reranker: str = RERANKER,
+):
     """Grade the documents based on the query.
 
+    Documents the reranker scores past its accept or reject cutoff are kept or dropped without an LLM call.
+    In "per_document" mode the others are graded concurrently, with at most `max_workers` grading calls in flight.
+    In "batch" mode they are graded in a single call, falling back to "per_document" mode if it fails.
+    The relevant documents are returned in their retrieval order.
+
     Args:
         query: The query text.
+        documents: The list of documents.
+        max_workers: The maximum number of concurrent grading calls.
+        timeout: Seconds to wait for each grade, None waits forever.
+        keep_on_error: Whether to keep a document whose grading failed or timed out.
+        mode: The grading mode, "per_document" or "batch".
+        reranker: The reranker whose cutoffs skip the grading, "none" grades every document.
 
     Returns:
         The graded documents.
     """
-    final_document_list = []
-    for document in documents:
-        grade = grade_document(query=query, document=document)
-        if grade.content[-1].parsed.binary_score == "yes":
-            final_document_list.append(document)
-        else:
-            continue
+    if mode not in ("per_document", "batch"):
+        raise ValueError(f"Unknown grading mode: {mode}")
+
+    if not documents:
+        return []
+
+    relevance = _reranker_verdicts(query, documents, reranker)
+    uncertain = [i for i, relevant in enumerate(relevance) if relevant is None]
+
+    if uncertain:
+        uncertain_documents = [documents[i] for i in uncertain]
+        grades = None
+        if mode == "batch":
+            try:
+                grades = _batch_relevance(query, uncertain_documents, keep_on_error)
+            except Exception:
+                grades = None
+
+        if grades is None:
+            grades = _concurrent_relevance(query, uncertain_documents, max_workers, timeout, keep_on_error)
+
+        for i, relevant in zip(uncertain, grades):
+            relevance[i] = relevant
+
+    return [document for document, relevant in zip(documents, relevance) if relevant]
 
-    return final_document_list
+
+def pack_context(documents: List[str], history: Optional[str], model: str = LLM_ANSWER_MODEL):
+    """Fit the documents and the history in the prompt token budget of the answer model.
+
+    Args:
+        documents: The list of documents, most relevant first.
+        history: The conversation history.
+        model: The model answering.
+
+    Returns:
+        The documents and the history to put in the prompt.
+    """
+    return pack_documents(documents, model), truncate_tokens(history, budget(model, "history"), model)
 
 
 def llm_generation(query: str, intent: str, output_sentiment: str, documents: List[str], history: str):
@@ -52,12 +177,29 @@ def llm_generation(query: str, intent: str, output_sentiment: str, documents: Li
         documents: The list of documents.
 
     Returns:
-        The generated answer from llm.
+        The generated answer from llm and the documents it was given.
     """
+    documents, history = pack_context(documents, history)
     result = llm_answer(query=query, user_intent=intent, output_emotion=output_sentiment, documents=documents, history=history)
     return result, documents
 
 
+def llm_generation_stream(query: str, intent: str, output_sentiment: str, documents: List[str], history: str):
+    """Generate an answer using the LLM model, streaming its tokens.
+
+    Args:
+        query: The query text.
+        intent: The user intent.
+        output_sentiment: The output sentiment.
+        documents: The list of documents.
+
+    Returns:
+        An iterator over the tokens of the answer and the documents it was given.
+    """
+    documents, history = pack_context(documents, history)
+    return stream_llm_answer(query=query, user_intent=intent, output_emotion=output_sentiment, documents=documents, history=history), documents
+
+
 def halucinations_score(documents: List[str], answer: str):
     """Check if the answer is hallucinated.
 
@@ -96,5 +238,101 @@ def requery(query: str):
     Returns:
         The response from the chatbot.
     """
-    new_query = requery(query)
-    return new_query
\ No newline at end of file
+    new_query = llm_requery(query)
+    return new_query
+
+# Async variants of the functions above, for callers running in an event loop.
+
+@traced("retrieve")
+@coalesced("get_documents", documents_key)
+async def async_get_documents(query: str, limit: Optional[int], reranker: str = RERANKER):
+    """Async `get_documents`, the reranker runs in a worker thread."""
+    results = await async_get_results(query, collection_name="podcasts", limit=limit)
+    model = get_reranker(reranker)
+    if model is None or not results:
+        return results
+    try:
+        ranking = await asyncio.to_thread(model.rerank, query, results)
+    except Exception:
+        logger.warning("%s reranker failed, keeping the retrieval order", reranker, exc_info=True)
+        return results
+    return [results[index] for index, _ in ranking]
+
+
+async def _async_is_relevant(query: str, document: str, semaphore: asyncio.Semaphore, timeout: Optional[float], keep_on_error: bool) -> bool:
+    async with semaphore:
+        try:
+            grade = await asyncio.wait_for(async_grade_document(query=query, document=document), timeout)
+            return grade.binary_score == "yes"
+        except Exception:
+            return keep_on_error
+
+
+async def async_graded_documents(
+    query: str,
+    documents: List[str],
+    max_workers: int = GRADING_MAX_WORKERS,
+    timeout: Optional[float] = GRADING_TIMEOUT,
+    keep_on_error: bool = True,
+    mode: str = GRADING_MODE,
+    reranker: str = RERANKER,
+):
+    """Async `graded_documents`, at most `max_workers` grading calls are in flight."""
+    if mode not in ("per_document", "batch"):
+        raise ValueError(f"Unknown grading mode: {mode}")
+
+    if not documents:
+        return []
+
+    relevance = await asyncio.to_thread(_reranker_verdicts, query, documents, reranker)
+    uncertain = [i for i, relevant in enumerate(relevance) if relevant is None]
+
+    if uncertain:
+        uncertain_documents = [documents[i] for i in uncertain]
+        grades = None
+        if mode == "batch":
+            try:
+                grade = await asyncio.wait_for(async_grade_documents_batch(query=query, documents=uncertain_documents), timeout)
+                verdicts = {item.index: item.binary_score == "yes" for item in grade.grades}
+                grades = [verdicts.get(index, keep_on_error) for index in range(len(uncertain_documents))]
+            except Exception:
+                grades = None
+
+        if grades is None:
+            semaphore = asyncio.Semaphore(max(1, max_workers))
+            grades = await asyncio.gather(*(_async_is_relevant(query, document, semaphore, timeout, keep_on_error) for document in uncertain_documents))
+
+        for i, relevant in zip(uncertain, grades):
+            relevance[i] = relevant
+
+    return [document for document, relevant in zip(documents, relevance) if relevant]
+
+
+async def async_llm_generation(query: str, intent: str, output_sentiment: str, documents: List[str], history: str):
+    """Async `llm_generation`."""
+    documents, history = pack_context(documents, history)
+    result = await async_llm_answer(query=query, user_intent=intent, output_emotion=output_sentiment, documents=documents, history=history)
+    return result, documents
+
+
+def async_llm_generation_stream(query: str, intent: str, output_sentiment: str, documents: List[str], history: str):
+    """Async `llm_generation_stream`, returns an async iterator over the tokens of the answer and the documents it was given."""
+    documents, history = pack_context(documents, history)
+    return async_stream_llm_answer(query=query, user_intent=intent, output_emotion=output_sentiment, documents=documents, history=history), documents
+
+
+async def async_halucinations_score(documents: List[str], answer: str):
+    """Async `halucinations_score`."""
+    result = await async_check_halucinations(document=documents, answer=answer)
+    return result.binary_score
+
+
+async def async_answer_grade(answer: str, question: str):
+    """Async `answer_grade`."""
+    grade = await async_grade_answer(answer=answer, question=question)
+    return grade.binary_score
+
+
+async def async_requery(query: str):
+    """Async `requery`."""
+    return await async_llm_requery(query)
@@ -0,0 +1,150 @@
+from dataclasses import dataclass, field
+from typing import List, Dict, Optional
+from enum import Enum
+import time
+
+# attempts allowed per stage, counted per request
+RETRIEVAL_RETRIES = ANSWER_RETRIES = HALLUCINATION_RETRIES = 3
+# seconds before the pipeline stops retrying and returns the best answer so far
+RAG_DEADLINE = 60.0
+
+DEADLINE_FALLBACK = "Sorry, I could not find a good answer to that in time. Could you try rephrasing the question?"
+
+
+class Stage(str, Enum):
+    RETRIEVE = "retrieve"
+    GRADE = "grade"
+    GENERATE = "generate"
+    CHECK_HALLUCINATION = "check_hallucination"
+    GRADE_ANSWER = "grade_answer"
+    REQUERY = "requery"
+    DONE = "done"
+
+
+# how trustworthy an answer is, the best ranked answer is returned when the pipeline gives up
+GENERATED, GROUNDED, ACCEPTED = 1, 2, 3
+
+
+@dataclass
+class PipelineState:
+    """Request scoped state of the RAG pipeline.
+
+    Every stage of the pipeline reads and updates the state, then the transition methods below pick
+    the next stage from the outcome and the remaining attempt budgets. Nothing is shared between
+    requests, so concurrent requests cannot reset each other's counters.
+    """
+
+    query: str
+    user_intent: str
+    output_emotion: str
+    history: Optional[str] = None
+    deadline: Optional[float] = None
+    budgets: Dict[str, int] = field(default_factory=lambda: {
+        "retrieval": RETRIEVAL_RETRIES,
+        "hallucination": HALLUCINATION_RETRIES,
+        "answer": ANSWER_RETRIES,
+    })
+    attempts: Dict[str, int] = field(default_factory=lambda: {"retrieval": 0, "hallucination": 0, "answer": 0})
+
+    stage: Stage = Stage.RETRIEVE
+    original_query: str = ""
+    documents: List[str] = field(default_factory=list)
+    graded_documents: List[str] = field(default_factory=list)
+    answer: Optional[str] = None
+    best_answer: Optional[str] = None
+    best_rank: int = 0
+    # whether the current answer passed the hallucination check
+    grounded: bool = False
+    degraded: bool = False
+    # stage to resume once the query has been rewritten
+    resume: Stage = Stage.RETRIEVE
+    # documents already retrieved for a query, e.g. speculatively while routing
+    prefetched: Dict[str, List[str]] = field(default_factory=dict)
+    trace: List[str] = field(default_factory=list)
+
+    def __post_init__(self):
+        if not self.original_query:
+            self.original_query = self.query
+
+    @classmethod
+    def start(cls, query: str, user_intent: str, output_emotion: str, history: Optional[str] = None, timeout: Optional[float] = RAG_DEADLINE, **kwargs) -> "PipelineState":
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        return cls(query=query, user_intent=user_intent, output_emotion=output_emotion, history=history, deadline=deadline, **kwargs)
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def remaining(self) -> Optional[float]:
+        return None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+
+    def attempt(self) -> int:
+        """The pass of the pipeline the request is in, 1 until the first requery."""
+        return 1 + sum(self.attempts.values())
+
+    def _retry(self, budget: str, resume: Stage) -> Optional[Stage]:
+        if self.attempts[budget] >= self.budgets[budget]:
+            return None
+        self.attempts[budget] += 1
+        self.resume = resume
+        return Stage.REQUERY
+
+    def _offer(self, answer: str, rank: int):
+        # keep the earliest answer of the highest rank
+        if rank > self.best_rank:
+            self.best_answer = answer
+            self.best_rank = rank
+
+    def after_retrieval(self, documents: List[str]) -> Stage:
+        self.documents = documents
+        return Stage.GRADE
+
+    def after_grading(self, graded_documents: List[str]) -> Stage:
+        self.graded_documents = graded_documents
+        if graded_documents:
+            return Stage.GENERATE
+        # no relevant documents, rewrite the query and retrieve again, else answer without documents
+        return self._retry("retrieval", Stage.RETRIEVE) or Stage.GENERATE
+
+    def after_generation(self, answer: str) -> Stage:
+        self.answer = answer
+        self.grounded = False
+        self._offer(answer, GENERATED)
+        return Stage.CHECK_HALLUCINATION
+
+    def after_hallucination_check(self, score: str) -> Stage:
+        if str(score).lower() == "no":
+            # regenerate from the same documents with a rewritten query
+            retry = self._retry("hallucination", Stage.GENERATE)
+            if retry:
+                return retry
+        else:
+            self.grounded = True
+            self._offer(self.answer, GROUNDED)
+        return Stage.GRADE_ANSWER
+
+    def after_answer_grade(self, grade: str) -> Stage:
+        if str(grade).lower() == "no":
+            # the answer misses the question, rewrite the query and retrieve again
+            return self._retry("answer", Stage.RETRIEVE) or Stage.DONE
+        # an answer flagged as hallucinated stays below the grounded ones, even when it is on topic
+        if self.grounded:
+            self._offer(self.answer, ACCEPTED)
+        return Stage.DONE
+
+    def after_requery(self, query: str) -> Stage:
+        self.query = query
+        return self.resume
+
+    def on_deadline(self) -> Stage:
+        """Stop retrying, an answer is still generated once, without grading, if there is none yet."""
+        self.degraded = True
+        return Stage.GENERATE if self.best_answer is None else Stage.DONE
+
+    def accepted(self) -> bool:
+        """Whether the result passed both graders before the deadline, only such answers are cached."""
+        return self.best_rank == ACCEPTED and not self.degraded
+
+    def result(self) -> str:
+        if self.best_answer is not None:
+            return self.best_answer
+        return self.answer if self.answer is not None else DEADLINE_FALLBACK
@@ -0,0 +1,184 @@
+from collections import Counter, OrderedDict
+from typing import List, Dict, Optional, Tuple
+from agents.bm25 import analyze
+from agents.clients import get_client
+import threading
+import hashlib
+import math
+import os
+
+# "none", "lexical", "cross_encoder" or "cohere"
+RERANKER = os.getenv("RERANKER", "none")
+CROSS_ENCODER_MODEL = os.getenv("CROSS_ENCODER_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+CROSS_ENCODER_BATCH_SIZE = 32
+COHERE_RERANK_MODEL = "rerank-english-v3.0"
+RERANK_CACHE_SIZE = 4096
+
+
+def _cutoff(name: str, default: Optional[float]) -> Optional[float]:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return None if value.lower() == "none" else float(value)
+
+
+class Reranker:
+    """Scores the relevance of documents to a query.
+
+    Documents scoring at or above `accept_score` are relevant enough to skip the LLM grader, documents
+    scoring at or below `reject_score` are dropped without grading, None disables a cutoff. Scores are
+    cached per (query, document) so reranking and grading the same candidates scores them once.
+    """
+
+    name = "none"
+    accept_score: Optional[float] = None
+    reject_score: Optional[float] = None
+
+    def __init__(self, accept_score: Optional[float] = None, reject_score: Optional[float] = None, cache_size: int = RERANK_CACHE_SIZE):
+        prefix = f"RERANK_{self.name.upper()}"
+        self.accept_score = accept_score if accept_score is not None else _cutoff(f"{prefix}_ACCEPT", self.accept_score)
+        self.reject_score = reject_score if reject_score is not None else _cutoff(f"{prefix}_REJECT", self.reject_score)
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _score(self, query: str, documents: List[str]) -> List[float]:
+        raise NotImplementedError
+
+    def _key(self, query: str, document: str) -> str:
+        return hashlib.sha256("\0".join([self.name, query, document]).encode("utf-8")).hexdigest()
+
+    def score(self, query: str, documents: List[str]) -> List[float]:
+        """Get the relevance score of every document, only the documents not cached are scored."""
+        keys = [self._key(query, document) for document in documents]
+        with self._lock:
+            scores = [self._cache.get(key) for key in keys]
+            for key, score in zip(keys, scores):
+                if score is not None:
+                    self._cache.move_to_end(key)
+
+        missing = [i for i, score in enumerate(scores) if score is None]
+        if missing:
+            for i, score in zip(missing, self._score(query, [documents[i] for i in missing])):
+                scores[i] = score
+            with self._lock:
+                for i in missing:
+                    self._cache[keys[i]] = scores[i]
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return scores
+
+    def rerank(self, query: str, documents: List[str]) -> List[Tuple[int, float]]:
+        """Get the (index, score) of the documents, best first."""
+        scores = self.score(query, documents)
+        return sorted(enumerate(scores), key=lambda item: item[1], reverse=True)
+
+    def verdict(self, score: float) -> Optional[bool]:
+        """True when clearly relevant, False when clearly irrelevant, None when the LLM should decide."""
+        if self.accept_score is not None and score >= self.accept_score:
+            return True
+        if self.reject_score is not None and score <= self.reject_score:
+            return False
+        return None
+
+
+class LexicalReranker(Reranker):
+    """IDF-weighted coverage of the query terms, no model needed.
+
+    A document scores the share of the query's IDF mass it contains, the IDF being computed over the
+    candidates, so 1.0 means every query term is present and 0.0 that none is.
+    """
+
+    name = "lexical"
+    reject_score = 0.0
+
+    def _score(self, query: str, documents: List[str]) -> List[float]:
+        terms = set(analyze(query))
+        tokens = [set(analyze(document)) for document in documents]
+        if not terms:
+            return [0.0] * len(documents)
+
+        document_frequency = Counter(term for document in tokens for term in document & terms)
+        idf = {term: math.log(1 + (len(documents) + 1) / (document_frequency[term] + 0.5)) for term in terms}
+        total = sum(idf.values())
+        return [sum(idf[term] for term in document & terms) / total for document in tokens]
+
+
+class CrossEncoderReranker(Reranker):
+    """Local sentence-transformers cross-encoder, all candidates are scored in one batched pass.
+
+    `CrossEncoder.predict` already maps the logit of single-label models like ms-marco through a
+    sigmoid, the scores and the cutoffs are probabilities.
+    """
+
+    name = "cross_encoder"
+    accept_score = 0.9
+    reject_score = 0.01
+
+    def __init__(self, model_name: str = CROSS_ENCODER_MODEL, batch_size: int = CROSS_ENCODER_BATCH_SIZE, **kwargs):
+        super().__init__(**kwargs)
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self._model = None
+        self._model_lock = threading.Lock()
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    # imported lazily, torch takes seconds to import and is only needed by this reranker
+                    from sentence_transformers import CrossEncoder
+                    self._model = CrossEncoder(self.model_name)
+        return self._model
+
+    def _key(self, query: str, document: str) -> str:
+        return super()._key(self.model_name + "\0" + query, document)
+
+    def _score(self, query: str, documents: List[str]) -> List[float]:
+        scores = self.model.predict([(query, document) for document in documents], batch_size=self.batch_size, show_progress_bar=False)
+        return [float(score) for score in scores]
+
+
+class CohereReranker(Reranker):
+    """Cohere rerank API, only the candidates missing from the cache are sent."""
+
+    name = "cohere"
+    accept_score = 0.8
+    reject_score = 0.05
+
+    def __init__(self, model_name: str = COHERE_RERANK_MODEL, **kwargs):
+        super().__init__(**kwargs)
+        self.model_name = model_name
+
+    def _key(self, query: str, document: str) -> str:
+        return super()._key(self.model_name + "\0" + query, document)
+
+    def _score(self, query: str, documents: List[str]) -> List[float]:
+        response = get_client("cohere").rerank(model=self.model_name, query=query, documents=documents, top_n=len(documents))
+        scores = [0.0] * len(documents)
+        for result in response.results:
+            scores[result.index] = result.relevance_score
+        return scores
+
+
+RERANKERS = {
+    "lexical": LexicalReranker,
+    "cross_encoder": CrossEncoderReranker,
+    "cohere": CohereReranker,
+}
+
+_rerankers: Dict[str, Reranker] = {}
+_rerankers_lock = threading.Lock()
+
+
+def get_reranker(name: str = RERANKER) -> Optional[Reranker]:
+    """Get the shared reranker of the given name, None for "none"."""
+    if name == "none":
+        return None
+    if name not in RERANKERS:
+        raise ValueError(f"Unknown reranker: {name}")
+    with _rerankers_lock:
+        if name not in _rerankers:
+            _rerankers[name] = RERANKERS[name]()
+        return _rerankers[name]
@@ -0,0 +1,218 @@
+from typing import List, Optional, Dict
+from agents.embedding_cache import CACHE_DIR, normalize_text
+from agents.rag_db import get_embedding, async_get_embedding, VECTOR_SIZE
+from agents.memory_manager import NO_FACTS
+import numpy as np
+import threading
+import time
+import re
+import os
+
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.95"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(24 * 60 * 60)))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "50000"))
+
+# markdown links to timestamps, e.g. [(02:16:41)](https://youtube.com/watch?v=tYrdMjVXyNg&t=8201)
+CITATION_PATTERN = re.compile(r"\[\(?\d{1,2}:\d{2}(?::\d{2})?\)?\]\([^)\s]+\)")
+
+
+def generation_path(collection_name: str) -> str:
+    return os.path.join(CACHE_DIR, f"{collection_name}.generation")
+
+
+def collection_generation(collection_name: str) -> int:
+    """Get the generation of a collection, it changes every time the collection is re-ingested."""
+    try:
+        return os.stat(generation_path(collection_name)).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def bump_collection_generation(collection_name: str):
+    """Mark a collection as re-ingested, invalidating the responses cached for it in every process."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(generation_path(collection_name), "w", encoding="utf-8") as f:
+        f.write(str(time.time_ns()))
+
+
+def shareable(history: Optional[str]) -> bool:
+    """Whether an answer generated with these session facts may be served to other users.
+
+    The cache is shared by every session and looked up by the query alone, an answer generated with
+    the facts of a session may rely on them, only the answers of sessions without facts are stored.
+    """
+    return not history or history == NO_FACTS
+
+
+def extract_citations(response: str) -> List[str]:
+    """Get the timestamp links cited in a response."""
+    return list(dict.fromkeys(CITATION_PATTERN.findall(response)))
+
+
+class SemanticResponseCache:
+    """Cache of RAG responses looked up by the similarity of the query embeddings.
+
+    Embeddings are kept normalized in one float32 matrix so a lookup is a single matrix-vector product.
+    The cache is keyed by the query alone so every user asking a popular question shares the entry,
+    see `shareable` for the answers kept out of it.
+    Entries expire after `ttl` seconds, once full the least recently used entry is replaced and
+    everything is dropped when the collection generation changes.
+    """
+
+    def __init__(
+        self,
+        collection_name: str = "podcasts",
+        threshold: float = RESPONSE_CACHE_THRESHOLD,
+        ttl: float = RESPONSE_CACHE_TTL,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        dim: int = VECTOR_SIZE,
+    ):
+        self.collection_name = collection_name
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+        self._lock = threading.Lock()
+        self._vectors = np.zeros((min(1024, max_entries), dim), dtype=np.float32)
+        self._expires = np.zeros(len(self._vectors), dtype=np.float64)
+        self._used = np.zeros(len(self._vectors), dtype=np.float64)
+        self._entries: List[Optional[Dict]] = [None] * len(self._vectors)
+        self._size = 0
+        self._generation = collection_generation(collection_name)
+
+    def __len__(self) -> int:
+        return sum(entry is not None for entry in self._entries[:self._size])
+
+    def _check_generation(self):
+        generation = collection_generation(self.collection_name)
+        if generation != self._generation:
+            self._clear()
+            self._generation = generation
+            self.stats["invalidations"] += 1
+
+    def _clear(self):
+        self._expires[:] = 0
+        self._entries = [None] * len(self._vectors)
+        self._size = 0
+
+    def _slot(self, now: float) -> int:
+        if self._size < len(self._vectors):
+            self._size += 1
+            return self._size - 1
+        if len(self._vectors) < self.max_entries:
+            capacity = min(len(self._vectors) * 2, self.max_entries)
+            grow = capacity - len(self._vectors)
+            self._vectors = np.concatenate([self._vectors, np.zeros((grow, self._vectors.shape[1]), dtype=np.float32)])
+            self._expires = np.concatenate([self._expires, np.zeros(grow)])
+            self._used = np.concatenate([self._used, np.zeros(grow)])
+            self._entries += [None] * grow
+            return self._slot(now)
+        # reuse an expired slot, else the least recently used one
+        expired = np.flatnonzero(self._expires < now)
+        slot = int(expired[0]) if len(expired) else int(np.argmin(self._used))
+        if self._entries[slot] is not None:
+            self.stats["evictions"] += 1
+        return slot
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, embedding: List[float]) -> Optional[Dict]:
+        """Get the cached entry of the most similar previous query, None below the threshold."""
+        vector = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            self._check_generation()
+            if self._size:
+                scores = self._vectors[:self._size] @ vector
+                scores[self._expires[:self._size] < now] = -1.0
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self._used[best] = now
+                    self.stats["hits"] += 1
+                    return dict(self._entries[best], similarity=float(scores[best]))
+            self.stats["misses"] += 1
+            return None
+
+    def store(self, query: str, embedding: List[float], response: str, citations: Optional[List[str]] = None):
+        """Cache the response of a query."""
+        vector = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            self._check_generation()
+            slot = self._slot(now)
+            self._vectors[slot] = vector
+            self._expires[slot] = now + self.ttl
+            self._used[slot] = now
+            self._entries[slot] = {
+                "query": query,
+                "response": response,
+                "citations": extract_citations(response) if citations is None else citations,
+                "created": now,
+            }
+
+    def invalidate(self):
+        """Drop every cached response."""
+        with self._lock:
+            self._clear()
+            self.stats["invalidations"] += 1
+
+    def hit_rate(self) -> float:
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
+
+
+response_cache = SemanticResponseCache()
+
+
+def lookup_response(query: str) -> Optional[Dict]:
+    """Get the cached response of a previously answered query similar to this one.
+
+    Args:
+        query: The query text.
+
+    Returns:
+        The cached entry with the "response" and its "citations", None on a miss.
+    """
+    try:
+        return response_cache.lookup(get_embedding(normalize_text(query)))
+    except Exception:
+        return None
+
+
+def store_response(query: str, response: str, history: Optional[str] = None):
+    """Cache the response of a query, unless it was generated with session facts.
+
+    Args:
+        query: The query text.
+        response: The response of the RAG model.
+        history: The session facts the response was generated with.
+    """
+    if not shareable(history):
+        return
+    try:
+        response_cache.store(query, get_embedding(normalize_text(query)), response)
+    except Exception:
+        pass
+
+
+async def async_lookup_response(query: str) -> Optional[Dict]:
+    """Async `lookup_response`, the query is embedded without blocking the event loop."""
+    try:
+        return response_cache.lookup(await async_get_embedding(normalize_text(query)))
+    except Exception:
+        return None
+
+
+async def async_store_response(query: str, response: str, history: Optional[str] = None):
+    """Async `store_response`."""
+    if not shareable(history):
+        return
+    try:
+        response_cache.store(query, await async_get_embedding(normalize_text(query)), response)
+    except Exception:
+        pass
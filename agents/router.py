@@ -0,0 +1,229 @@
+from typing import Dict, List, Optional, Tuple
+from pydantic import Field, ValidationError
+from agents.clients import get_client, async_groq_client
+from agents.context import pack_history
+from agents.entry import ChatbotEntry, CHATBOT_ENTRY_PROMPT, chatbot_entry, async_chatbot_entry, chatbot_entry_message
+from agents.tracing import span, traced, record_usage
+from ell import Message
+import threading
+import logging
+import time
+import re
+import os
+
+logger = logging.getLogger(__name__)
+
+# route with the heuristics and the small model first, the large model only when they are unsure
+ROUTER_CASCADE = os.getenv("ROUTER_CASCADE", "true").lower() == "true"
+ROUTER_SMALL_MODEL = "llama-3.1-8b-instant"
+# decisions of the small model below this confidence are escalated to the large model
+ROUTER_MIN_CONFIDENCE = float(os.getenv("ROUTER_MIN_CONFIDENCE", "0.7"))
+# only short messages are answered by the heuristics, longer ones may ask something
+HEURISTIC_MAX_WORDS = 8
+
+TIERS = ("heuristic", "small", "large")
+
+GREETING_PATTERN = re.compile(r"^(hi|hello|hey|hiya|howdy|yo|greetings|good (morning|afternoon|evening))( (there|everyone|all|host))?$")
+THANKS_PATTERN = re.compile(r"^((ok|okay|great|cool|awesome) )?(thanks|thank you|thx|ty|cheers)( (so much|a lot|man|mate))?$")
+FAREWELL_PATTERN = re.compile(r"^(bye|goodbye|bye bye|see you|see ya|later|good night)( (then|now))?$")
+TOXIC_PATTERN = re.compile(r"\b(idiot|stupid|moron|dumb|useless|shut up|fuck\w*|shit\w*|bitch|bastard|retard\w*|stfu|kill yourself|hate you)\b")
+# toxic words aimed at the host, not quoted from a question about the podcast
+SECOND_PERSON_PATTERN = re.compile(r"\b(you|your|you're|youre|u|ur)\b")
+
+HEURISTIC_ANSWERS = {
+    "Greeting": "Hey there, welcome to the show! Ask me anything about the podcast, who said what and when, and I'll dig it up for you.",
+    "Thanks": "Anytime! Got another question about the podcast? I'm all ears.",
+    "Farewell": "Thanks for tuning in! Come back anytime you want to dig into another episode.",
+    "Toxic": "I can sense there's frustration here, but let's keep this respectful and productive. What would you like to know about the podcast?",
+}
+
+ROUTER_JSON_PROMPT = """
+        Reply with a single JSON object with the keys:
+        - "answer": the answer to the query if it can be answered from the history, else "no answer",
+        - "use_rag": true or false,
+        - "user_intent": the user intent,
+        - "output_emotion": the output emotion,
+        - "confidence": a number between 0 and 1, how sure you are of use_rag and user_intent.
+        """
+
+
+class RouterDecision(ChatbotEntry):
+    confidence: float = Field(..., ge=0.0, le=1.0, description="Confidence of the routing decision")
+
+
+_stats = {
+    "heuristic": 0, "small": 0, "large": 0,
+    "escalated_invalid": 0, "escalated_low_confidence": 0, "escalated_error": 0,
+}
+_seconds = dict.fromkeys(TIERS, 0.0)
+_stats_lock = threading.Lock()
+
+
+def _record(tier: str, seconds: float, escalation: Optional[str] = None):
+    with _stats_lock:
+        _seconds[tier] += seconds
+        if escalation is None:
+            _stats[tier] += 1
+        else:
+            _stats[f"escalated_{escalation}"] += 1
+
+
+def router_stats() -> Dict[str, float]:
+    """Counts of the turns routed by every tier of the cascade.
+
+    "<tier>" turns were decided by the tier and "<tier>_hit_rate" is their share of all turns,
+    "escalated_<reason>" counts the small model decisions passed on to the large model because they
+    were "invalid", "low_confidence" or an "error". "<tier>_seconds" is the time spent in the tier,
+    escalated calls included. The latency percentiles are the "router.<tier>" stage metrics.
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+        seconds = dict(_seconds)
+    total = sum(stats[tier] for tier in TIERS)
+    for tier in TIERS:
+        stats[f"{tier}_hit_rate"] = stats[tier] / total if total else 0.0
+        stats[f"{tier}_seconds"] = seconds[tier]
+    return stats
+
+
+def _normalize(query: str) -> str:
+    return " ".join(re.sub(r"[^\w\s']", " ", query.casefold()).split())
+
+
+def heuristic_route(query: str) -> Optional[ChatbotEntry]:
+    """Route the obvious messages, greetings, thanks, farewells and insults, without a model.
+
+    Returns:
+        The decision, None when the message needs a model.
+    """
+    text = _normalize(query)
+    if not text or len(text.split()) > HEURISTIC_MAX_WORDS:
+        return None
+    for intent, pattern in (("Greeting", GREETING_PATTERN), ("Thanks", THANKS_PATTERN), ("Farewell", FAREWELL_PATTERN)):
+        if pattern.match(text):
+            return ChatbotEntry(answer=HEURISTIC_ANSWERS[intent], use_rag=False, user_intent=intent, output_emotion="Friendly")
+    if TOXIC_PATTERN.search(text) and SECOND_PERSON_PATTERN.search(text):
+        return ChatbotEntry(answer=HEURISTIC_ANSWERS["Toxic"], use_rag=False, user_intent="Toxic", output_emotion="None")
+    return None
+
+
+def small_model_messages(query: str, history: List[Message], facts: str) -> List[Dict[str, str]]:
+    # the small model has a smaller history budget than the large one
+    history = pack_history(history, model=ROUTER_SMALL_MODEL)
+    return (
+        [{"role": "system", "content": CHATBOT_ENTRY_PROMPT + ROUTER_JSON_PROMPT}]
+        + [{"role": message.role, "content": message.text} for message in history]
+        + [{"role": "user", "content": chatbot_entry_message(query=query, facts=facts)}]
+    )
+
+
+def check_decision(content: Optional[str]) -> Tuple[Optional[ChatbotEntry], Optional[str]]:
+    """Validate the JSON decision of the small model.
+
+    Returns:
+        The decision and None, or None and the reason to escalate it.
+    """
+    try:
+        decision = RouterDecision.model_validate_json(content or "")
+    except ValidationError:
+        return None, "invalid"
+    if decision.confidence < ROUTER_MIN_CONFIDENCE:
+        return None, "low_confidence"
+    return ChatbotEntry(**decision.model_dump(exclude={"confidence"})), None
+
+
+@traced("router.small")
+def small_model_route(query: str, history: List[Message], facts: str) -> Tuple[Optional[ChatbotEntry], Optional[str]]:
+    response = get_client("groq").chat.completions.create(
+        model=ROUTER_SMALL_MODEL,
+        messages=small_model_messages(query, history, facts),
+        response_format={"type": "json_object"},
+        temperature=0,
+    )
+    record_usage(response)
+    return check_decision(response.choices[0].message.content)
+
+
+@traced("router.small")
+async def async_small_model_route(query: str, history: List[Message], facts: str) -> Tuple[Optional[ChatbotEntry], Optional[str]]:
+    response = await async_groq_client().chat.completions.create(
+        model=ROUTER_SMALL_MODEL,
+        messages=small_model_messages(query, history, facts),
+        response_format={"type": "json_object"},
+        temperature=0,
+    )
+    record_usage(response)
+    return check_decision(response.choices[0].message.content)
+
+
+def _heuristic_tier(query: str) -> Optional[ChatbotEntry]:
+    started = time.perf_counter()
+    with span("router.heuristic"):
+        decision = heuristic_route(query)
+    if decision is not None:
+        _record("heuristic", time.perf_counter() - started)
+    return decision
+
+
+def _escalation(error: BaseException) -> Tuple[None, str]:
+    # an unavailable small model must not cost the turn, the large model answers instead
+    logger.warning("small router model failed, escalating: %s", error)
+    return None, "error"
+
+
+@traced("router")
+def route(query: str, history: List[Message], facts: str) -> ChatbotEntry:
+    """Decide how to answer a message with the cheapest tier that is sure of it.
+
+    The heuristics answer greetings and insults, the small model decides the other messages and the
+    large `chatbot_entry` model decides what the small model got wrong or was unsure of.
+
+    Args:
+        query: The user message.
+        history: The conversation, packed for the large model.
+        facts: The facts of the session.
+
+    Returns:
+        The decision, with the answer when no retrieval is needed.
+    """
+    if ROUTER_CASCADE:
+        decision = _heuristic_tier(query)
+        if decision is not None:
+            return decision
+        started = time.perf_counter()
+        try:
+            decision, escalation = small_model_route(query, history, facts)
+        except Exception as e:
+            decision, escalation = _escalation(e)
+        _record("small", time.perf_counter() - started, escalation)
+        if decision is not None:
+            return decision
+
+    started = time.perf_counter()
+    with span("router.large"):
+        response = chatbot_entry(query=query, history=history, facts=facts)
+    _record("large", time.perf_counter() - started)
+    return response.content[-1].parsed
+
+
+@traced("router")
+async def async_route(query: str, history: List[Message], facts: str) -> ChatbotEntry:
+    """Async `route`."""
+    if ROUTER_CASCADE:
+        decision = _heuristic_tier(query)
+        if decision is not None:
+            return decision
+        started = time.perf_counter()
+        try:
+            decision, escalation = await async_small_model_route(query, history, facts)
+        except Exception as e:
+            decision, escalation = _escalation(e)
+        _record("small", time.perf_counter() - started, escalation)
+        if decision is not None:
+            return decision
+
+    started = time.perf_counter()
+    with span("router.large"):
+        response = await async_chatbot_entry(query=query, history=history, facts=facts)
+    _record("large", time.perf_counter() - started)
+    return response
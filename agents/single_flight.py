@@ -0,0 +1,142 @@
+from typing import Any, Callable, Dict, Hashable, Optional
+from agents.tracing import span
+import functools
+import threading
+import inspect
+import asyncio
+import weakref
+import os
+
+# concurrent calls with the same arguments share one computation
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "true").lower() == "true"
+
+_stats: Dict[str, Dict[str, int]] = {}
+_stats_lock = threading.Lock()
+
+
+def _record(name: str, **increments):
+    with _stats_lock:
+        stats = _stats.setdefault(name, {"calls": 0, "executions": 0, "merged": 0, "failures": 0, "cancelled": 0})
+        for key, value in increments.items():
+            stats[key] += value
+
+
+def coalescing_stats() -> Dict[str, Dict[str, float]]:
+    """Counts of the coalesced calls by function.
+
+    "executions" ran the function, "merged" waited for the result of an execution already in flight,
+    "cancelled" executions were cancelled because every caller waiting for them went away.
+    """
+    with _stats_lock:
+        stats = {name: dict(counts) for name, counts in _stats.items()}
+    for counts in stats.values():
+        counts["merge_rate"] = counts["merged"] / counts["calls"] if counts["calls"] else 0.0
+    return stats
+
+
+def _share(result: Any) -> Any:
+    # every caller gets its own list, the callers may reorder or trim it
+    return list(result) if isinstance(result, list) else result
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class _AsyncCall:
+    def __init__(self, task: "asyncio.Future"):
+        self.task = task
+        self.waiters = 0
+
+
+def coalesced(name: str, key: Callable[..., Hashable]) -> Callable:
+    """Share one execution of the decorated function between the concurrent calls with the same key.
+
+    The first call runs the function, the calls arriving while it runs wait for it and receive its
+    result, or its exception. An async execution runs in its own task, it is cancelled only once
+    every caller waiting for it is cancelled.
+
+    Args:
+        name: The name of the function in the stats and the traces.
+        key: Computes the key of a call from its arguments.
+    """
+    def decorator(func: Callable) -> Callable:
+        if inspect.iscoroutinefunction(func):
+            # the in-flight tasks of every event loop, a task cannot be awaited from another loop
+            loop_calls: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Hashable, _AsyncCall]]" = weakref.WeakKeyDictionary()
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not SINGLE_FLIGHT:
+                    return await func(*args, **kwargs)
+                call_key = key(*args, **kwargs)
+                calls = loop_calls.setdefault(asyncio.get_running_loop(), {})
+                call = calls.get(call_key)
+                leader = call is None
+                if leader:
+                    call = calls[call_key] = _AsyncCall(asyncio.ensure_future(func(*args, **kwargs)))
+
+                    def forget(task, call=call):
+                        if calls.get(call_key) is call:
+                            del calls[call_key]
+                        if not task.cancelled() and task.exception() is not None:
+                            _record(name, failures=1)
+
+                    call.task.add_done_callback(forget)
+                    _record(name, calls=1, executions=1)
+                else:
+                    _record(name, calls=1, merged=1)
+
+                call.waiters += 1
+                try:
+                    if leader:
+                        return _share(await asyncio.shield(call.task))
+                    with span(f"coalesced.{name}"):
+                        return _share(await asyncio.shield(call.task))
+                except asyncio.CancelledError:
+                    if call.waiters == 1 and not call.task.done():
+                        call.task.cancel()
+                        _record(name, cancelled=1)
+                    raise
+                finally:
+                    call.waiters -= 1
+            return async_wrapper
+
+        calls: Dict[Hashable, _Call] = {}
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not SINGLE_FLIGHT:
+                return func(*args, **kwargs)
+            call_key = key(*args, **kwargs)
+            with lock:
+                call = calls.get(call_key)
+                leader = call is None
+                if leader:
+                    call = calls[call_key] = _Call()
+            _record(name, calls=1, executions=int(leader), merged=int(not leader))
+
+            if leader:
+                try:
+                    call.result = func(*args, **kwargs)
+                    return _share(call.result)
+                except BaseException as e:
+                    call.error = e
+                    _record(name, failures=1)
+                    raise
+                finally:
+                    with lock:
+                        del calls[call_key]
+                    call.done.set()
+
+            with span(f"coalesced.{name}"):
+                call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return _share(call.result)
+        return wrapper
+    return decorator
@@ -0,0 +1,124 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Dict, Optional
+from agents.rag_functions import get_documents, async_get_documents, RETRIEVAL_LIMIT
+import threading
+import asyncio
+import time
+import os
+
+# start the retrieval of the raw prompt while the router decides whether RAG is needed
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "true").lower() == "true"
+
+speculation_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="speculative-retrieval")
+
+_stats = {"launched": 0, "hits": 0, "misses": 0, "failures": 0, "saved_seconds": 0.0, "wasted_seconds": 0.0}
+_stats_lock = threading.Lock()
+
+
+def _record(**increments):
+    with _stats_lock:
+        for key, value in increments.items():
+            _stats[key] += value
+
+
+def speculation_stats() -> Dict[str, float]:
+    """Counts of the speculative retrievals.
+
+    "hits" were used by the RAG pipeline, "misses" discarded because the router answered without RAG.
+    "saved_seconds" is the retrieval time hidden behind routing, "wasted_seconds" the retrieval time
+    spent on discarded speculations.
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    claimed = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / claimed if claimed else 0.0
+    return stats
+
+
+class SpeculativeRetrieval:
+    """Retrieval of the documents of a query started before knowing whether they are needed.
+
+    Call `claim` to get the documents once the router chose RAG, else `discard`.
+    """
+
+    def __init__(self, query: str, limit: int = RETRIEVAL_LIMIT):
+        self.query = query
+        self.limit = limit
+        self.started = time.perf_counter()
+        self.duration: Optional[float] = None
+        _record(launched=1)
+        self.future: Future = speculation_executor.submit(self._retrieve)
+
+    def _retrieve(self) -> Optional[List[str]]:
+        try:
+            return get_documents(query=self.query, limit=self.limit)
+        except Exception:
+            return None
+        finally:
+            self.duration = time.perf_counter() - self.started
+
+    def claim(self, timeout: Optional[float] = None) -> Optional[List[str]]:
+        """Get the documents, None if the retrieval failed or timed out and has to be run again."""
+        claimed = time.perf_counter()
+        try:
+            documents = self.future.result(timeout=timeout)
+        except Exception:
+            documents = None
+        if documents is None:
+            _record(failures=1)
+            return None
+        # the part of the retrieval that ran before the documents were asked for
+        _record(hits=1, saved_seconds=min(claimed, self.started + self.duration) - self.started)
+        return documents
+
+    def discard(self):
+        """Drop the speculation, it is cancelled if it did not start yet."""
+        _record(misses=1)
+
+        def wasted(future: Future):
+            if not future.cancelled():
+                _record(wasted_seconds=self.duration)
+
+        # a running retrieval cannot be interrupted, its time is counted once it finishes
+        self.future.cancel()
+        self.future.add_done_callback(wasted)
+
+
+class AsyncSpeculativeRetrieval:
+    """Async `SpeculativeRetrieval`, the retrieval task is cancelled when discarded."""
+
+    def __init__(self, query: str, limit: int = RETRIEVAL_LIMIT):
+        self.query = query
+        self.limit = limit
+        self.started = time.perf_counter()
+        self.duration: Optional[float] = None
+        _record(launched=1)
+        self.task = asyncio.create_task(self._retrieve())
+
+    async def _retrieve(self) -> Optional[List[str]]:
+        try:
+            return await async_get_documents(query=self.query, limit=self.limit)
+        except Exception:
+            return None
+        finally:
+            self.duration = time.perf_counter() - self.started
+
+    async def claim(self) -> Optional[List[str]]:
+        """Get the documents, None if the retrieval failed and has to be run again."""
+        claimed = time.perf_counter()
+        documents = await self.task
+        if documents is None:
+            _record(failures=1)
+            return None
+        _record(hits=1, saved_seconds=min(claimed, self.started + self.duration) - self.started)
+        return documents
+
+    def discard(self):
+        """Drop the speculation, cancelling the retrieval if it is still running."""
+        if self.task.done():
+            wasted = self.duration or 0.0
+        else:
+            # the time spent until the cancellation
+            wasted = time.perf_counter() - self.started
+            self.task.cancel()
+        _record(misses=1, wasted_seconds=wasted)
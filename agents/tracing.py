@@ -0,0 +1,354 @@
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional
+from agents.embedding_cache import CACHE_DIR
+import contextvars
+import functools
+import threading
+import inspect
+import asyncio
+import logging
+import secrets
+import json
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+# finished spans are appended to this file, one JSON object per line, empty to disable
+TRACE_FILE = os.getenv("TRACE_FILE", os.path.join(CACHE_DIR, "traces.jsonl"))
+# port of the metrics endpoint, started by `serve_metrics`
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+# durations kept per stage for the percentiles
+METRICS_WINDOW = 2048
+RECENT_SPANS = 1000
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Span:
+    """A timed call, with the tokens it used and the HTTP requests it sent."""
+
+    def __init__(self, name: str, parent: Optional["Span"] = None, **attributes: Any):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else secrets.token_hex(8)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.status = "ok"
+        self.error: Optional[str] = None
+        self.attempt = _attempt.get()
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.attributes = attributes
+
+    def set(self, **attributes: Any):
+        self.attributes.update(attributes)
+
+    def add_usage(self, prompt_tokens: Optional[int] = 0, completion_tokens: Optional[int] = 0):
+        self.prompt_tokens += prompt_tokens or 0
+        self.completion_tokens += completion_tokens or 0
+
+    def fail(self, error: BaseException):
+        self.status = "cancelled" if isinstance(error, (asyncio.CancelledError, GeneratorExit)) else "error"
+        self.error = f"{type(error).__name__}: {error}"
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+        metrics.record(self)
+        _export(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "started_at": self.started_at,
+            "duration": self.duration,
+            "status": self.status,
+            "error": self.error,
+            "attempt": self.attempt,
+            "requests": self.requests,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "attributes": self.attributes,
+        }
+
+
+_current: "contextvars.ContextVar[Optional[Span]]" = contextvars.ContextVar("span", default=None)
+_attempt: "contextvars.ContextVar[int]" = contextvars.ContextVar("attempt", default=1)
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span]:
+    """Time the enclosed block as a child of the current span."""
+    current = Span(name, _current.get(), **attributes)
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.fail(e)
+        raise
+    finally:
+        _current.reset(token)
+        current.finish()
+
+
+@contextmanager
+def attempt(number: int) -> Iterator[None]:
+    """Mark the spans started in the block with the retry attempt they belong to."""
+    token = _attempt.set(number)
+    try:
+        yield
+    finally:
+        _attempt.reset(token)
+
+
+def record_usage(response: Any):
+    """Add the token usage of a provider response to the current span."""
+    current = _current.get()
+    usage = getattr(response, "usage", None)
+    if current is not None and usage is not None:
+        current.add_usage(getattr(usage, "prompt_tokens", 0), getattr(usage, "completion_tokens", 0))
+
+
+def record_tokens(prompt_tokens: int, completion_tokens: int):
+    """Add token counts to the current span."""
+    current = _current.get()
+    if current is not None:
+        current.add_usage(prompt_tokens, completion_tokens)
+
+
+def count_request(request):
+    """httpx request hook, counts the requests of the current span, retries included."""
+    current = _current.get()
+    if current is not None:
+        current.requests += 1
+
+
+async def async_count_request(request):
+    count_request(request)
+
+
+def propagate(func: Callable) -> Callable:
+    """Run `func` in a copy of the current context, so spans it starts in a thread pool keep their parent."""
+    context = contextvars.copy_context()
+    return functools.partial(context.run, func)
+
+
+def traced(name: str, **attributes: Any) -> Callable:
+    """Record every call of the decorated function as a span named `name`.
+
+    Generators are timed from their first item to their exhaustion, with the time to the first item
+    in the "first_item" attribute.
+    """
+    def decorator(func: Callable) -> Callable:
+        if inspect.isasyncgenfunction(func):
+            @functools.wraps(func)
+            async def async_generator_wrapper(*args, **kwargs):
+                current = Span(name, _current.get(), **attributes)
+                items = func(*args, **kwargs)
+                try:
+                    while True:
+                        # the span is current only while the generator runs, not while the caller does
+                        token = _current.set(current)
+                        try:
+                            item = await items.__anext__()
+                        except StopAsyncIteration:
+                            break
+                        finally:
+                            _current.reset(token)
+                        current.attributes.setdefault("first_item", time.perf_counter() - current.started)
+                        yield item
+                except BaseException as e:
+                    current.fail(e)
+                    raise
+                finally:
+                    current.finish()
+            return async_generator_wrapper
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name, **attributes):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                current = Span(name, _current.get(), **attributes)
+                items = func(*args, **kwargs)
+                try:
+                    while True:
+                        token = _current.set(current)
+                        try:
+                            item = next(items)
+                        except StopIteration:
+                            break
+                        finally:
+                            _current.reset(token)
+                        current.attributes.setdefault("first_item", time.perf_counter() - current.started)
+                        yield item
+                except BaseException as e:
+                    current.fail(e)
+                    raise
+                finally:
+                    current.finish()
+            return generator_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, **attributes):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class UsageRecordingStore:
+    """ell store forwarding every call to `store`, adding the token usage of the LMP calls to the current span.
+
+    ell writes an invocation right after the model call, in the caller's context, so the usage ell
+    parsed from the response lands on the span of the LMP.
+    """
+
+    def __init__(self, store):
+        self._store = store
+
+    def __getattr__(self, name: str):
+        return getattr(self._store, name)
+
+    def write_invocation(self, invocation, consumes):
+        record_tokens(invocation.prompt_tokens or 0, invocation.completion_tokens or 0)
+        return self._store.write_invocation(invocation, consumes)
+
+
+def _quantile(durations: List[float], q: float) -> float:
+    return durations[min(len(durations) - 1, int(len(durations) * q))] if durations else 0.0
+
+
+class StageMetrics:
+    """Counts, errors, tokens and latency percentiles of every span name, with the count per attempt."""
+
+    def __init__(self, window: int = METRICS_WINDOW, recent: int = RECENT_SPANS):
+        self.window = window
+        self._stages: Dict[str, Dict[str, Any]] = {}
+        self.recent: "deque[Dict[str, Any]]" = deque(maxlen=recent)
+        self._lock = threading.Lock()
+
+    def record(self, span: Span):
+        with self._lock:
+            stage = self._stages.get(span.name)
+            if stage is None:
+                stage = self._stages[span.name] = {
+                    "count": 0, "errors": 0, "seconds": 0.0, "requests": 0,
+                    "prompt_tokens": 0, "completion_tokens": 0, "attempts": {}, "durations": deque(maxlen=self.window),
+                }
+            stage["count"] += 1
+            stage["attempts"][span.attempt] = stage["attempts"].get(span.attempt, 0) + 1
+            stage["errors"] += span.status == "error"
+            stage["seconds"] += span.duration
+            stage["requests"] += span.requests
+            stage["prompt_tokens"] += span.prompt_tokens
+            stage["completion_tokens"] += span.completion_tokens
+            stage["durations"].append(span.duration)
+            self.recent.append(span.to_dict())
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """The totals of every stage with the p50, p95 and p99 of its recent durations in seconds."""
+        with self._lock:
+            stages = {name: dict(stage, attempts=dict(stage["attempts"]), durations=sorted(stage["durations"])) for name, stage in self._stages.items()}
+        report = {}
+        for name, stage in stages.items():
+            durations = stage.pop("durations")
+            for q in QUANTILES:
+                stage[f"p{int(q * 100)}"] = _quantile(durations, q)
+            report[name] = stage
+        return report
+
+    def prometheus(self) -> str:
+        """The snapshot in the Prometheus text exposition format."""
+        lines = [
+            "# TYPE podcast_stage_duration_seconds summary",
+        ]
+        snapshot = self.snapshot()
+        for name, stage in sorted(snapshot.items()):
+            for q in QUANTILES:
+                lines.append(f'podcast_stage_duration_seconds{{stage="{name}",quantile="{q}"}} {stage[f"p{int(q * 100)}"]:.6f}')
+            lines.append(f'podcast_stage_duration_seconds_sum{{stage="{name}"}} {stage["seconds"]:.6f}')
+            lines.append(f'podcast_stage_duration_seconds_count{{stage="{name}"}} {stage["count"]}')
+        for metric, key in (("errors", "errors"), ("requests", "requests")):
+            lines.append(f"# TYPE podcast_stage_{metric}_total counter")
+            lines.extend(f'podcast_stage_{metric}_total{{stage="{name}"}} {stage[key]}' for name, stage in sorted(snapshot.items()))
+        lines.append("# TYPE podcast_stage_tokens_total counter")
+        for name, stage in sorted(snapshot.items()):
+            lines.append(f'podcast_stage_tokens_total{{stage="{name}",type="prompt"}} {stage["prompt_tokens"]}')
+            lines.append(f'podcast_stage_tokens_total{{stage="{name}",type="completion"}} {stage["completion_tokens"]}')
+        # retries and requeries of a stage, attempt 1 being the first try
+        lines.append("# TYPE podcast_stage_attempts_total counter")
+        for name, stage in sorted(snapshot.items()):
+            lines.extend(f'podcast_stage_attempts_total{{stage="{name}",attempt="{number}"}} {count}' for number, count in sorted(stage["attempts"].items()))
+        return "\n".join(lines) + "\n"
+
+
+metrics = StageMetrics()
+
+_trace_file = None
+_trace_lock = threading.Lock()
+
+
+def _export(span: Span):
+    global _trace_file
+    if not TRACE_FILE:
+        return
+    line = json.dumps(span.to_dict(), default=str)
+    with _trace_lock:
+        try:
+            if _trace_file is None:
+                directory = os.path.dirname(TRACE_FILE)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                _trace_file = open(TRACE_FILE, "a", encoding="utf-8")
+            _trace_file.write(line + "\n")
+            _trace_file.flush()
+        except OSError:
+            logger.warning("could not write the span %s to %s", span.name, TRACE_FILE, exc_info=True)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves /metrics in the Prometheus text format, /metrics.json and the recent spans at /traces."""
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = metrics.prometheus(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(metrics.snapshot()), "application/json"
+        elif self.path == "/traces":
+            body, content_type = "".join(json.dumps(span, default=str) + "\n" for span in list(metrics.recent)), "application/x-ndjson"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port: int = METRICS_PORT, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serve the metrics from a background thread."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,255 @@
+from itertools import chain
+from typing import List, Dict, Iterable, Iterator, NamedTuple, Optional
+from agents.context import encoding
+import re
+import os
+
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "500"))
+# tokens of the last turns of a chunk repeated at the start of the next one
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "60"))
+# a last chunk of a subtopic with fewer new tokens is merged into the previous chunk
+CHUNK_MIN_TOKENS = 100
+# bump when the chunks change, transcripts ingested by an older chunker are ingested again
+CHUNKER_VERSION = "2"
+
+CONTENT_MARKER = "Markdown Content:"
+HEADER_PATTERN = re.compile(r"^(?P<field>Title|URL Source|Published Time): (?P<value>.+)$")
+UNDERLINE_PATTERN = re.compile(r"^-{3,}\s*$")
+# e.g. "Ben Shapiro [(00:00:04)](https://youtube.com/watch?v=tYrdMjVXyNg&t=4) No. What has to happen..."
+TURN_PATTERN = re.compile(r"^(?P<speaker>[^\[\n]+?) \[\((?P<timestamp>\d{2}:\d{2}:\d{2})\)\]\((?P<url>[^)\s]+)\)\s*(?P<text>.*)$")
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+")
+
+HEADER_FIELDS = {"Title": "title", "URL Source": "url", "Published Time": "published"}
+
+
+class Turn(NamedTuple):
+    subtopic: str
+    speaker: str
+    timestamp: str
+    url: str
+    text: str
+
+
+class Chunk(NamedTuple):
+    """Consecutive speaker turns of a subtopic, with the time span they cover."""
+
+    title: Optional[str]
+    url: Optional[str]
+    subtopic: str
+    speakers: List[str]
+    content: str
+    start: str
+    start_url: str
+    end: str
+    end_url: str
+    token_count: int
+
+    @property
+    def timestamp(self) -> str:
+        """Markdown links to the start and the end of the chunk in the video."""
+        if self.start == self.end:
+            return f"[({self.start})]({self.start_url})"
+        return f"[({self.start})]({self.start_url}) - [({self.end})]({self.end_url})"
+
+
+class _Piece(NamedTuple):
+    turn: Turn
+    line: str
+    tokens: int
+
+
+def read_lines(path: str) -> Iterator[str]:
+    """Yield the lines of a file one at a time, without the line breaks."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            yield line.rstrip("\r\n")
+
+
+def read_header(lines: Iterator[str]) -> Dict[str, Optional[str]]:
+    """Consume the header of a transcript up to its content marker.
+
+    Returns:
+        The "title", "url" and "published" fields, None when missing.
+    """
+    header = dict.fromkeys(HEADER_FIELDS.values())
+    for line in lines:
+        if line.startswith(CONTENT_MARKER):
+            break
+        match = HEADER_PATTERN.match(line)
+        if match:
+            header[HEADER_FIELDS[match["field"]]] = match["value"].strip()
+    return header
+
+
+def iter_turns(lines: Iterable[str]) -> Iterator[Turn]:
+    """Parse the speaker turns of the content of a transcript, line by line.
+
+    A subtopic is a line underlined with dashes. Lines that are neither a turn nor a subtopic are
+    appended to the text of the turn they follow.
+    """
+    subtopic = ""
+    turn: Optional[Turn] = None
+    # a line is only known not to be a subtopic once the next line is read
+    pending: Optional[str] = None
+
+    # the empty line appended flushes the last pending line
+    for line in chain(lines, [""]):
+        if pending and UNDERLINE_PATTERN.match(line):
+            if turn is not None:
+                yield turn
+                turn = None
+            subtopic = pending.strip()
+            pending = None
+            continue
+
+        if pending:
+            match = TURN_PATTERN.match(pending)
+            if match:
+                if turn is not None:
+                    yield turn
+                turn = Turn(subtopic, match["speaker"].strip(), match["timestamp"], match["url"], match["text"].strip())
+            elif turn is not None:
+                turn = turn._replace(text=f"{turn.text} {pending.strip()}")
+        pending = line
+
+    if turn is not None:
+        yield turn
+
+
+def _line(speaker: str, text: str) -> str:
+    return f"{speaker}: {text} \n"
+
+
+def _pieces(turn: Turn, max_tokens: int) -> Iterator[_Piece]:
+    # a turn longer than a chunk is split between sentences, a sentence longer than a chunk between tokens
+    enc = encoding()
+    line = _line(turn.speaker, turn.text)
+    tokens = len(enc.encode(line, disallowed_special=()))
+    if tokens <= max_tokens:
+        yield _Piece(turn, line, tokens)
+        return
+
+    sentences = []
+    for sentence in SENTENCE_PATTERN.split(turn.text):
+        encoded = enc.encode(sentence, disallowed_special=())
+        sentences.extend(enc.decode(encoded[start:start + max_tokens]) for start in range(0, len(encoded), max_tokens))
+
+    text, used = [], 0
+    for sentence in sentences:
+        size = len(enc.encode(sentence + " ", disallowed_special=()))
+        if text and used + size > max_tokens:
+            line = _line(turn.speaker, " ".join(text))
+            yield _Piece(turn, line, len(enc.encode(line, disallowed_special=())))
+            text, used = [], 0
+        text.append(sentence)
+        used += size
+    if text:
+        line = _line(turn.speaker, " ".join(text))
+        yield _Piece(turn, line, len(enc.encode(line, disallowed_special=())))
+
+
+def _chunk(pieces: List[_Piece], title: Optional[str], url: Optional[str]) -> Chunk:
+    speakers = []
+    for piece in pieces:
+        if piece.turn.speaker not in speakers:
+            speakers.append(piece.turn.speaker)
+    first, last = pieces[0].turn, pieces[-1].turn
+    return Chunk(
+        title=title,
+        url=url,
+        subtopic=first.subtopic,
+        speakers=speakers,
+        content="".join(piece.line for piece in pieces),
+        start=first.timestamp,
+        start_url=first.url,
+        end=last.timestamp,
+        end_url=last.url,
+        token_count=sum(piece.tokens for piece in pieces),
+    )
+
+
+def chunk_turns(
+    turns: Iterable[Turn],
+    title: Optional[str] = None,
+    url: Optional[str] = None,
+    max_tokens: int = CHUNK_MAX_TOKENS,
+    overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+    min_tokens: int = CHUNK_MIN_TOKENS,
+) -> Iterator[Chunk]:
+    """Group consecutive turns of a subtopic into chunks of at most `max_tokens` tokens.
+
+    Chunks end between turns, a chunk starts with the last turns of the previous chunk of the same
+    subtopic that fit in `overlap_tokens`. Only a turn longer than a whole chunk is split.
+
+    Args:
+        turns: The turns of a transcript, in order.
+        title: The title of the transcript.
+        url: The URL of the transcript.
+        max_tokens: The maximum number of tokens of a chunk.
+        overlap_tokens: The maximum number of tokens repeated from the previous chunk.
+        min_tokens: The minimum number of new tokens of the last chunk of a subtopic.
+
+    Returns:
+        An iterator over the chunks, in order.
+    """
+    window: List[_Piece] = []
+    window_tokens = 0
+    # the pieces of the window repeated from the previous chunk
+    overlap = 0
+    # the last chunk is held back until the next one is known to be large enough
+    previous: Optional[List[_Piece]] = None
+
+    def close_subtopic():
+        nonlocal previous
+        fresh = window[overlap:]
+        if previous is not None and fresh and sum(piece.tokens for piece in fresh) < min_tokens:
+            yield _chunk(previous + fresh, title, url)
+        else:
+            if previous is not None:
+                yield _chunk(previous, title, url)
+            if fresh:
+                yield _chunk(window, title, url)
+        previous = None
+
+    for turn in turns:
+        if window and turn.subtopic != window[0].turn.subtopic:
+            yield from close_subtopic()
+            window, window_tokens, overlap = [], 0, 0
+
+        for piece in _pieces(turn, max_tokens):
+            if window and window_tokens + piece.tokens > max_tokens:
+                if previous is not None:
+                    yield _chunk(previous, title, url)
+                previous = window
+                # the trailing pieces fitting in the overlap, never the whole chunk
+                tail, used = [], 0
+                for p in reversed(window[1:]):
+                    if used + p.tokens > overlap_tokens:
+                        break
+                    tail.insert(0, p)
+                    used += p.tokens
+                window, window_tokens, overlap = tail, used, len(tail)
+            window.append(piece)
+            window_tokens += piece.tokens
+
+    if window:
+        yield from close_subtopic()
+
+
+def iter_chunks(path: str, max_tokens: int = CHUNK_MAX_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> Iterator[Chunk]:
+    """Parse and chunk a transcript file, reading it line by line."""
+    lines = read_lines(path)
+    header = read_header(lines)
+    yield from chunk_turns(iter_turns(lines), title=header["title"], url=header["url"], max_tokens=max_tokens, overlap_tokens=overlap_tokens)
+
+
+def batched(chunks: Iterable[Chunk], size: int) -> Iterator[List[Chunk]]:
+    """Group chunks into lists of `size` for batched embedding."""
+    batch = []
+    for chunk in chunks:
+        batch.append(chunk)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
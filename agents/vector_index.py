@@ -0,0 +1,341 @@
+from typing import List, Dict, Optional, Iterable, NamedTuple, Any
+from agents.embedding_cache import CACHE_DIR
+from agents.bm25 import BM25Index
+import numpy as np
+import threading
+import shutil
+import json
+import re
+import os
+
+INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", os.path.join(CACHE_DIR, "index"))
+# payload fields that can be used in `must` filters
+FILTER_FIELDS = ("subtopic", "speakers", "title")
+# "none" searches the float32 vectors, "int8" and "binary" search a quantized copy first
+# and rescore only the best candidates with the float32 vectors
+QUANTIZATION = os.getenv("VECTOR_QUANTIZATION", "none")
+QUANTIZATIONS = ("none", "int8", "binary")
+# candidates rescored per requested result when searching a quantized index
+RESCORE_OVERSAMPLING = int(os.getenv("RESCORE_OVERSAMPLING", "4"))
+# rows converted to float32 at a time when scoring int8 vectors
+SCORE_BLOCK_ROWS = 256
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+class SearchHit(NamedTuple):
+    id: Any
+    score: float
+    payload: Dict
+
+
+def index_path(collection_name: str, directory: str = INDEX_DIR) -> str:
+    return os.path.join(directory, collection_name)
+
+
+def has_lexical_index(collection_name: str, directory: str = INDEX_DIR) -> bool:
+    return os.path.exists(os.path.join(index_path(collection_name, directory), "bm25.json"))
+
+
+def index_version(path: str) -> int:
+    return os.stat(os.path.join(path, "points.json")).st_mtime_ns
+
+
+def _values(value) -> List[str]:
+    if value is None:
+        return []
+    return [str(item) for item in value] if isinstance(value, list) else [str(value)]
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.casefold())
+
+
+def quantize_int8(matrix: np.ndarray):
+    """Symmetric int8 codes of the rows of a matrix with the scale of every row."""
+    scales = np.abs(matrix).max(axis=1, initial=0) / 127
+    scales[scales == 0] = 1
+    codes = np.round(matrix / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def quantize_binary(matrix: np.ndarray) -> np.ndarray:
+    """Sign bits of the rows of a matrix, packed 8 dimensions per byte."""
+    return np.packbits(matrix > 0, axis=-1)
+
+
+def _save_array(directory: str, name: str, array: np.ndarray):
+    mapped = np.lib.format.open_memmap(os.path.join(directory, name), mode="w+", dtype=array.dtype, shape=array.shape)
+    mapped[:] = array
+    mapped.flush()
+    del mapped
+
+
+def build_index(
+    collection_name: str,
+    ids: List[Any],
+    vectors: Iterable[List[float]],
+    payloads: List[Dict],
+    directory: str = INDEX_DIR,
+    quantization: str = QUANTIZATION,
+) -> str:
+    """Write a local index of a collection.
+
+    The index is a directory holding the normalized vectors as a float32 matrix, their quantized copy,
+    the payloads, one packed bitmap per value of the filter fields and the BM25 index of the contents.
+    It is written next to the live index and swapped in.
+
+    Args:
+        collection_name: The name of the collection.
+        ids: The point ids.
+        vectors: The point vectors, in the order of the ids.
+        payloads: The point payloads, in the order of the ids.
+        directory: The directory containing the indexes.
+        quantization: "none", "int8" or "binary".
+
+    Returns:
+        The path of the index.
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization: {quantization}")
+
+    path = index_path(collection_name, directory)
+    staging = path + ".tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    # an empty collection has no vector giving the dimension, its index matches nothing
+    matrix = np.asarray(list(vectors), dtype=np.float32).reshape(len(ids), -1) if ids else np.zeros((0, 0), dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.where(norms == 0, 1, norms)
+    _save_array(staging, "vectors.npy", matrix)
+    if quantization == "int8":
+        codes, scales = quantize_int8(matrix)
+        _save_array(staging, "vectors.int8.npy", codes)
+        _save_array(staging, "scales.npy", scales)
+    elif quantization == "binary":
+        _save_array(staging, "vectors.bits.npy", quantize_binary(matrix))
+    with open(os.path.join(staging, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"count": len(ids), "dim": matrix.shape[1], "quantization": quantization}, f)
+
+    rows, bitmaps = {}, []
+    for field in FILTER_FIELDS:
+        masks: Dict[str, np.ndarray] = {}
+        for position, payload in enumerate(payloads):
+            for value in _values(payload.get(field)):
+                masks.setdefault(value, np.zeros(len(ids), dtype=bool))[position] = True
+        rows[field] = {}
+        for value, mask in sorted(masks.items()):
+            rows[field][value] = len(bitmaps)
+            bitmaps.append(np.packbits(mask))
+    np.save(os.path.join(staging, "filters.npy"), np.asarray(bitmaps, dtype=np.uint8).reshape(len(bitmaps), (len(ids) + 7) // 8))
+
+    with open(os.path.join(staging, "filters.json"), "w", encoding="utf-8") as f:
+        json.dump(rows, f, ensure_ascii=False)
+    with open(os.path.join(staging, "points.json"), "w", encoding="utf-8") as f:
+        json.dump({"ids": [str(point_id) for point_id in ids], "payloads": payloads}, f, ensure_ascii=False)
+    BM25Index.build([payload.get("content") or "" for payload in payloads]).save(staging)
+
+    # swap the new index in, processes holding the old files keep reading them until they reload
+    previous = path + ".old"
+    shutil.rmtree(previous, ignore_errors=True)
+    if os.path.exists(path):
+        os.replace(path, previous)
+    os.replace(staging, path)
+    shutil.rmtree(previous, ignore_errors=True)
+    return path
+
+
+def export_collection(client, collection_name: str, directory: str = INDEX_DIR, batch_size: int = 256, quantization: str = QUANTIZATION) -> str:
+    """Build the local index of a Qdrant collection from its points."""
+    ids, vectors, payloads = [], [], []
+    offset = None
+    while True:
+        points, offset = client.scroll(collection_name=collection_name, limit=batch_size, offset=offset, with_payload=True, with_vectors=True)
+        for point in points:
+            ids.append(point.id)
+            vectors.append(point.vector)
+            payloads.append(point.payload)
+        if offset is None:
+            break
+    return build_index(collection_name, ids, vectors, payloads, directory, quantization)
+
+
+class NumpyVectorIndex:
+    """In-process search over a memory-mapped float32 matrix.
+
+    The matrices are opened read-only with mmap, so every worker process on the host shares the same pages.
+    The search is exact, unless the index was built quantized: the quantized vectors are then scanned and
+    only the rows of the best candidates are read from the float32 matrix to rescore them.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # the build the index was opened from, `open_index` reopens it once the index is rebuilt
+        self.version = index_version(path)
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.bitmaps = np.load(os.path.join(path, "filters.npy"), mmap_mode="r")
+        try:
+            with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+                self.quantization = json.load(f)["quantization"]
+        except FileNotFoundError:
+            self.quantization = "none"
+        if self.quantization == "int8":
+            self.codes = np.load(os.path.join(path, "vectors.int8.npy"), mmap_mode="r")
+            self.scales = np.load(os.path.join(path, "scales.npy"), mmap_mode="r")
+        elif self.quantization == "binary":
+            self.bits = np.load(os.path.join(path, "vectors.bits.npy"), mmap_mode="r")
+        with open(os.path.join(path, "filters.json"), "r", encoding="utf-8") as f:
+            self.rows: Dict[str, Dict[str, int]] = json.load(f)
+        with open(os.path.join(path, "points.json"), "r", encoding="utf-8") as f:
+            points = json.load(f)
+        self.ids: List[str] = points["ids"]
+        self.payloads: List[Dict] = points["payloads"]
+        self._tokens: Optional[List[set]] = None
+        self._bm25: Optional[BM25Index] = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _bitmap(self, field: str, values: List[str]) -> np.ndarray:
+        rows = [self.rows.get(field, {}).get(value) for value in values]
+        rows = [row for row in rows if row is not None]
+        if not rows:
+            return np.zeros(len(self), dtype=bool)
+        packed = np.bitwise_or.reduce(self.bitmaps[rows], axis=0)
+        return np.unpackbits(packed, count=len(self)).astype(bool)
+
+    def _text_mask(self, terms: List[str]) -> np.ndarray:
+        # a term matches a chunk when all of its tokens are in the chunk, like a Qdrant full-text match
+        if self._tokens is None:
+            self._tokens = [set(tokenize(str(payload.get("content") or ""))) for payload in self.payloads]
+        mask = np.zeros(len(self), dtype=bool)
+        for term in terms:
+            tokens = set(tokenize(term))
+            if tokens:
+                mask |= np.fromiter((tokens <= chunk for chunk in self._tokens), dtype=bool, count=len(self))
+        return mask
+
+    def filter_mask(self, must: Optional[Dict[str, List[str]]] = None, should: Optional[List[str]] = None) -> Optional[np.ndarray]:
+        """Mask of the points matching every `must` field (any of its values) and at least one `should` term."""
+        mask = None
+        for field, values in (must or {}).items():
+            if field not in FILTER_FIELDS:
+                raise ValueError(f"{field} is not a filter field of the index")
+            field_mask = self._bitmap(field, _values(values))
+            mask = field_mask if mask is None else mask & field_mask
+        if should:
+            text_mask = self._text_mask(should)
+            mask = text_mask if mask is None else mask & text_mask
+        return mask
+
+    def approximate_scores(self, query: np.ndarray) -> np.ndarray:
+        """Scores of every point computed on the quantized vectors, only their order is meaningful."""
+        if self.quantization == "int8":
+            scores = np.empty(len(self), dtype=np.float32)
+            for start in range(0, len(self), SCORE_BLOCK_ROWS):
+                block = self.codes[start:start + SCORE_BLOCK_ROWS]
+                scores[start:start + len(block)] = block.astype(np.float32) @ query
+            return scores * self.scales
+        if self.quantization == "binary":
+            distances = np.bitwise_count(self.bits ^ quantize_binary(query)).sum(axis=1, dtype=np.int32)
+            return -distances.astype(np.float32)
+        return self.vectors @ query
+
+    @staticmethod
+    def _top(scores: np.ndarray, limit: int) -> np.ndarray:
+        limit = min(limit, len(scores))
+        if limit <= 0:
+            return np.zeros(0, dtype=np.int64)
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top])]
+        return top[np.isfinite(scores[top])]
+
+    def search(
+        self,
+        vector: List[float],
+        limit: int = 5,
+        must: Optional[Dict[str, List[str]]] = None,
+        should: Optional[List[str]] = None,
+        score_threshold: Optional[float] = None,
+        exact: bool = False,
+    ) -> List[SearchHit]:
+        """Get the top `limit` points by cosine similarity, `exact` skips the quantized vectors."""
+        if not len(self):
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        query = query / norm if norm else query
+        mask = self.filter_mask(must, should)
+
+        if exact or self.quantization == "none":
+            candidates = np.arange(len(self))
+            scores = self.vectors @ query
+        else:
+            approximate = self.approximate_scores(query)
+            if mask is not None:
+                approximate = np.where(mask, approximate, -np.inf)
+            candidates = np.sort(self._top(approximate, limit * RESCORE_OVERSAMPLING))
+            scores = self.vectors[candidates] @ query
+            mask = None if mask is None else mask[candidates]
+
+        if mask is not None:
+            scores = np.where(mask, scores, -np.inf)
+        if score_threshold is not None:
+            scores = np.where(scores >= score_threshold, scores, -np.inf)
+
+        top = self._top(scores, limit)
+        return [SearchHit(self.ids[candidates[i]], float(scores[i]), self.payloads[candidates[i]]) for i in top]
+
+    def memory_usage(self) -> Dict[str, int]:
+        """Bytes of the float32 vectors and of their quantized copy."""
+        usage = {"float32": self.vectors.nbytes, "quantized": 0}
+        if self.quantization == "int8":
+            usage["quantized"] = self.codes.nbytes + self.scales.nbytes
+        elif self.quantization == "binary":
+            usage["quantized"] = self.bits.nbytes
+        return usage
+
+    def recall(self, k: int = 10, queries: int = 100, seed: int = 0) -> float:
+        """Recall@k of the quantized search against the exact search.
+
+        The queries are stored vectors with gaussian noise, so they are not trivially their own nearest point.
+        """
+        rng = np.random.default_rng(seed)
+        sample = rng.choice(len(self), size=min(queries, len(self)), replace=False)
+        found = 0
+        for row in sample:
+            query = self.vectors[row] + rng.normal(0, 0.5 / np.sqrt(self.vectors.shape[1]), self.vectors.shape[1]).astype(np.float32)
+            expected = {hit.id for hit in self.search(query, limit=k, exact=True)}
+            found += len(expected & {hit.id for hit in self.search(query, limit=k)})
+        return found / (len(sample) * min(k, len(self))) if len(sample) else 1.0
+
+    def quantization_report(self, k: int = 10) -> Dict[str, Any]:
+        usage = self.memory_usage()
+        return {"quantization": self.quantization, "float32_bytes": usage["float32"], "quantized_bytes": usage["quantized"], f"recall@{k}": self.recall(k)}
+
+    @property
+    def bm25(self) -> BM25Index:
+        if self._bm25 is None:
+            self._bm25 = BM25Index.load(self.path)
+        return self._bm25
+
+    def lexical_search(self, query: str, limit: int = 5, must: Optional[Dict[str, List[str]]] = None) -> List[SearchHit]:
+        """Get the top `limit` points by the BM25 score of their content."""
+        hits = self.bm25.search(query, limit=limit, mask=self.filter_mask(must))
+        return [SearchHit(self.ids[i], score, self.payloads[i]) for i, score in hits]
+
+
+_indexes: Dict[str, NumpyVectorIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def open_index(collection_name: str, directory: str = INDEX_DIR) -> NumpyVectorIndex:
+    """Get the local index of a collection, reopened when it was rebuilt."""
+    path = index_path(collection_name, directory)
+    version = index_version(path)
+    with _indexes_lock:
+        index = _indexes.get(path)
+        if index is None or index.version != version:
+            index = _indexes[path] = NumpyVectorIndex(path)
+        return index
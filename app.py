@@ -1,8 +1,29 @@
+import time
+# the agents import the provider SDKs and ell, the slowest part of a cold start
+_imports_started = time.perf_counter()
 import streamlit as st
-from agents.entry import chatbot_entry
-from agents.memory_db import get_memory, delete_session, add_memory, create_session, summarize_conversation, SESSION_ID
-from agents.podcast_agent import execute_rag_response
+from agents.clients import record_timing, warmup
+from agents.entry import CHATBOT_ENTRY_MODEL
+from agents.router import async_route
+from agents.context import pack_history
+from agents.memory_db import create_session, SESSION_ID
+from agents.memory_manager import MemoryManager
+from agents.podcast_agent import async_execute_rag_response, async_stream_rag_response
+from agents.response_cache import async_lookup_response, async_store_response
+from agents.speculation import AsyncSpeculativeRetrieval, SPECULATIVE_RETRIEVAL
+from agents.tracing import serve_metrics, METRICS_PORT
 from ell import Message
+import logging
+import asyncio
+import os
+
+record_timing("imports", time.perf_counter() - _imports_started)
+logger = logging.getLogger(__name__)
+
+# render RAG answers token by token, the graders run once the answer is complete
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "true").lower() == "true"
+# serve the per-stage latency, token and retry metrics of the traced calls on METRICS_PORT
+SERVE_METRICS = os.getenv("SERVE_METRICS", "true").lower() == "true"
 
 
 st.set_page_config(
@@ -14,6 +35,40 @@ st.set_page_config(
 
 st.title("podcast chat")
 
+
+@st.cache_resource
+def start_clients():
+    # connect to the providers while the first page renders, once per process
+    started = warmup()
+    started.add_done_callback(lambda future: logger.info("startup timings: %s", future.result()))
+    return started
+
+
+start_clients()
+
+
+@st.cache_resource
+def start_metrics():
+    try:
+        return serve_metrics(METRICS_PORT)
+    except OSError as e:
+        # e.g. another app process already serves the metrics
+        logger.warning("could not serve the metrics on port %d: %s", METRICS_PORT, e)
+        return None
+
+
+if SERVE_METRICS:
+    start_metrics()
+
+
+@st.cache_resource
+def get_memory_manager() -> MemoryManager:
+    # shared by the reruns and sessions of the app, its writer thread outlives a rerun
+    return MemoryManager()
+
+
+memory_manager = get_memory_manager()
+
 if "session_active" not in st.session_state:
     st.session_state.session_active = False
 
@@ -26,7 +81,7 @@ def handle_create_session():
     ]
 
 def handle_delete_session():
-    delete_session(SESSION_ID)
+    memory_manager.delete_session(SESSION_ID)
     st.session_state.session_active = False
     st.session_state.history = []
     st.session_state.messages = []
@@ -38,6 +93,12 @@ with st.expander("session"):
 
 
 if st.session_state.session_active:
+    def remember(prompt: str, answer: str):
+        # the turn is written to Zep and the answer summarized in the background,
+        # the history keeps the full answer until its summary is ready
+        st.session_state.history.append(Message(role="assistant", content=answer))
+        memory_manager.record_turn(SESSION_ID, prompt, answer)
+
     async def main():
 
         for message in st.session_state.messages:
@@ -50,52 +111,93 @@ if st.session_state.session_active:
 
             with st.chat_message("user"):
                 st.markdown(prompt)
-        
-        try:
-            facts = get_memory(session_id=SESSION_ID)
-            fact_content = ("\n ").join([fact for fact in facts.facts])
-        except Exception as e:
-            fact_content = "No facts available"
+
+        if st.session_state.messages[-1].role == "assistant":
+            return
+
+        # a similar question may have been answered before, then routing and retrieval are skipped
+        fact_content = memory_manager.facts(SESSION_ID)
+        cached = await async_lookup_response(prompt)
 
         if len(st.session_state.messages) > 20:
-            combined_history = st.session_state.history[:-20] + st.session_state.messages[-20:]
+            summarized = [memory_manager.summarized(message) for message in st.session_state.history[:-20]]
+            combined_history = summarized + st.session_state.messages[-20:]
         else:
             combined_history = st.session_state.messages
+        # the most recent messages fitting in the history token budget of the router
+        combined_history = pack_history(combined_history, model=CHATBOT_ENTRY_MODEL)
 
-        if st.session_state.messages[-1].role != "assistant":
+        if cached is not None:
             with st.chat_message("assistant"):
-                with st.spinner("Thinking..."):
-                    response = chatbot_entry(
+                st.markdown(cached["response"])
+            st.session_state.messages.append(Message(role="assistant", content=cached["response"]))
+            remember(prompt, cached["response"])
+            return
+
+        streamed = None
+        documents = None
+        with st.chat_message("assistant"):
+            with st.spinner("Thinking..."):
+                # retrieve the documents of the prompt while the router decides whether they are needed
+                speculation = AsyncSpeculativeRetrieval(prompt) if SPECULATIVE_RETRIEVAL else None
+                response = await async_route(
+                    query=prompt,
+                    history=combined_history,
+                    facts=fact_content,
+                )
+                use_rag = str(response.use_rag).lower() == "true"
+                if speculation is not None:
+                    if use_rag:
+                        documents = await speculation.claim()
+                    else:
+                        speculation.discard()
+                if use_rag and STREAM_RESPONSES:
+                    streamed = await async_stream_rag_response(
+                        query=prompt,
+                        user_intent=response.user_intent,
+                        output_emotion=response.output_emotion,
+                        history=fact_content,
+                        documents=documents,
+                    )
+                if use_rag and streamed is None:
+                    rag_response = await async_execute_rag_response(
                         query=prompt,
-                        history=combined_history,
-                        facts=fact_content,
+                        user_intent=response.user_intent,
+                        output_emotion=response.output_emotion,
+                        history=fact_content,
+                        documents=documents,
                     )
-                    if str(response.content[-1].parsed.use_rag).lower() == "true":
-                        rag_response = execute_rag_response(
+            if streamed is not None:
+                # render the tokens as they arrive, the answer is graded once complete, like in server.py
+                placeholder = st.empty()
+                async for _ in streamed:
+                    placeholder.markdown(streamed.text + "▌")
+                rag_response = streamed.text
+                placeholder.markdown(rag_response)
+                if await streamed.is_valid():
+                    # an answer the graders could not check is shown but not cached
+                    if streamed.graded:
+                        await async_store_response(prompt, rag_response, history=fact_content)
+                else:
+                    with st.spinner("Let me double check that..."):
+                        rag_response = await async_execute_rag_response(
                             query=prompt,
-                            user_intent=response.content[-1].parsed.user_intent,
-                            output_emotion=response.content[-1].parsed.output_emotion,
+                            user_intent=response.user_intent,
+                            output_emotion=response.output_emotion,
                             history=fact_content,
+                            use_cache=False,
+                            documents=documents,
                         )
-            if str(response.content[-1].parsed.use_rag).lower() != "true":
-                st.markdown(response.content[-1].parsed.answer)
-                add_memory(
-                    session_id=SESSION_ID,
-                    user_content=str(prompt),
-                    assistent_content=str(response.content[-1].parsed.answer),
-                )
-                st.session_state.messages.append(Message(role="assistant", content=response.content[-1].parsed.answer))
-            else:
+                    placeholder.markdown(rag_response)
+        if not use_rag:
+            st.markdown(response.answer)
+            st.session_state.messages.append(Message(role="assistant", content=response.answer))
+        else:
+            if streamed is None:
                 st.markdown(rag_response)
-                add_memory(
-                    session_id=SESSION_ID,
-                    user_content=str(prompt),
-                    assistent_content=str(rag_response),
-                )
-                st.session_state.messages.append(Message(role="assistant", content=rag_response))
-            assistant_message = st.session_state.messages[-1].content[-1].text
-            summary = summarize_conversation(conversation=assistant_message)
-            st.session_state.history.append(Message(role="assistant", content=summary))
+            st.session_state.messages.append(Message(role="assistant", content=rag_response))
+        assistant_message = st.session_state.messages[-1].content[-1].text
+        remember(prompt, assistant_message)
 
 else:
     async def main():
@@ -103,5 +205,4 @@ else:
 
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main())
@@ -0,0 +1,176 @@
+from typing import Callable, Dict, List, Any
+import tracemalloc
+import statistics
+import argparse
+import tempfile
+import hashlib
+import json
+import time
+import sys
+import os
+
+# the agents modules read the API keys at import, the clients are only created on first use and none is called here
+for key in ("OPENAI_API_KEY", "GROQ_API_KEY", "ZEP_API_KEY", "COHERE_API_KEY", "QDRANT_CLOUD_API_KEY"):
+    os.environ.setdefault(key, "benchmark")
+# the local vector index is built in a scratch directory
+os.environ.setdefault("VECTOR_INDEX_DIR", tempfile.mkdtemp(prefix="benchmark-index-"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from qdrant_client import QdrantClient
+from qdrant_client.http import models
+from agents import rag_db, ingest, vector_index, transcripts, clients, context
+from agents.keywords import KeywordExtractor, build_keyword_index, terms_from_index
+
+COLLECTION_NAME = "podcasts"
+
+QUERIES = [
+    "What does Elon Musk think about the war in Ukraine?",
+    "Is Israel doing the correct thing attacking Gaza?",
+    "What did Yann LeCun say about open source AI and Llama?",
+    "How did Sam Altman describe the OpenAI board saga?",
+    "What is the podcast about?",
+]
+
+
+def fake_embedding(text: str) -> List[float]:
+    """Deterministic unit vector standing in for text-embedding-3-small."""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(rag_db.VECTOR_SIZE).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def setup_offline_providers() -> Dict[str, Any]:
+    """Point rag_db at an in-memory Qdrant loaded with the corpus, with fake embeddings and local entities."""
+    client = QdrantClient(":memory:")
+    clients.set_client("qdrant", client)
+    rag_db.get_embedding = fake_embedding
+
+    extractor = KeywordExtractor(terms_from_index(build_keyword_index(path=None)))
+    rag_db.get_entities = extractor.extract
+
+    ingest.create_collections(COLLECTION_NAME, rag_db.VECTOR_SIZE)
+    paths = ingest.transcript_paths(ingest.DATA_DIR)
+    chunks = [chunk for path in paths for chunk in transcripts.iter_chunks(path)]
+    client.upsert(
+        collection_name=COLLECTION_NAME,
+        points=[
+            models.PointStruct(id=ingest.chunk_id(chunk), vector=fake_embedding(chunk.content), payload=ingest.chunk_payload(chunk))
+            for chunk in chunks
+        ],
+    )
+    vector_index.export_collection(client, COLLECTION_NAME)
+    return {"paths": paths, "chunks": chunks}
+
+
+def check_encoding():
+    """Exit with a clear message when the tiktoken encoding of the chunker cannot be loaded.
+
+    tiktoken downloads its encodings on first use and caches them, offline the run would otherwise
+    die inside the chunking of the corpus.
+    """
+    try:
+        context.encoding()
+    except Exception as e:
+        sys.exit(
+            f"could not load the tiktoken encoding {context.TOKEN_COUNT_ENCODING}: {type(e).__name__}, "
+            "run once with network access to cache it, or point TIKTOKEN_CACHE_DIR at a directory holding it"
+        )
+
+
+def payload_size(result: Any) -> int:
+    return len(json.dumps(result, default=str).encode("utf-8"))
+
+
+def measure(func: Callable[[], Any], repeat: int, warmup: int = 2) -> Dict[str, float]:
+    """Latency percentiles, allocations and payload size of a benchmark case."""
+    for _ in range(warmup):
+        func()
+
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - started)
+
+    # allocations are measured on a separate run, tracing slows the code down
+    tracemalloc.start()
+    result = func()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    durations.sort()
+    return {
+        "mean_ms": statistics.fmean(durations) * 1000,
+        "p50_ms": durations[len(durations) // 2] * 1000,
+        "p95_ms": durations[min(len(durations) - 1, int(len(durations) * 0.95))] * 1000,
+        "peak_alloc_kb": peak / 1024,
+        "retained_alloc_kb": current / 1024,
+        "payload_kb": payload_size(result) / 1024,
+    }
+
+
+def cases(corpus: Dict[str, Any]) -> Dict[str, Callable[[], Any]]:
+    paths = corpus["paths"]
+    documents = rag_db.hybrid_search(collection_name=COLLECTION_NAME, query=QUERIES[0], limit=10)
+
+    return {
+        "parse_transcripts": lambda: [list(transcripts.iter_turns(transcripts.read_lines(path))) for path in paths],
+        "chunk_transcripts": lambda: [list(transcripts.iter_chunks(path)) for path in paths],
+        "markdown_template": lambda: [rag_db.markdown_template(document) for document in documents],
+        "hybrid_search": lambda: [rag_db.hybrid_search(collection_name=COLLECTION_NAME, query=query, limit=5) for query in QUERIES],
+        "hybrid_search_vector_only": lambda: [rag_db.hybrid_search(collection_name=COLLECTION_NAME, query=query, limit=5, full_text_search=False) for query in QUERIES],
+        "hybrid_search_local": lambda: [rag_db.hybrid_search(collection_name=COLLECTION_NAME, query=query, limit=5, backend="local") for query in QUERIES],
+        "get_results": lambda: [rag_db.get_results(query, collection_name=COLLECTION_NAME, limit=5) for query in QUERIES],
+    }
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], tolerance: float) -> List[str]:
+    """Get the cases whose p50 latency or peak allocations regressed by more than `tolerance`."""
+    regressions = []
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        for metric in ("p50_ms", "peak_alloc_kb"):
+            if baseline[name][metric] and stats[metric] > baseline[name][metric] * (1 + tolerance):
+                regressions.append(f"{name}.{metric}: {baseline[name][metric]:.2f} -> {stats[metric]:.2f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline micro-benchmarks of the retrieval path.")
+    parser.add_argument("--repeat", type=int, default=20, help="timed runs per case")
+    parser.add_argument("--only", nargs="*", help="cases to run")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare against, exits 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    args = parser.parse_args()
+
+    check_encoding()
+    corpus = setup_offline_providers()
+    print(f"corpus: {len(corpus['paths'])} transcripts, {len(corpus['chunks'])} chunks")
+
+    results = {}
+    print(f"{'case':<28}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'peak KB':>10}{'kept KB':>10}{'out KB':>10}")
+    for name, func in cases(corpus).items():
+        if args.only and name not in args.only:
+            continue
+        stats = results[name] = measure(func, args.repeat)
+        print(f"{name:<28}" + "".join(f"{stats[metric]:>10.2f}" for metric in ("mean_ms", "p50_ms", "p95_ms", "peak_alloc_kb", "retained_alloc_kb", "payload_kb")))
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=1)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from agents.clients import warmup
+from agents.entry import CHATBOT_ENTRY_MODEL
+from agents.router import async_route
+from agents.context import pack_history
+from agents.memory_db import async_create_session, async_get_memory
+from agents.memory_manager import MemoryManager
+from agents.podcast_agent import async_execute_rag_response, async_stream_rag_response
+from agents.response_cache import async_lookup_response, async_store_response
+from agents.speculation import AsyncSpeculativeRetrieval, SPECULATIVE_RETRIEVAL
+from agents.tracing import span, metrics
+from ell import Message
+import uvicorn
+import asyncio
+import logging
+import uuid
+import json
+import os
+
+logger = logging.getLogger(__name__)
+
+# chat turns answered at once by a worker process, the others wait up to SERVER_QUEUE_TIMEOUT seconds
+SERVER_MAX_CONCURRENCY = int(os.getenv("SERVER_MAX_CONCURRENCY", "16"))
+SERVER_QUEUE_TIMEOUT = float(os.getenv("SERVER_QUEUE_TIMEOUT", "5"))
+# sessions whose history a worker keeps in memory, the others are loaded from Zep again
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "1024"))
+# the most recent messages sent as they are, older answers are replaced by their summaries
+RECENT_MESSAGES = 20
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "8000"))
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "1"))
+
+
+class CreateSessionRequest(BaseModel):
+    user_id: str = Field(description="The Zep user owning the session")
+    session_id: Optional[str] = Field(default=None, description="The id of the session, generated when missing")
+
+
+class CreateSessionResponse(BaseModel):
+    session_id: str
+
+
+class ChatRequest(BaseModel):
+    message: str = Field(min_length=1, description="The user message")
+    stream: bool = Field(default=True, description="Stream the answer as server-sent events")
+
+
+class ChatResponse(BaseModel):
+    session_id: str
+    answer: str
+    use_rag: bool
+    cached: bool
+
+
+class Session:
+    """The conversation of a session, as known by this worker."""
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.messages: List[Message] = []
+        self.loaded = False
+        # the turns of a session are answered one at a time, in order
+        self.lock = asyncio.Lock()
+
+
+class SessionStore:
+    """The sessions recently served by a worker, the least recently used are evicted.
+
+    Zep holds the conversation of every session, a worker loads it on the first turn it serves for a
+    session, so any worker behind the load balancer can serve any session. Turns are written to Zep
+    in the background, a session moving to another worker within `MEMORY_FLUSH_INTERVAL` seconds of
+    its last turn may miss that turn in its history.
+    """
+
+    def __init__(self, size: int = SESSION_CACHE_SIZE):
+        self.size = size
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+
+    def get(self, session_id: str) -> Session:
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = self._sessions[session_id] = Session(session_id)
+            self._evict()
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def discard(self, session_id: str):
+        self._sessions.pop(session_id, None)
+
+    def _evict(self):
+        # a session answering a turn is kept, its lock must stay the only one
+        for session_id in list(self._sessions):
+            if len(self._sessions) <= self.size:
+                return
+            if not self._sessions[session_id].lock.locked():
+                del self._sessions[session_id]
+
+
+async def load_history(session: Session):
+    """Load the conversation of a session from Zep, once per worker."""
+    if session.loaded:
+        return
+    try:
+        memory = await async_get_memory(session.session_id)
+        session.messages = [
+            Message(role=message.role_type, content=message.content)
+            for message in memory.messages or []
+            if message.role_type in ("user", "assistant")
+        ]
+    except Exception:
+        # a new session, or Zep is unavailable, the conversation starts empty
+        logger.warning("could not load the history of session %s", session.session_id, exc_info=True)
+    session.loaded = True
+
+
+def recent_history(messages: List[Message], memory_manager: MemoryManager) -> List[Message]:
+    if len(messages) > RECENT_MESSAGES:
+        messages = [memory_manager.summarized(message) for message in messages[:-RECENT_MESSAGES]] + messages[-RECENT_MESSAGES:]
+    # the most recent messages fitting in the history token budget of the router
+    return pack_history(messages, model=CHATBOT_ENTRY_MODEL)
+
+
+async def chat_turn(session: Session, prompt: str, memory_manager: MemoryManager, stream: bool = True) -> AsyncIterator[Tuple[str, Dict]]:
+    """Answer a user message, the flow of `app.py` without the UI.
+
+    Yields:
+        ("token", {"text"}) events while a RAG answer streams, then one ("answer", {...}) event with the
+        final answer, which replaces the streamed tokens when the graders rejected them.
+    """
+    await load_history(session)
+    # the session only keeps the turn once it is answered
+    user_message = Message(role="user", content=prompt)
+
+    # a similar question may have been answered before, then routing and retrieval are skipped
+    fact_content, cached = await asyncio.gather(
+        asyncio.to_thread(memory_manager.facts, session.session_id),
+        async_lookup_response(prompt),
+    )
+    use_rag = True
+    if cached is not None:
+        answer = cached["response"]
+    else:
+        speculation = AsyncSpeculativeRetrieval(prompt) if SPECULATIVE_RETRIEVAL else None
+        response = await async_route(
+            query=prompt,
+            history=recent_history(session.messages + [user_message], memory_manager),
+            facts=fact_content,
+        )
+        use_rag = str(response.use_rag).lower() == "true"
+        documents = None
+        if speculation is not None:
+            if use_rag:
+                documents = await speculation.claim()
+            else:
+                speculation.discard()
+
+        if not use_rag:
+            answer = response.answer
+        else:
+            answer = None
+            streamed = None
+            if stream:
+                streamed = await async_stream_rag_response(
+                    query=prompt,
+                    user_intent=response.user_intent,
+                    output_emotion=response.output_emotion,
+                    history=fact_content,
+                    documents=documents,
+                )
+            if streamed is not None:
+                async for token in streamed:
+                    yield "token", {"text": token}
+                if await streamed.is_valid():
+                    answer = streamed.text
+                    # an answer the graders could not check is served but not cached
+                    if streamed.graded:
+                        await async_store_response(prompt, answer, history=fact_content)
+            if answer is None:
+                answer = await async_execute_rag_response(
+                    query=prompt,
+                    user_intent=response.user_intent,
+                    output_emotion=response.output_emotion,
+                    history=fact_content,
+                    use_cache=streamed is None,
+                    documents=documents,
+                )
+
+    session.messages.extend([user_message, Message(role="assistant", content=answer)])
+    memory_manager.record_turn(session.session_id, prompt, answer)
+    yield "answer", {"session_id": session.session_id, "answer": answer, "use_rag": use_rag, "cached": cached is not None}
+
+
+def sse(event: str, data: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def create_app(max_concurrency: int = SERVER_MAX_CONCURRENCY, queue_timeout: float = SERVER_QUEUE_TIMEOUT) -> FastAPI:
+    """Create the chat API of a worker process.
+
+    The state of the worker lives on `app.state` and is created in its event loop, run as many as
+    needed behind a load balancer. Workers share the conversations through Zep, every worker keeps
+    its own response cache and only its invalidation, the collection generation file, is shared.
+    """
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        app.state.memory_manager = MemoryManager()
+        app.state.sessions = SessionStore()
+        app.state.slots = asyncio.Semaphore(max_concurrency)
+        warmup()
+        yield
+        app.state.memory_manager.close()
+
+    app = FastAPI(title="podcast chat", lifespan=lifespan)
+
+    async def acquire_slot(request: Request):
+        try:
+            await asyncio.wait_for(request.app.state.slots.acquire(), queue_timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail="Too many concurrent requests", headers={"Retry-After": "1"})
+
+    @app.get("/health")
+    async def health(request: Request):
+        return {"status": "ok", "saturated": request.app.state.slots.locked()}
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def stage_metrics():
+        return metrics.prometheus()
+
+    @app.post("/sessions", response_model=CreateSessionResponse)
+    async def create_session(body: CreateSessionRequest):
+        session_id = body.session_id or uuid.uuid4().hex
+        await async_create_session(user_id=body.user_id, session_id=session_id)
+        return CreateSessionResponse(session_id=session_id)
+
+    @app.delete("/sessions/{session_id}", status_code=204)
+    async def delete_session(session_id: str, request: Request):
+        request.app.state.sessions.discard(session_id)
+        await asyncio.to_thread(request.app.state.memory_manager.delete_session, session_id)
+
+    @app.post("/sessions/{session_id}/chat", response_model=ChatResponse)
+    async def chat(session_id: str, body: ChatRequest, request: Request):
+        state = request.app.state
+        await acquire_slot(request)
+        session = state.sessions.get(session_id)
+
+        if not body.stream:
+            try:
+                async with session.lock:
+                    with span("chat_turn", session_id=session_id):
+                        async for event, data in chat_turn(session, body.message, state.memory_manager, stream=False):
+                            if event == "answer":
+                                return ChatResponse(**data)
+            finally:
+                state.slots.release()
+
+        async def events() -> AsyncIterator[str]:
+            # the slot is held until the stream ends or the client goes away
+            try:
+                async with session.lock:
+                    with span("chat_turn", session_id=session_id, stream=True):
+                        async for event, data in chat_turn(session, body.message, state.memory_manager):
+                            yield sse(event, data)
+            except Exception as e:
+                logger.exception("chat turn failed for session %s", session_id)
+                yield sse("error", {"detail": str(e)})
+            finally:
+                state.slots.release()
+
+        return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    return app
+
+
+app = create_app()
+
+
+if __name__ == "__main__":
+    uvicorn.run("server:app", host=SERVER_HOST, port=SERVER_PORT, workers=SERVER_WORKERS)
@@ -0,0 +1,8 @@
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# the agents modules read the API keys at import, the tests never call a provider
+for name in ("OPENAI_API_KEY", "GROQ_API_KEY", "COHERE_API_KEY", "ZEP_API_KEY"):
+    os.environ.setdefault(name, "test")
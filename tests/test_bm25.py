@@ -0,0 +1,61 @@
+from agents.bm25 import BM25Index, analyze, reciprocal_rank_fusion
+import numpy as np
+
+CONTENTS = [
+    "Elon Musk talks about rockets and Mars colonies",
+    "The history of the Roman empire and its fall",
+    "Rockets, rockets everywhere: the economics of reusable rockets",
+    "",
+]
+
+
+def test_analyze_drops_stopwords():
+    assert analyze("What is the Roman Empire about?") == ["roman", "empire"]
+
+
+def test_search_ranks_by_term_frequency():
+    index = BM25Index.build(CONTENTS)
+
+    hits = index.search("rockets")
+
+    assert [position for position, _ in hits] == [2, 0]
+    assert hits[0][1] > hits[1][1] > 0
+
+
+def test_search_skips_documents_without_a_query_term():
+    index = BM25Index.build(CONTENTS)
+
+    assert index.search("quantum") == []
+    assert index.search("the and of") == []
+
+
+def test_search_limit_and_mask():
+    index = BM25Index.build(CONTENTS)
+
+    assert len(index.search("rockets roman", limit=1)) == 1
+    mask = np.array([True, True, False, True])
+    assert [position for position, _ in index.search("rockets", mask=mask)] == [0]
+
+
+def test_save_and_load_keep_the_scores(tmp_path):
+    index = BM25Index.build(CONTENTS)
+    index.save(str(tmp_path))
+
+    loaded = BM25Index.load(str(tmp_path))
+
+    assert len(loaded) == len(index)
+    np.testing.assert_allclose(loaded.scores("roman rockets mars"), index.scores("roman rockets mars"))
+
+
+def test_empty_index():
+    index = BM25Index.build([])
+
+    assert len(index) == 0
+    assert index.search("rockets") == []
+
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion([["a", "b"], ["b", "c"]], k=1)
+
+    assert fused == {"a": 1 / 2, "b": 1 / 3 + 1 / 2, "c": 1 / 3}
+    assert reciprocal_rank_fusion([["a"], ["b"]], weights=[2.0, 1.0], k=0) == {"a": 2.0, "b": 1.0}
@@ -0,0 +1,64 @@
+from collections import OrderedDict
+from agents import context
+import pytest
+
+
+class WordEncoding:
+    """One token per word, so the tests need no tiktoken download."""
+
+    name = "words"
+
+    def encode(self, text, **kwargs):
+        return text.split()
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+@pytest.fixture(autouse=True)
+def word_encoding(monkeypatch):
+    monkeypatch.setattr(context, "encoding", lambda model=None: WordEncoding())
+    monkeypatch.setattr(context, "_token_counts", OrderedDict())
+
+
+def test_pack_documents_keeps_the_order():
+    documents = ["one two", "three four five", "six"]
+
+    assert context.pack_documents(documents, "gpt-4o-mini", limit=10) == documents
+
+
+def test_pack_documents_skips_the_documents_not_fitting():
+    documents = ["one two three", "four five six seven", "eight", "nine ten"]
+
+    assert context.pack_documents(documents, "gpt-4o-mini", limit=6) == ["one two three", "eight", "nine ten"]
+
+
+def test_pack_documents_truncates_a_first_document_over_the_budget():
+    documents = ["one two three four five", "six seven eight nine ten eleven"]
+
+    assert context.pack_documents(documents, "gpt-4o-mini", limit=3) == ["one two three"]
+
+
+def test_pack_documents_without_documents():
+    assert context.pack_documents([], "gpt-4o-mini", limit=3) == []
+
+
+def test_pack_documents_uses_the_model_budget(monkeypatch):
+    monkeypatch.setitem(context.CONTEXT_BUDGETS, "test-model", {"documents": 2, "history": 1})
+
+    assert context.pack_documents(["one", "two", "three"], "test-model") == ["one", "two"]
+
+
+def test_seeded_token_counts_are_used():
+    context.seed_token_count("one two three", 1, "words")
+
+    assert context.count_tokens("one two three") == 1
+    assert context.pack_documents(["one two three", "four"], "gpt-4o-mini", limit=2) == ["one two three", "four"]
+
+
+def test_dedupe_chunks_drops_repeated_content():
+    first = {"content": "rockets are hard to land on a moving barge at sea"}
+    repeated = {"content": "Rockets are hard to land on a moving barge at sea!"}
+    other = {"content": "the roman empire fell slowly over centuries"}
+
+    assert context.dedupe_chunks([first, repeated, other]) == [first, other]
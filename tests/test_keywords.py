@@ -0,0 +1,62 @@
+from agents.keywords import AhoCorasick, KeywordExtractor, build_keyword_index, terms_from_index
+
+TRANSCRIPT = """Title: Transcript for Elon Musk: War, AI & Aliens | Lex Fridman Podcast #400 - Lex Fridman
+
+Markdown Content:
+Introduction
+------------
+
+Elon Musk [(00:00:00)](https://youtube.com) Rockets are hard.
+
+Lex Fridman [(00:00:05)](https://youtube.com) Tell me about Starship.
+"""
+
+
+def test_aho_corasick_finds_every_occurrence():
+    matcher = AhoCorasick(["he", "she", "hers", "his"])
+
+    assert matcher.find("she told his story, hers too") == [(0, 3, "she"), (9, 12, "his"), (20, 24, "hers")]
+
+
+def test_aho_corasick_matches_word_boundaries_only():
+    matcher = AhoCorasick(["art", "ai"])
+
+    assert matcher.find("smart artists paint") == []
+    assert matcher.find("art, ai.") == [(0, 3, "art"), (5, 7, "ai")]
+
+
+def test_aho_corasick_overlapping_patterns():
+    matcher = AhoCorasick(["new york", "york city"])
+
+    assert matcher.find("new york city") == [(0, 8, "new york"), (4, 13, "york city")]
+
+
+def test_extractor_keeps_the_leftmost_longest_matches():
+    extractor = KeywordExtractor({"elon musk": "Elon Musk", "musk": "Musk", "ai": "AI", "musk on ai": "Musk on AI"})
+
+    assert extractor.extract("What does Elon Musk on AI say?") == ["Elon Musk", "AI"]
+
+
+def test_extractor_returns_canonical_spellings_once():
+    extractor = KeywordExtractor({"starship": "Starship"})
+
+    assert extractor.extract("STARSHIP and starship") == ["Starship"]
+    assert extractor.extract("nothing here") == []
+
+
+def test_terms_from_index_matches_speakers_by_their_names():
+    terms = terms_from_index({"speakers": ["Elon Musk"], "terms": ["musk", "rockets"]})
+
+    assert terms == {"elon musk": "Elon Musk", "elon": "Elon", "musk": "Musk", "rockets": "rockets"}
+
+
+def test_build_keyword_index(tmp_path):
+    (tmp_path / "elonmusk.txt").write_text(TRANSCRIPT, encoding="utf-8")
+
+    index = build_keyword_index(str(tmp_path), path=None)
+
+    assert index["speakers"] == ["Elon Musk", "Lex Fridman"]
+    assert index["titles"] == ["AI", "Aliens", "Elon Musk", "War"]
+    assert index["subtopics"] == ["Introduction"]
+    extractor = KeywordExtractor(terms_from_index(index))
+    assert extractor.extract("what did musk say about aliens") == ["Musk", "Aliens"]
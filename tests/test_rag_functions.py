@@ -0,0 +1,51 @@
+from agents import rag_functions
+import threading
+import time
+import pytest
+
+
+@pytest.fixture
+def grades(monkeypatch):
+    """Grade the documents "yes", "no", "slow" (answers after 0.05s), "stuck" and "error"."""
+    release = threading.Event()
+
+    def is_relevant(query, document):
+        if document == "slow":
+            time.sleep(0.05)
+            return True
+        if document == "stuck":
+            release.wait(5)
+            return True
+        if document == "error":
+            raise RuntimeError("grader failed")
+        return document == "yes"
+
+    monkeypatch.setattr(rag_functions, "_is_relevant", is_relevant)
+    yield
+    release.set()
+
+
+def test_concurrent_relevance_keeps_the_document_order(grades):
+    documents = ["slow", "no", "yes", "no", "slow"]
+
+    assert rag_functions._concurrent_relevance("query", documents, 5, 5.0, True) == [True, False, True, False, True]
+
+
+def test_concurrent_relevance_with_one_worker(grades):
+    assert rag_functions._concurrent_relevance("query", ["yes", "no", "slow"], 1, 5.0, True) == [True, False, True]
+
+
+@pytest.mark.parametrize("keep_on_error", [True, False])
+def test_concurrent_relevance_falls_back_on_timeouts(grades, keep_on_error):
+    start = time.monotonic()
+
+    relevance = rag_functions._concurrent_relevance("query", ["yes", "stuck", "no"], 3, 0.2, keep_on_error)
+
+    assert relevance == [True, keep_on_error, False]
+    # the stuck grade is not waited for
+    assert time.monotonic() - start < 2
+
+
+@pytest.mark.parametrize("keep_on_error", [True, False])
+def test_concurrent_relevance_falls_back_on_errors(grades, keep_on_error):
+    assert rag_functions._concurrent_relevance("query", ["error", "no"], 2, 5.0, keep_on_error) == [keep_on_error, False]
@@ -0,0 +1,81 @@
+from agents.rerankers import CrossEncoderReranker, LexicalReranker, Reranker
+import pytest
+
+
+class StaticReranker(Reranker):
+    name = "static"
+
+    def __init__(self, scores, **kwargs):
+        super().__init__(**kwargs)
+        self.scores = scores
+        self.scored = []
+
+    def _score(self, query, documents):
+        self.scored.extend(documents)
+        return [self.scores[document] for document in documents]
+
+
+class FakeCrossEncoder:
+    """Returns probabilities like `CrossEncoder.predict` does for single-label models."""
+
+    def __init__(self, scores):
+        self.scores = scores
+
+    def predict(self, pairs, **kwargs):
+        return [self.scores[document] for _, document in pairs]
+
+
+def test_verdict_cutoffs():
+    reranker = StaticReranker({}, accept_score=0.8, reject_score=0.1)
+
+    assert reranker.verdict(0.9) is True
+    assert reranker.verdict(0.8) is True
+    assert reranker.verdict(0.5) is None
+    assert reranker.verdict(0.1) is False
+    assert reranker.verdict(0.0) is False
+
+
+def test_verdict_without_cutoffs():
+    reranker = StaticReranker({})
+
+    assert reranker.verdict(1.0) is None
+    assert reranker.verdict(-1.0) is None
+
+
+def test_cutoffs_from_the_environment(monkeypatch):
+    monkeypatch.setenv("RERANK_STATIC_ACCEPT", "0.7")
+    monkeypatch.setenv("RERANK_STATIC_REJECT", "none")
+
+    reranker = StaticReranker({})
+
+    assert (reranker.accept_score, reranker.reject_score) == (0.7, None)
+
+
+def test_scores_are_cached():
+    reranker = StaticReranker({"a": 0.2, "b": 0.9})
+
+    assert reranker.rerank("query", ["a", "b"]) == [(1, 0.9), (0, 0.2)]
+    assert reranker.score("query", ["b", "a"]) == [0.9, 0.2]
+    assert reranker.scored == ["a", "b"]
+
+
+def test_lexical_reranker():
+    reranker = LexicalReranker()
+
+    scores = reranker.score("roman empire", ["the roman empire", "the roman republic", "rockets"])
+
+    assert scores[0] == pytest.approx(1.0)
+    assert 0 < scores[1] < 1
+    assert scores[2] == 0.0
+    assert reranker.verdict(scores[2]) is False
+
+
+def test_cross_encoder_keeps_the_probabilities():
+    reranker = CrossEncoderReranker()
+    reranker._model = FakeCrossEncoder({"relevant": 0.95, "irrelevant": 0.005, "unsure": 0.4})
+
+    scores = reranker.score("query", ["relevant", "irrelevant", "unsure"])
+
+    # squashing the probabilities again would map them all into (0.5, 0.73)
+    assert scores == pytest.approx([0.95, 0.005, 0.4])
+    assert [reranker.verdict(score) for score in scores] == [True, False, None]
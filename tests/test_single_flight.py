@@ -0,0 +1,134 @@
+from agents.single_flight import coalesced, coalescing_stats
+import threading
+import asyncio
+import time
+import pytest
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def test_concurrent_calls_share_one_execution():
+    release = threading.Event()
+    executions = []
+
+    @coalesced("test_sync_shared", key=lambda value: value)
+    def compute(value):
+        executions.append(value)
+        release.wait(5)
+        return [value]
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(compute("a"))) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    _wait_for(lambda: coalescing_stats().get("test_sync_shared", {}).get("merged") == 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert executions == ["a"]
+    assert results == [["a"]] * 3
+    # every caller gets its own list
+    assert len({id(result) for result in results}) == 3
+    stats = coalescing_stats()["test_sync_shared"]
+    assert (stats["calls"], stats["executions"], stats["merged"]) == (3, 1, 2)
+
+
+def test_sequential_calls_execute_again():
+    calls = []
+
+    @coalesced("test_sync_sequential", key=lambda value: value)
+    def compute(value):
+        calls.append(value)
+        return value
+
+    assert compute("a") == compute("a") == "a"
+    assert calls == ["a", "a"]
+
+
+def test_waiters_receive_the_exception():
+    release = threading.Event()
+
+    @coalesced("test_sync_error", key=lambda: "key")
+    def fail():
+        release.wait(5)
+        raise ValueError("boom")
+
+    errors = []
+
+    def call():
+        try:
+            fail()
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    _wait_for(lambda: coalescing_stats().get("test_sync_error", {}).get("merged") == 1)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(errors) == 2 and errors[0] is errors[1]
+    assert coalescing_stats()["test_sync_error"]["failures"] == 1
+
+
+def test_async_calls_share_one_execution():
+    executions = []
+
+    @coalesced("test_async_shared", key=lambda value: value)
+    async def compute(value):
+        executions.append(value)
+        await asyncio.sleep(0.01)
+        return [value]
+
+    async def main():
+        return await asyncio.gather(compute("a"), compute("a"), compute("b"))
+
+    assert asyncio.run(main()) == [["a"], ["a"], ["b"]]
+    assert sorted(executions) == ["a", "b"]
+
+
+def test_async_execution_survives_a_cancelled_waiter():
+    @coalesced("test_async_cancel", key=lambda: "key")
+    async def compute():
+        await asyncio.sleep(0.05)
+        return "done"
+
+    async def main():
+        first = asyncio.ensure_future(compute())
+        second = asyncio.ensure_future(compute())
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(main()) == "done"
+    assert coalescing_stats()["test_async_cancel"]["cancelled"] == 0
+
+
+def test_async_execution_is_cancelled_with_its_last_waiter():
+    started = []
+
+    @coalesced("test_async_cancel_all", key=lambda: "key")
+    async def compute():
+        started.append(True)
+        await asyncio.sleep(5)
+
+    async def main():
+        call = asyncio.ensure_future(compute())
+        await asyncio.sleep(0.01)
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+
+    asyncio.run(main())
+    assert started == [True]
+    assert coalescing_stats()["test_async_cancel_all"]["cancelled"] == 1
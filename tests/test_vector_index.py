@@ -0,0 +1,93 @@
+from agents.vector_index import build_index, quantize_binary, quantize_int8, NumpyVectorIndex
+import numpy as np
+import pytest
+
+
+def _collection(count=200, dim=32, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = rng.normal(size=(count, dim)).astype(np.float32)
+    payloads = [{"content": f"chunk {i}", "subtopic": "even" if i % 2 == 0 else "odd"} for i in range(count)]
+    return list(range(count)), vectors, payloads
+
+
+def test_quantize_int8_round_trip():
+    matrix = np.array([[0.5, -1.0, 0.25], [0.0, 0.0, 0.0]], dtype=np.float32)
+
+    codes, scales = quantize_int8(matrix)
+
+    assert codes.dtype == np.int8 and scales.dtype == np.float32
+    assert codes[0].tolist() == [64, -127, 32]
+    # an all-zero row keeps a scale of 1 instead of dividing by zero
+    assert codes[1].tolist() == [0, 0, 0] and scales[1] == 1
+    np.testing.assert_allclose(codes[0] * scales[0], matrix[0], atol=1 / 127)
+
+
+def test_quantize_binary_packs_the_sign_bits():
+    matrix = np.array([[1, -1, 1, 1, -1, -1, -1, 1, 1]], dtype=np.float32)
+
+    bits = quantize_binary(matrix)
+
+    assert bits.shape == (1, 2)
+    assert bits.tolist() == [[0b10110001, 0b10000000]]
+
+
+@pytest.mark.parametrize("quantization", ["none", "int8", "binary"])
+def test_search_finds_the_nearest_points(tmp_path, quantization):
+    ids, vectors, payloads = _collection()
+    index = NumpyVectorIndex(build_index("test", ids, vectors, payloads, str(tmp_path), quantization))
+
+    assert index.quantization == quantization
+    for row in (0, 17, 123):
+        hits = index.search(vectors[row], limit=3)
+        assert hits[0].id == str(row)
+        assert hits[0].score == pytest.approx(1.0, abs=1e-5)
+        assert hits[0].payload == payloads[row]
+
+
+@pytest.mark.parametrize("quantization", ["int8", "binary"])
+def test_quantized_search_rescores_with_the_float32_vectors(tmp_path, quantization):
+    ids, vectors, payloads = _collection()
+    index = NumpyVectorIndex(build_index("test", ids, vectors, payloads, str(tmp_path), quantization))
+
+    hits = index.search(vectors[5], limit=5)
+    exact = {hit.id: hit.score for hit in index.search(vectors[5], limit=len(ids), exact=True)}
+
+    for hit in hits:
+        assert hit.score == pytest.approx(exact[hit.id])
+    assert index.memory_usage()["quantized"] < index.memory_usage()["float32"]
+    assert index.recall(k=5, queries=20) >= 0.6
+
+
+@pytest.mark.parametrize("quantization", ["none", "int8"])
+def test_search_applies_the_filters(tmp_path, quantization):
+    ids, vectors, payloads = _collection()
+    index = NumpyVectorIndex(build_index("test", ids, vectors, payloads, str(tmp_path), quantization))
+
+    hits = index.search(vectors[4], limit=5, must={"subtopic": ["odd"]})
+
+    assert len(hits) == 5
+    assert all(hit.payload["subtopic"] == "odd" for hit in hits)
+    assert index.search(vectors[4], must={"subtopic": ["missing"]}) == []
+
+
+def test_empty_collection(tmp_path):
+    index = NumpyVectorIndex(build_index("test", [], [], [], str(tmp_path), "int8"))
+
+    assert len(index) == 0
+    assert index.search([0.1, 0.2]) == []
+    assert index.lexical_search("chunk") == []
+
+
+def test_rebuild_replaces_the_index(tmp_path):
+    ids, vectors, payloads = _collection(count=10)
+    build_index("test", ids, vectors, payloads, str(tmp_path))
+
+    path = build_index("test", ids[:4], vectors[:4], payloads[:4], str(tmp_path))
+
+    assert len(NumpyVectorIndex(path)) == 4
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["test"]
+
+
+def test_unknown_quantization(tmp_path):
+    with pytest.raises(ValueError):
+        build_index("test", [], [], [], str(tmp_path), "float16")